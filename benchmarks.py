@@ -0,0 +1,177 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+import general_json2yolo
+from downloads import Downloader
+from imageio_utils import RegionReader
+
+
+def timeit(fn, *args, n=3):
+    """Returns the best wall time in seconds of `n` calls to fn(*args) and the last result."""
+    best = float("inf")
+    for _ in range(n):
+        t = time.perf_counter()
+        y = fn(*args)
+        best = min(best, time.perf_counter() - t)
+    return best, y
+
+
+def min_index_reference(arr1, arr2):
+    """Original all-pairs min_index, kept as the correctness and speed baseline."""
+    dis = ((arr1[:, None, :] - arr2[None, :, :]) ** 2).sum(-1)
+    return np.unravel_index(np.argmin(dis, axis=None), dis.shape)
+
+
+def polygon(n, rng, offset=0.0):
+    """Returns an (n, 2) float polygon ring with integer-pixel vertices, so distance ties are common."""
+    a = np.sort(rng.uniform(0, 2 * np.pi, n))
+    r = rng.uniform(200, 400, n)
+    return np.round(np.stack((np.cos(a) * r + offset, np.sin(a) * r), 1))
+
+
+def benchmark_min_index(sizes=(64, 512, 2048, 8192), seed=0):
+    """Benchmarks min_index against the all-pairs reference for polygon size buckets and checks identical indices."""
+    rng = np.random.default_rng(seed)
+    print(f"{'N=M':>6} {'reference (ms)':>15} {'min_index (ms)':>15} {'speedup':>8}  same")
+    for n in sizes:
+        a, b = polygon(n, rng), polygon(n, rng, offset=700.0)
+        t0, y0 = timeit(min_index_reference, a, b)
+        t1, y1 = timeit(general_json2yolo.min_index, a, b)
+        same = tuple(map(int, y0)) == tuple(map(int, y1))
+        print(f"{n:>6} {t0 * 1e3:>15.2f} {t1 * 1e3:>15.2f} {t0 / t1:>7.1f}x  {same}")
+
+
+def frame(w, h, rng):
+    """Returns a smooth textured (h, w, 3) uint8 BGR frame that compresses like a camera image."""
+    im = cv2.resize(rng.integers(0, 256, (h // 8, w // 8, 3), dtype=np.uint8), (w, h), interpolation=cv2.INTER_CUBIC)
+    return cv2.add(im, rng.integers(0, 16, (h, w, 3), dtype=np.uint8))
+
+
+def full_crop(path, box, scale=1.0):
+    """Baseline crop: full-frame decode, slice and optional INTER_AREA resize like RegionReader."""
+    x0, y0, x1, y1 = box
+    im = cv2.imread(path)[y0:y1, x0:x1]
+    if scale != 1:
+        im = cv2.resize(im, (round((x1 - x0) * scale), round((y1 - y0) * scale)), interpolation=cv2.INTER_AREA)
+    return im
+
+
+def benchmark_roi(size=(3840, 2160), fractions=(1 / 4, 1 / 8, 1 / 16), scales=(1.0, 0.5), seed=0):
+    """
+    Benchmarks full-frame decoding against RegionReader crops of a 4K JPEG for person-like crop sizes.
+
+    Frames are written without restart markers, with one restart interval per MCU row and with 16-MCU intervals; each
+    crop is `fraction` of the frame width with a 1:2.5 aspect ratio. Reads are cold, with a new reader per call.
+    """
+    rng = np.random.default_rng(seed)
+    w, h = size
+    im = frame(w, h, rng)
+    with tempfile.TemporaryDirectory() as d:
+        print(
+            f"{'restart':>8} {'crop':>10} {'scale':>6} {'full (ms)':>10} "
+            f"{'roi (ms)':>9} {'speedup':>8} {'via':>8}  same"
+        )
+        for name, interval in ("none", 0), ("row", w // 16), ("16 MCU", 16):
+            path = os.path.join(d, f"{name}.jpg")
+            cv2.imwrite(path, im, [cv2.IMWRITE_JPEG_QUALITY, 90, cv2.IMWRITE_JPEG_RST_INTERVAL, interval])
+            for fraction in fractions:
+                cw = int(w * fraction)
+                ch = min(int(cw * 2.5), h)
+                x0, y0 = int(rng.integers(0, w - cw + 1)), int(rng.integers(0, h - ch + 1))
+                box = (x0, y0, x0 + cw, y0 + ch)
+                for scale in scales:
+                    t0, a = timeit(full_crop, path, box, scale)
+                    t1, b = timeit(lambda p=path, b=box, s=scale: RegionReader()(p, b, s))
+                    reader = RegionReader()
+                    reader(path, box, scale)
+                    via = ",".join(reader.counts)  # strategy picked
+                    # reduced DCT decoding is approximate by design, so scaled crops report the mean abs difference
+                    same = bool((a == b).all()) if scale == 1 else f"{np.abs(a.astype(int) - b).mean():.2f}"
+                    print(
+                        f"{name:>8} {f'{cw}x{ch}':>10} {scale:>6g} {t0 * 1e3:>10.2f} {t1 * 1e3:>9.2f} "
+                        f"{t0 / t1:>7.1f}x {via:>8}  {same}"
+                    )
+
+
+def image_server(files, latency=0.05):
+    """Starts a local keep-alive HTTP server that serves `files` {path: bytes} after `latency` seconds per request."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, so pooled connections are reused
+
+        def do_GET(self):
+            """Serves one file, or 404."""
+            time.sleep(latency)  # stand-in for the network round trips of a remote image server
+            body = files.get(self.path.split("?")[0])
+            self.send_response(200 if body is not None else 404)
+            self.send_header("Content-Length", str(len(body or b"")))
+            self.end_headers()
+            self.wfile.write(body or b"")
+
+        def log_message(self, *args):
+            """Keeps the benchmark output quiet."""
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def sequential_download(items):
+    """Baseline download: one bare requests.get per URL, the whole body in memory, written after it arrives."""
+    import requests
+
+    for url, path in items:
+        r = requests.get(url)
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            f.write(r.content)
+
+
+def benchmark_download(n=64, size=200_000, latency=0.05, workers=(4, 16), seed=0):
+    """
+    Benchmarks sequential image downloads against the pooled, concurrent Downloader on a local stand-in server.
+
+    `n` images of `size` random bytes are served with `latency` seconds per request; one missing URL checks that
+    failures are returned per item. Downloaded files are compared with the served bytes.
+    """
+    rng = np.random.default_rng(seed)
+    files = {f"/pic/{i:04d}.jpg": rng.integers(0, 256, size, dtype=np.uint8).tobytes() for i in range(n)}
+    server = image_server(files, latency)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with tempfile.TemporaryDirectory() as d:
+            items = [(base + k, os.path.join(d, os.path.basename(k))) for k in files]
+            t0, _ = timeit(sequential_download, items, n=1)
+            print(f"{'workers':>8} {'sequential (s)':>15} {'Downloader (s)':>15} {'speedup':>8}  same  failed")
+            for w in workers:
+                for _, path in items:
+                    os.remove(path)
+                with Downloader(workers=w, per_host=w) as dl:
+                    t1, results = timeit(lambda dl=dl: list(dl.map(items + [(base + "/missing.jpg", d + "/x")])), n=1)
+                same = all(Path(p).read_bytes() == files["/pic/" + os.path.basename(p)] for _, p in items)
+                failed = sum(r.error is not None for r in results)
+                print(f"{w:>8} {t0:>15.2f} {t1:>15.2f} {t0 / t1:>7.1f}x  {same}  {failed}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSON2YOLO micro-benchmarks")
+    parser.add_argument("name", choices=["min_index", "roi", "download"], help="benchmark to run")
+    opt = parser.parse_args()
+    if opt.name == "min_index":
+        benchmark_min_index()
+    elif opt.name == "roi":
+        benchmark_roi()
+    elif opt.name == "download":
+        benchmark_download()
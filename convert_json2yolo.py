@@ -1,85 +1,104 @@
 # Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
 
 import contextlib
-import json
 from collections import defaultdict
 
-import cv2
 import pandas as pd
-from PIL import Image
 
 from utils import *
-import shutil
 
 
-def convert_coco_json(image_dir="../coco/images/", json_dir="../coco/annotations/", use_segments=False, cls91to80=False):
-    """Converts COCO JSON format to YOLO label format, with options for segments and class mapping."""
-    save_dir = make_dirs()  # output directory
-    coco80 = coco91_to_coco80_class()
+def convert_coco_json(image_dir="../coco/images/", json_dir="../coco/annotations/", use_segments=False, cls91to80=False, decimals=None, incremental=False, stage_mode="reflink", store=None, pack=False, shard_size=0):
+    """
+    Converts LabelMe JSON shapes to YOLO labels; `decimals` sets the rounding tolerance for duplicate boxes.
+
+    Images are staged into the output tree by `stage_mode` (see staging.STAGE_MODES) instead of being copied.
+
+    Annotations are read from the LabelMeStore of `json_dir`. Given a `store` file it is cached there, and later runs
+    parse only the JSON files changed since; by default every JSON file is parsed and nothing is cached.
 
-    # Import json
-    for json_file in sorted(Path(json_dir).resolve().glob("*.json")):
-        # print(json_file, json_file.stem)
-        # fn = Path(save_dir) / "labels" / json_file.stem.replace("instances_", "")  # folder name
-        image_fn = Path(save_dir) / "images"  # folder name
-        fn = Path(save_dir) / "labels"  # folder name
-        # print("fn: ",fn)
-        # fn.mkdir()
-        os.makedirs(image_fn, exist_ok=True)
-        os.makedirs(fn, exist_ok=True)  # make directory if not exists
-        with open(json_file) as f:
-            data = json.load(f)
-
-        image_file_name = json_file.stem+".jpg"
-        image_path = os.path.join(image_dir, image_file_name)
-        img_width, img_height = data['imageWidth'], data['imageHeight']
-        # print("image_path, img_width, img_height: ", image_path, img_width, img_height)
-        with Image.open(image_path) as img:
-            img_width, img_height = img.size
-        # print(f"Image dimensions: width={img_width}, height={img_height}")
-
-        bboxes = []
-        for shape in data['shapes']:
-            label = shape['label']
-            if label == 'ALC条板':
+    With `incremental=True` the output directory is kept and only JSON/image pairs that changed since the last run are
+    reconverted; outputs of deleted JSON files are removed. Changing `use_segments`, `cls91to80` or `decimals` converts
+    every pair again.
+
+    With `pack=True` all labels are packed into one memory-mappable `labels.bin` (see packing.PackedLabels) instead of
+    one .txt file per image; PackedLabels.export() writes the .txt files back when needed.
+
+    With `shard_size` > 0 images and labels are written into tar shards of at most `shard_size` bytes plus a shard index
+    under `new_dir/shards` (see packing.ShardWriter) instead of the images/ and labels/ trees.
+    """
+    out = DatasetWriter("new_dir", stage_mode, pack, shard_size, incremental)  # checks the options before cleaning
+    save_dir = make_dirs(out.save_dir, clean=not incremental)  # output directory
+    options = {"use_segments": use_segments, "cls91to80": cls91to80, "decimals": decimals}  # labels depend on these
+    manifest = Manifest(save_dir / "manifest.json", options) if incremental else None
+    coco80 = coco91_to_coco80_class()
+    sizes = ImageSizeCache()
+    with out:  # packed labels and the open shard are discarded on failure
+        # Import json
+        json_dir = Path(json_dir).resolve()
+        records = LabelMeStore.open(json_dir, store)
+        json_files = [json_dir / f for f in records.files.tolist()]
+        for json_file, rec in zip(json_files, records):
+            # print(json_file, json_file.stem)
+            # fn = Path(save_dir) / "labels" / json_file.stem.replace("instances_", "")  # folder name
+            image_fn = Path(save_dir) / "images"  # folder name
+            fn = Path(save_dir) / "labels"  # folder name
+            # print("fn: ",fn)
+            # fn.mkdir()
+            os.makedirs(image_fn, exist_ok=True)
+            os.makedirs(fn, exist_ok=True)  # make directory if not exists
+            image_file_name = json_file.stem+".jpg"
+            image_path = os.path.join(image_dir, image_file_name)
+            label_path = (fn / image_file_name).with_suffix(".txt")
+            if manifest:
+                if not manifest.changed(str(json_file), [json_file, image_path]):
+                    continue
+                manifest.begin(str(json_file), [label_path, image_fn / image_file_name])
+            if rec.error:
+                raise ValueError(f"{json_file}: {rec.error}")
+
+            # print("image_path, img_width, img_height: ", image_path, img_width, img_height)
+            img_width, img_height = sizes(image_path, exif=False)  # header-only probe, cached across runs
+            # print(f"Image dimensions: width={img_width}, height={img_height}")
+
+            keep = rec.labels != 'ALC条板'
+            for label in rec.labels[~keep]:
                 print(f"Label: {label}")
-                continue
-
-            cls = int(shape['group_id'])
-            cls -= 1
-            # if cls != 5:
-            #     cls -= 1
-            # else:
-            #     cls = 3
-            # print(f"Class: {cls}")
-
-            x_coords = [point[0] for point in shape['points']]
-            y_coords = [point[1] for point in shape['points']]
-            x_min, x_max = min(x_coords), max(x_coords)
-            y_min, y_max = min(y_coords), max(y_coords)
-            # x_min, x_max = int(min(x_coords)), int(max(x_coords))
-            # y_min, y_max = int(min(y_coords)), int(max(y_coords))
-
-            box = np.array([x_min, y_min, x_max-x_min, y_max-y_min], dtype=np.float64)
-            box[:2] += box[2:] / 2  # xy top-left corner to center
-            box[[0, 2]] /= img_width  # normalize x
-            box[[1, 3]] /= img_height  # normalize y
-            
-            if box[2] <= 0 or box[3] <= 0:  # if w <= 0 and h <= 0
-                continue
-
-            box = [cls] + box.tolist()
-            # print(f"Box: {box}")
-            if box not in bboxes:
-                bboxes.append(box)
-            
-            # Copy image to output/images directory
-            shutil.copy(image_path, image_fn / image_file_name)
-            # Write
-            with open((fn / image_file_name).with_suffix(".txt"), "a") as file:
-                for i in range(len(bboxes)):
-                    line = (*(bboxes[i]),)  # cls, box or segments
-                    file.write(("%g " * len(line)).rstrip() % line + "\n")
+            if (rec.group_ids[keep] < 0).any():
+                raise ValueError(f"{json_file}: shape without group_id")
+            boxes, valid = normalize_boxes(rec.xywh()[keep], img_width, img_height)
+
+            bboxes, seen = [], set()
+            for cls, box, ok in zip(rec.group_ids[keep].tolist(), boxes, valid):
+                cls -= 1
+                # if cls != 5:
+                #     cls -= 1
+                # else:
+                #     cls = 3
+                # print(f"Class: {cls}")
+
+                if not ok:  # if w <= 0 and h <= 0
+                    continue
+
+                box = [cls] + box.tolist()
+                # print(f"Box: {box}")
+                key = row_key(box, decimals)  # hashed duplicate check, O(1) per box
+                if key not in seen:
+                    seen.add(key)
+                    bboxes.append(box)
+
+            if bboxes:
+                # Stage image and write labels (cls, box or segments), or both into the current shard
+                out.write(image_path, image_fn / image_file_name, label_path, bboxes)
+
+            if manifest:
+                manifest.record(str(json_file), [x for x in (label_path, image_fn / image_file_name) if x.exists()])
+
+        if manifest:
+            manifest.prune(str(x) for x in json_files)
+            manifest.save()
+
+    sizes.save()
 
 
 def min_index(arr1, arr2):
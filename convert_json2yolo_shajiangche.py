@@ -1,86 +1,81 @@
 # Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
 
 import contextlib
-import json
 from collections import defaultdict
 
-import cv2
 import pandas as pd
-from PIL import Image
 
 from utils import *
-import shutil
 
 
 def convert_coco_json(image_dir="../coco/images/", json_dir="../coco/annotations/", 
-                      use_segments=False, cls91to80=False):
-    """Converts COCO JSON format to YOLO label format, with options for segments and class mapping."""
+                      use_segments=False, cls91to80=False, decimals=None, stage_mode="reflink", store=None, pack=False, shard_size=0):
+    """
+    Converts LabelMe JSON shapes to YOLO labels; `decimals` sets the rounding tolerance for duplicate boxes.
+
+    Images are staged into the output tree by `stage_mode` (see staging.STAGE_MODES) instead of being copied.
+
+    Annotations are read from the LabelMeStore of `json_dir`. Given a `store` file it is cached there, and later runs
+    parse only the JSON files changed since; by default every JSON file is parsed and nothing is cached.
+
+    With `pack=True` all labels are packed into one memory-mappable `labels.bin` (see packing.PackedLabels) instead of
+    one .txt file per image. With `shard_size` > 0 images and labels are written into tar shards of at most
+    `shard_size` bytes plus a shard index (see packing.ShardWriter) instead of the images/ and labels/ trees.
+    """
     folder_name = os.path.basename(image_dir)
-    print(f"Processing folder: {folder_name}")
     save_dir = folder_name.split('_')[0]
+    out = DatasetWriter(save_dir, stage_mode, pack, shard_size)
+    print(f"Processing folder: {folder_name}")
 
     os.makedirs(save_dir, exist_ok=True)
     coco80 = coco91_to_coco80_class()
-
-    # Import json
-    for json_file in sorted(Path(json_dir).resolve().glob("*.json")):
-        # print(json_file, json_file.stem)
-        # fn = Path(save_dir) / "labels" / json_file.stem.replace("instances_", "")  # folder name
-        image_fn = Path(save_dir) / "images"  # folder name
-        fn = Path(save_dir) / "labels"  # folder name
-        # print("fn: ",fn)
-        # fn.mkdir()
-        os.makedirs(image_fn, exist_ok=True)
-        os.makedirs(fn, exist_ok=True)  # make directory if not exists
-        with open(json_file) as f:
-            data = json.load(f)
-
-        image_file_name = json_file.stem+".jpg"
-        image_path = os.path.join(image_dir, image_file_name)
-        img_width, img_height = data['imageWidth'], data['imageHeight']
-        # print("image_path, img_width, img_height: ", image_path, img_width, img_height)
-        with Image.open(image_path) as img:
-            img_width, img_height = img.size
-        # print(f"Image dimensions: width={img_width}, height={img_height}")
-
-        bboxes = []
-        for shape in data['shapes']:
-            label = shape['label']
-            
-            if 'group_id' not in shape:
-                print(f"group_id not found in shape: {shape}, file: {json_file}, label: {label}")
-                continue
-
-            cls = int(shape['group_id'])
-            cls -= 1
-
-            x_coords = [point[0] for point in shape['points']]
-            y_coords = [point[1] for point in shape['points']]
-            x_min, x_max = min(x_coords), max(x_coords)
-            y_min, y_max = min(y_coords), max(y_coords)
-            # x_min, x_max = int(min(x_coords)), int(max(x_coords))
-            # y_min, y_max = int(min(y_coords)), int(max(y_coords))
-
-            box = np.array([x_min, y_min, x_max-x_min, y_max-y_min], dtype=np.float64)
-            box[:2] += box[2:] / 2  # xy top-left corner to center
-            box[[0, 2]] /= img_width  # normalize x
-            box[[1, 3]] /= img_height  # normalize y
-            
-            if box[2] <= 0 or box[3] <= 0:  # if w <= 0 and h <= 0
-                continue
-
-            box = [cls] + box.tolist()
-            # print(f"Box: {box}")
-            if box not in bboxes:
-                bboxes.append(box)
-
-            # Copy image to output/images directory
-            shutil.copy(image_path, image_fn / image_file_name)
-            # Write
-            with open((fn / image_file_name).with_suffix(".txt"), "w") as file:
-                for i in range(len(bboxes)):
-                    line = (*(bboxes[i]),)  # cls, box or segments
-                    file.write(("%g " * len(line)).rstrip() % line + "\n")
+    sizes = ImageSizeCache()
+    with out:  # packed labels and the open shard are discarded on failure
+        # Import json
+        json_dir = Path(json_dir).resolve()
+        for rec in LabelMeStore.open(json_dir, store):
+            json_file = json_dir / rec.file
+            # print(json_file, json_file.stem)
+            # fn = Path(save_dir) / "labels" / json_file.stem.replace("instances_", "")  # folder name
+            image_fn = Path(save_dir) / "images"  # folder name
+            fn = Path(save_dir) / "labels"  # folder name
+            # print("fn: ",fn)
+            # fn.mkdir()
+            os.makedirs(image_fn, exist_ok=True)
+            os.makedirs(fn, exist_ok=True)  # make directory if not exists
+            if rec.error:
+                raise ValueError(f"{json_file}: {rec.error}")
+
+            image_file_name = json_file.stem+".jpg"
+            image_path = os.path.join(image_dir, image_file_name)
+            # print("image_path, img_width, img_height: ", image_path, img_width, img_height)
+            img_width, img_height = sizes(image_path, exif=False)  # header-only probe, cached across runs
+            # print(f"Image dimensions: width={img_width}, height={img_height}")
+
+            keep = rec.group_ids >= 0
+            for label in rec.labels[~keep]:
+                print(f"group_id not found in shape, file: {json_file}, label: {label}")
+            boxes, valid = normalize_boxes(rec.xywh()[keep], img_width, img_height)
+
+            bboxes, seen = [], set()
+            for cls, box, ok in zip(rec.group_ids[keep].tolist(), boxes, valid):
+                cls -= 1
+
+                if not ok:  # if w <= 0 and h <= 0
+                    continue
+
+                box = [cls] + box.tolist()
+                # print(f"Box: {box}")
+                key = row_key(box, decimals)  # hashed duplicate check, O(1) per box
+                if key not in seen:
+                    seen.add(key)
+                    bboxes.append(box)
+
+            if bboxes:
+                # Stage image and write labels (cls, box or segments), or both into the current shard
+                out.write(image_path, image_fn / image_file_name, (fn / image_file_name).with_suffix(".txt"), bboxes)
+
+    sizes.save()
 
 
 def min_index(arr1, arr2):
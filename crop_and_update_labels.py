@@ -1,58 +1,23 @@
 #!/usr/bin/env python3
 """
-根据scale_person_bbox获取的新坐标进行图像裁剪，
+根据expand_boxes放大后的person坐标进行图像裁剪，
 同时更新标签为aqm和fgmj在新图像中的坐标位置
 """
 
 import os
 import json
 import cv2
-import numpy as np
-from PIL import Image
 from pathlib import Path
 
+from imageio_utils import (JPEG_SUBSAMPLING, ImageSizeCache, RegionReader, encode_params, jpeg_mcu, passthrough_safe,
+                           write_image)
+from utils import expand_boxes
 
-def scale_person_bbox(x_min, y_min, x_max, y_max, img_width, img_height):
-    """
-    将类别为person的边界框高度放大1.5倍，宽度放大2倍，超出图像范围的部分忽略
-    
-    Args:
-        x_min, y_min, x_max, y_max: 原始边界框坐标
-        img_width, img_height: 图像宽度和高度
-    
-    Returns:
-        新的边界框坐标 (x_min_new, y_min_new, x_max_new, y_max_new)
-    """
-    # 计算原始中心点
-    center_x = (x_min + x_max) / 2
-    center_y = (y_min + y_max) / 2
-    
-    # 计算原始宽高
-    width = x_max - x_min
-    height = y_max - y_min
-    
-    # 放大后的宽高
-    new_width = width * 2
-    new_height = height * 1.5
-    
-    # 计算新的边界框坐标
-    x_min_new = center_x - new_width / 2
-    x_max_new = center_x + new_width / 2
-    y_min_new = center_y - new_height / 2
-    y_max_new = center_y + new_height / 2
-    
-    # 确保不超出图像边界
-    x_min_new = max(0, x_min_new)
-    x_max_new = min(img_width, x_max_new)
-    y_min_new = max(0, y_min_new)
-    y_max_new = min(img_height, y_max_new)
-    
-    return x_min_new, y_min_new, x_max_new, y_max_new
 
-
-def crop_image_and_update_labels(image_path, json_path, output_dir, crop_ratio=0.1):
+def crop_image_and_update_labels(image_path, json_path, output_dir, crop_ratio=0.1, quality=None, subsampling=None, lossless=False,
+                                 read=None, sizes=None):
     """
-    根据scale_person_bbox获取的新坐标进行图像裁剪，
+    根据expand_boxes放大后的person坐标进行图像裁剪，
     同时更新标签为aqm和fgmj在新图像中的坐标位置
     
     Args:
@@ -60,17 +25,23 @@ def crop_image_and_update_labels(image_path, json_path, output_dir, crop_ratio=0
         json_path (str): 对应的JSON标注文件路径
         output_dir (str): 输出目录
         crop_ratio (float): 裁剪比例，用于扩展裁剪区域
+        quality (int): JPEG 编码质量，默认沿用 OpenCV 设置
+        subsampling (str): JPEG 色度抽样，'444'/'422'/'420'
+        lossless (bool): 裁剪起点对齐到MCU网格并用jpegtran无损裁剪，不重新编码
+        read (RegionReader): 区域解码器，只解码裁剪区域；默认新建
+        sizes (ImageSizeCache): 图像尺寸缓存，只读文件头；默认新建
     """
     
     # 创建输出目录
     os.makedirs(output_dir, exist_ok=True)
+    read = read or RegionReader()
+    sizes = sizes or ImageSizeCache()
     
-    # 读取图像
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError(f"无法读取图像: {image_path}")
-    
-    img_height, img_width = image.shape[:2]
+    # 读取图像尺寸，只解析文件头，不解码整张图像
+    try:
+        img_width, img_height = sizes(image_path)
+    except OSError as e:  # 缺失、无法识别或截断的图像
+        raise ValueError(f"无法读取图像: {image_path}") from e
     
     # 读取JSON标注文件
     with open(json_path, 'r', encoding='utf-8') as f:
@@ -103,9 +74,10 @@ def crop_image_and_update_labels(image_path, json_path, output_dir, crop_ratio=0
                 
                 # 如果是person类别，应用缩放操作
                 if label == 'person':
-                    x_min_new, y_min_new, x_max_new, y_max_new = scale_person_bbox(
-                        x_min, y_min, x_max, y_max, orig_img_width, orig_img_height
-                    )
+                    # 宽度放大2倍、高度放大1.5倍，超出图像范围的部分忽略
+                    x_min_new, y_min_new, x_max_new, y_max_new = expand_boxes(
+                        [[x_min, y_min, x_max, y_max]], orig_img_width, orig_img_height, scale=(2, 1.5)
+                    )[0]
                     person_boxes.append({
                         'original': (x_min, y_min, x_max, y_max),
                         'scaled': (x_min_new, y_min_new, x_max_new, y_max_new),
@@ -133,14 +105,26 @@ def crop_image_and_update_labels(image_path, json_path, output_dir, crop_ratio=0
         y_min_final = max(0, int(y_min_crop - expand_height))
         x_max_final = min(img_width, int(x_max_crop + expand_width))
         y_max_final = min(img_height, int(y_max_crop + expand_height))
+        if lossless and (mcu := jpeg_mcu(image_path)):
+            # 起点向左上对齐到MCU网格，才能不解码直接裁剪
+            x_min_final -= x_min_final % mcu[0]
+            y_min_final -= y_min_final % mcu[1]
         
-        # 执行裁剪
-        cropped_image = image[y_min_final:y_max_final, x_min_final:x_max_final]
-        
-        # 保存裁剪后的图像
+        crop_box = (x_min_final, y_min_final, x_max_final, y_max_final)
+        crop_width, crop_height = x_max_final - x_min_final, y_max_final - y_min_final
+
+        def decode():
+            """执行裁剪，只解码裁剪区域"""
+            cropped_image = read(image_path, crop_box)
+            if cropped_image is None:
+                raise ValueError(f"无法读取图像: {image_path}")
+            return cropped_image
+
+        # 保存裁剪后的图像，jpegtran可无损裁剪时不解码
         image_filename = Path(image_path).name
         cropped_image_path = os.path.join(output_dir, f"cropped_{image_filename}")
-        cv2.imwrite(cropped_image_path, cropped_image)
+        write_image(cropped_image_path, decode, src=image_path, box=crop_box,
+                    params=encode_params(cropped_image_path, quality, subsampling), lossless=lossless)
         
         # 更新标签文件中的坐标
         # 重新计算所有标注框在新图像中的坐标
@@ -162,8 +146,8 @@ def crop_image_and_update_labels(image_path, json_path, output_dir, crop_ratio=0
                         # 计算在新图像中的相对坐标
                         new_x_min = max(0, x_min - x_min_final)
                         new_y_min = max(0, y_min - y_min_final)
-                        new_x_max = min(cropped_image.shape[1], x_max - x_min_final)
-                        new_y_max = min(cropped_image.shape[0], y_max - y_min_final)
+                        new_x_max = min(crop_width, x_max - x_min_final)
+                        new_y_max = min(crop_height, y_max - y_min_final)
                         
                         # 更新points
                         new_points = [
@@ -196,8 +180,8 @@ def crop_image_and_update_labels(image_path, json_path, output_dir, crop_ratio=0
         data['shapes'] = updated_shapes
         
         # 更新图像尺寸为裁剪后的尺寸
-        data['imageWidth'] = cropped_image.shape[1]
-        data['imageHeight'] = cropped_image.shape[0]
+        data['imageWidth'] = crop_width
+        data['imageHeight'] = crop_height
         
         with open(updated_json_path, 'w', encoding='utf-8') as f:
             json.dump(data, f, indent=2, ensure_ascii=False)
@@ -215,9 +199,15 @@ def crop_image_and_update_labels(image_path, json_path, output_dir, crop_ratio=0
         image_filename = Path(image_path).name
         json_filename = Path(json_path).name
         
-        # 复制图像
+        # 复制图像：文件完整且无EXIF旋转时直接复用原文件字节，否则按原流程解码后重新编码
         copied_image_path = os.path.join(output_dir, f"cropped_{image_filename}")
-        cv2.imwrite(copied_image_path, image)
+        if passthrough_safe(image_path):
+            write_image(copied_image_path, None, src=image_path)
+        else:
+            image = cv2.imread(image_path)
+            if image is None:
+                raise ValueError(f"无法读取图像: {image_path}")
+            write_image(copied_image_path, image, params=encode_params(copied_image_path, quality, subsampling))
         
         # 复制JSON文件
         copied_json_path = os.path.join(output_dir, f"cropped_{json_filename}")
@@ -233,7 +223,7 @@ def crop_image_and_update_labels(image_path, json_path, output_dir, crop_ratio=0
         return copied_image_path, copied_json_path
 
 
-def batch_crop_and_update(input_image_dir, input_json_dir, output_dir, crop_ratio=0.1):
+def batch_crop_and_update(input_image_dir, input_json_dir, output_dir, crop_ratio=0.1, quality=None, subsampling=None, lossless=False):
     """
     批量处理图像和JSON文件
     
@@ -242,6 +232,7 @@ def batch_crop_and_update(input_image_dir, input_json_dir, output_dir, crop_rati
         input_json_dir (str): 输入JSON目录
         output_dir (str): 输出目录
         crop_ratio (float): 裁剪比例
+        quality, subsampling, lossless: 裁剪图的写出设置，见 crop_image_and_update_labels
     """
     # 创建输出目录
     os.makedirs(output_dir, exist_ok=True)
@@ -250,6 +241,7 @@ def batch_crop_and_update(input_image_dir, input_json_dir, output_dir, crop_rati
     json_files = [f for f in os.listdir(input_json_dir) if f.endswith('.json')]
     
     print(f"开始批量处理 {len(json_files)} 个JSON文件...")
+    read, sizes = RegionReader(), ImageSizeCache()
     
     for json_file in json_files:
         json_path = os.path.join(input_json_dir, json_file)
@@ -259,23 +251,27 @@ def batch_crop_and_update(input_image_dir, input_json_dir, output_dir, crop_rati
         if os.path.exists(image_path):
             try:
                 cropped_image_path, updated_json_path = crop_image_and_update_labels(
-                    image_path, json_path, output_dir, crop_ratio
+                    image_path, json_path, output_dir, crop_ratio, quality, subsampling, lossless, read, sizes
                 )
             except Exception as e:
                 print(f"处理文件 {json_file} 时出错: {e}")
         else:
             print(f"未找到对应的图像文件: {image_path}")
+    sizes.save()
 
 
 if __name__ == "__main__":
     # 示例用法
     import argparse
     
-    parser = argparse.ArgumentParser(description='根据scale_person_bbox获取的新坐标进行图像裁剪，同时更新标签')
+    parser = argparse.ArgumentParser(description='根据expand_boxes放大后的person坐标进行图像裁剪，同时更新标签')
     parser.add_argument('--image_dir', type=str, required=True, help='图像文件夹路径')
     parser.add_argument('--json_dir', type=str, required=True, help='JSON标注文件夹路径')
     parser.add_argument('--output_dir', type=str, required=True, help='输出文件夹路径')
     parser.add_argument('--crop_ratio', type=float, default=0.1, help='裁剪比例 (默认: 0.1)')
+    parser.add_argument('--quality', type=int, default=None, help='JPEG 编码质量 0-100')
+    parser.add_argument('--subsampling', type=str, default=None, choices=list(JPEG_SUBSAMPLING), help='JPEG 色度抽样')
+    parser.add_argument('--lossless_crop', action='store_true', help='裁剪框对齐到MCU网格并用jpegtran无损裁剪')
     
     args = parser.parse_args()
     
@@ -285,6 +281,7 @@ if __name__ == "__main__":
     print(f"输出目录: {args.output_dir}")
     print(f"裁剪比例: {args.crop_ratio}")
     
-    batch_crop_and_update(args.image_dir, args.json_dir, args.output_dir, args.crop_ratio)
+    batch_crop_and_update(args.image_dir, args.json_dir, args.output_dir, args.crop_ratio,
+                          args.quality, args.subsampling, args.lossless_crop)
     
     print("批量处理完成!")
@@ -0,0 +1,561 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import codecs
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DownloadResult = namedtuple("DownloadResult", "url path size etag sha1 error")  # error is None on success
+
+
+def pooled_session(per_host=8, pool_hosts=16):
+    """
+    Returns a requests.Session whose keep-alive connections are reused across requests.
+
+    Each host gets at most `per_host` open connections: with `pool_block=True` a request waits for a free connection
+    instead of opening an extra one, and connections to up to `pool_hosts` hosts are kept open.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=per_host, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` tokens per second on average and bursts of up to `burst` tokens.
+
+    take(n) may overdraw the bucket, e.g. for a chunk larger than the burst, and then sleeps until the debt is paid, so
+    the long-run rate holds for any request size. A falsy `rate` disables limiting.
+    """
+
+    def __init__(self, rate, burst=None):
+        """Creates a full bucket."""
+        self.rate, self.burst = rate, burst or rate
+        self.tokens, self.t = self.burst, time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n=1):
+        """Takes `n` tokens, sleeping as long as the bucket is in debt."""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate) - n
+            self.t = now
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+RETRY_STATUS = {429, 500, 502, 503, 504}  # throttled or server-side failures, worth retrying
+RETRY_ERRORS = (  # transient transport failures: refused or reset connections, timeouts, streams cut mid-body
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class Transport:
+    """
+    HTTP transport for the device image harvester: timeouts, retries with jittered exponential backoff, rate limits and
+    metrics, over one pooled session.
+
+    Every attempt has (connect, read) `timeout`s, so a hung socket fails instead of stalling the job. Connection
+    errors, timeouts, broken streams and RETRY_STATUS responses are retried up to `retries` times after a "full jitter"
+    sleep of uniform(0, min(max_backoff, backoff * 2**attempt)) seconds, or the server's Retry-After if longer. Two
+    token buckets shape traffic for all threads: `rps` requests per second and `bandwidth` bytes per second of bodies
+    read through iter_content(). Usage:
+
+        with Transport(rps=20, bandwidth=8 << 20) as transport:
+            r = transport.get(url, params=payload)
+            transport.report()
+    """
+
+    def __init__(self, timeout=(5, 30), retries=5, backoff=0.5, max_backoff=30, rps=None, bandwidth=None, session=None):
+        """Creates the transport over `session` (default a pooled session)."""
+        self.timeout, self.retries, self.backoff, self.max_backoff = timeout, retries, backoff, max_backoff
+        self.session = session or pooled_session()
+        self.requests, self.bytes = TokenBucket(rps), TokenBucket(bandwidth)
+        self.lock = threading.Lock()
+        self.metrics = {"requests": 0, "retries": 0, "failures": 0, "bytes": 0}
+        self.t0 = time.monotonic()
+
+    def count(self, key, n=1):
+        """Adds `n` to metric `key`."""
+        with self.lock:
+            self.metrics[key] += n
+
+    def retryable(self, e):
+        """Returns True if exception `e` is transient: a connection error, timeout, broken stream or RETRY_STATUS."""
+        if isinstance(e, requests.exceptions.HTTPError):
+            return e.response is not None and e.response.status_code in RETRY_STATUS
+        return isinstance(e, RETRY_ERRORS)
+
+    def delay(self, attempt, e):
+        """Returns the jittered backoff before retry `attempt`, at least the Retry-After of a throttled response."""
+        d = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        retry_after = getattr(getattr(e, "response", None), "headers", {}).get("Retry-After", "")
+        return max(d, min(float(retry_after), self.max_backoff)) if retry_after.isdigit() else d
+
+    def call(self, fn, *args):
+        """Returns fn(*args), retrying transient failures with backoff; the last error is raised."""
+        for attempt in range(self.retries + 1):
+            try:
+                return fn(*args)
+            except requests.exceptions.RequestException as e:
+                if attempt == self.retries or not self.retryable(e):
+                    self.count("failures")
+                    raise
+                self.count("retries")
+                time.sleep(self.delay(attempt, e))
+
+    def request(self, method, url, **kwargs):
+        """Sends one rate-limited request with the transport timeout, raising HTTPError on a RETRY_STATUS response."""
+        self.requests.take()
+        self.count("requests")
+        r = self.session.request(method, url, timeout=kwargs.pop("timeout", self.timeout), **kwargs)
+        if r.status_code in RETRY_STATUS:
+            r.close()
+            raise requests.exceptions.HTTPError(f"{r.status_code} Server Error for url: {r.url}", response=r)
+        return r
+
+    def get(self, url, **kwargs):
+        """GETs `url` with retries; other error statuses are returned for the caller's raise_for_status()."""
+        return self.call(lambda: self.request("GET", url, **kwargs))
+
+    def iter_content(self, response, chunk_size=1 << 16):
+        """Yields the body of a streamed `response` in chunks, within the bandwidth limit and counted in metrics."""
+        for chunk in response.iter_content(chunk_size):
+            self.bytes.take(len(chunk))
+            self.count("bytes", len(chunk))
+            yield chunk
+
+    def report(self):
+        """Prints requests, retries, failures and throughput since the transport was created."""
+        m, t = dict(self.metrics), time.monotonic() - self.t0
+        print(
+            f"Transport: {m['requests']} requests ({m['requests'] / t:.1f}/s), {m['retries']} retries, "
+            f"{m['failures']} failures, {m['bytes'] / 1e6:.1f} MB ({m['bytes'] / 1e6 / t:.2f} MB/s) in {t:.1f}s"
+        )
+
+    def close(self):
+        """Closes the pooled connections."""
+        self.session.close()
+
+    def __enter__(self):
+        """Returns the transport for use as a context manager that closes it on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Closes the transport."""
+        self.close()
+
+
+class Downloader:
+    """
+    Concurrent file downloader over one pooled Transport, streaming each response to disk.
+
+    Up to `workers` downloads run at once on a thread pool, and at most `per_host` of them hold a connection to the
+    same host. Responses are written in `chunk_size` pieces to a temporary `.part` file that is renamed when complete,
+    so an interrupted download never leaves a truncated image behind. Each download is retried as a whole by the
+    transport, which also applies its timeouts, rate limits and metrics. Usage:
+
+        with Downloader(workers=16) as dl:
+            for r in dl.map([(url, path), ...]):
+                print(r.url, r.size if r.error is None else r.error)
+    """
+
+    def __init__(self, workers=16, per_host=8, chunk_size=1 << 16, transport=None, ledger=None):
+        """
+        Creates the thread pool over `transport`, by default a Transport keeping `per_host` connections per host.
+
+        With a DownloadLedger `ledger`, map() skips URLs already downloaded to their path and records every result.
+        """
+        self.workers, self.per_host, self.chunk_size, self.ledger = workers, per_host, chunk_size, ledger
+        self.own_transport = transport is None
+        self.transport = transport or Transport(session=pooled_session(per_host, pool_hosts=max(16, workers)))
+        self.session = self.transport.session
+        self.hosts = {}  # host -> BoundedSemaphore capping its concurrent downloads
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+
+    def host_slot(self, url):
+        """Returns the semaphore limiting concurrent downloads from the host of `url`."""
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self.hosts[host]
+
+    def download(self, url, path):
+        """Streams `url` to `path` and returns its DownloadResult; errors are returned, not raised."""
+        tmp = f"{path}.part"
+        try:
+            with self.host_slot(url):
+                size, etag, sha1 = self.transport.call(self.fetch, url, tmp)
+            os.replace(tmp, path)
+            return DownloadResult(url, path, size, etag, sha1, None)
+        except (requests.exceptions.RequestException, OSError) as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return DownloadResult(url, path, None, None, None, e)
+
+    def fetch(self, url, tmp):
+        """Makes one attempt to stream `url` into `tmp` and returns its size, ETag and SHA-1."""
+        with self.transport.request("GET", url, stream=True) as r:
+            r.raise_for_status()
+            size, h = 0, hashlib.sha1()
+            with open(tmp, "wb") as f:
+                for chunk in self.transport.iter_content(r, self.chunk_size):
+                    f.write(chunk)
+                    h.update(chunk)
+                    size += len(chunk)
+            return size, r.headers.get("ETag"), h.hexdigest()
+
+    def map(self, items):
+        """Downloads (url, path) `items` concurrently and yields their DownloadResults in completion order."""
+        if self.ledger:
+            items = self.ledger.pending(items)  # completed files are skipped, failed and missing ones retried
+        pending = set()
+        for url, path in items:
+            pending.add(self.pool.submit(self.download, url, path))
+            if len(pending) >= 2 * self.workers:  # bounded queue, `items` may be a long generator
+                done = next(as_completed(pending))
+                pending.remove(done)
+                yield self.record(done.result())
+        for done in as_completed(pending):
+            yield self.record(done.result())
+
+    def record(self, result):
+        """Records `result` in the ledger, if any, and returns it."""
+        if self.ledger:
+            self.ledger.record(result)
+        return result
+
+    def close(self):
+        """Waits for running downloads and closes the pooled connections of its own transport."""
+        self.pool.shutdown(wait=True)
+        if self.own_transport:
+            self.transport.close()
+
+    def __enter__(self):
+        """Returns the downloader for use as a context manager that closes it on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Closes the downloader."""
+        self.close()
+
+
+class DownloadLedger:
+    """
+    Persistent SQLite ledger of downloads: URL -> local path, size, ETag, SHA-1, status and last error.
+
+    Every result is committed as it arrives, so after a crash or on the next scheduled run only URLs whose download
+    failed, never finished, or whose file is missing or has a different size are fetched again. Usage:
+
+        with DownloadLedger("downloads.sqlite") as ledger, Downloader(ledger=ledger) as dl:
+            list(dl.map(items))
+    """
+
+    def __init__(self, file="downloads.sqlite"):
+        """Opens or creates the ledger database `file`."""
+        self.file = file
+        self.db = sqlite3.connect(file, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")  # cheap per-result commits, readable while written
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS downloads (url TEXT PRIMARY KEY, path TEXT, size INTEGER, etag TEXT, "
+            "sha1 TEXT, status TEXT, error TEXT, updated REAL)"
+        )
+        self.lock = threading.Lock()
+        self.counts = {"skipped": 0, "done": 0, "failed": 0}  # this session
+
+    def done(self, url, path):
+        """Returns True if `url` was downloaded to `path` and the file is still there with its recorded size."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT path, size FROM downloads WHERE url = ? AND status = 'done'", (url,)
+            ).fetchone()
+        path = os.path.abspath(path)
+        return row is not None and row[0] == path and os.path.isfile(path) and os.path.getsize(path) == row[1]
+
+    def pending(self, items):
+        """Yields the (url, path) `items` that still need downloading and counts the others as skipped."""
+        for url, path in items:
+            if self.done(url, path):
+                with self.lock:
+                    self.counts["skipped"] += 1
+            else:
+                yield url, path
+
+    def record(self, result):
+        """Stores a DownloadResult as 'done' or 'failed'."""
+        status = "done" if result.error is None else "failed"
+        error = None if result.error is None else f"{type(result.error).__name__}: {result.error}"
+        with self.lock, self.db:
+            row = (result.url, os.path.abspath(result.path), result.size, result.etag, result.sha1, status, error)
+            self.db.execute("INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (*row, time.time()))
+            self.counts[status] += 1
+
+    def report(self):
+        """Prints this session's skipped, downloaded and failed counts and the ledger totals by status."""
+        with self.lock:
+            totals = dict(self.db.execute("SELECT status, COUNT(*) FROM downloads GROUP BY status").fetchall())
+        n = self.counts
+        print(
+            f"Downloads: {n['done']} done, {n['skipped']} skipped, {n['failed']} failed; ledger {self.file}: {totals}"
+        )
+
+    def close(self):
+        """Closes the database."""
+        self.db.close()
+
+    def __enter__(self):
+        """Returns the ledger for use as a context manager that closes it on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Closes the ledger."""
+        self.close()
+
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+def iter_json_list(chunks, key="data"):
+    """
+    Yields the items of the list at `key` of a top-level JSON object, parsing the byte `chunks` incrementally.
+
+    Only the item being parsed and the current chunk are held in memory, so items of a multi-MB response are available
+    as soon as they arrived. Other top-level values are parsed and dropped. Raises ValueError on malformed or truncated
+    JSON.
+    """
+    decoder, text, chunks = json.JSONDecoder(), codecs.getincrementaldecoder("utf-8")(), iter(chunks)
+    buf, pos, eof = "", 0, False
+
+    def more():
+        """Appends the next chunk to the unparsed rest of the buffer, returns False at the end of the body."""
+        nonlocal buf, pos, eof
+        chunk = next(chunks, None)
+        eof = chunk is None
+        buf, pos = buf[pos:] + text.decode(chunk or b"", final=eof), 0
+        return not eof
+
+    def token():
+        """Skips whitespace and returns the next character."""
+        nonlocal pos
+        while True:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            if not more():
+                raise ValueError("truncated JSON")
+
+    def value():
+        """Parses the complete JSON value at the next character, reading more chunks until it has arrived."""
+        nonlocal pos
+        token()
+        while True:
+            try:
+                v, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or buf[end - 1] in ']}"' or eof:  # a number at the end may continue in the next chunk
+                    pos = end
+                    return v
+            except ValueError:
+                if eof:
+                    raise
+            more()
+
+    if token() != "{":
+        raise ValueError("expected a JSON object")
+    pos += 1
+    while token() != "}":
+        if buf[pos] == ",":
+            pos += 1
+            continue
+        k = value()
+        if token() != ":":
+            raise ValueError(f"expected ':' after key {k!r}")
+        pos += 1
+        if k != key or token() != "[":
+            value()
+            continue
+        pos += 1
+        while token() != "]":
+            if buf[pos] == ",":
+                pos += 1
+                continue
+            yield value()
+        pos += 1
+
+
+class WindowTooLarge(Exception):
+    """Raised by ResourceStream.body() once a window's response has streamed more than its byte limit."""
+
+
+class ResourceStream:
+    """
+    Iterates the items of a time-windowed JSON resource query such as getResourceAll while its response streams in.
+
+    Items are parsed as they arrive (see iter_json_list), so image downloads fed from the stream start before the
+    metadata has fully arrived. A window whose response announces or actually streams more than `split_bytes`, e.g. a
+    chunked or compressed response without Content-Length, is split in half, down to `min_span` seconds, and the halves
+    are queried in order. A failed request or a body cut off mid-stream is retried with the transport's backoff policy.
+    Items are yielded only once: duplicates are looked up among the items of the current window, of the windows it was
+    split from and of the previous window, whose items may repeat on the shared boundary, so memory is bounded by the
+    window size rather than the item count. Iteration stops early on a failed query, which is kept in `error`. Usage:
+
+        stream = ResourceStream(transport, url, {"deviceName": name, "start_time": t0, "end_time": t1})
+        items = ((item["pic"], path) for item in stream)
+    """
+
+    def __init__(self, transport, url, params, headers=None, key="data", split_bytes=4 << 20, min_span=60):
+        """Creates the stream for the `params` window, whose 'start_time' and 'end_time' are epoch seconds."""
+        self.transport, self.url, self.params, self.headers, self.key = transport, url, params, headers, key
+        self.split_bytes, self.min_span = split_bytes, min_span
+        self.count, self.windows, self.error = 0, 0, None
+
+    def __iter__(self):
+        """Yields the items of all sub-windows in time order."""
+        stack = [(int(self.params["start_time"]), int(self.params["end_time"]), frozenset())]
+        last = frozenset()  # hashes of the items of the previous window
+        try:
+            while stack:
+                start, end, skip = stack.pop()
+                done = yield from self.query(start, end, skip | last, stack)
+                if done is not None:
+                    last = done
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.error = e
+            print(f"Failed to fetch {self.url} {self.params}: {e}")
+
+    def query(self, start, end, skip, stack):
+        """
+        Yields the items of one window whose hashes are not in `skip`, and returns the hashes of all its items.
+
+        If the response is too large, returns None after pushing the two halves onto `stack`, with the hashes of the
+        items yielded so far added to their `skip`.
+        """
+        params = {**self.params, "start_time": str(start), "end_time": str(end)}
+        limit = self.split_bytes if end - start > self.min_span else None
+        done = set()  # hashes of the items of this window, kept across retries
+        for attempt in range(self.transport.retries + 1):
+            try:
+                with self.open(params) as r:
+                    if limit is not None and int(r.headers.get("Content-Length", 0)) > limit:
+                        break
+                    for item in iter_json_list(self.body(r, limit), self.key):
+                        h = hash(json.dumps(item, sort_keys=True))
+                        if h not in done and h not in skip:
+                            self.count += 1
+                            yield item
+                        done.add(h)
+                self.windows += 1
+                return done
+            except WindowTooLarge:
+                break
+            except requests.exceptions.RequestException as e:  # failed request or body cut off mid-stream
+                if attempt == self.transport.retries or not self.transport.retryable(e):
+                    self.transport.count("failures")
+                    raise
+                self.transport.count("retries")
+                time.sleep(self.transport.delay(attempt, e))
+        mid = (start + end) // 2
+        skip = skip | done
+        stack += [(mid, end, skip), (start, mid, skip)]  # earlier half first
+        return None
+
+    def body(self, r, limit=None):
+        """Yields the body chunks of response `r`, raising WindowTooLarge once more than `limit` bytes have streamed."""
+        n = 0
+        for chunk in self.transport.iter_content(r):
+            n += len(chunk)
+            if limit is not None and n > limit:
+                raise WindowTooLarge(f"response of more than {limit} bytes")
+            yield chunk
+
+    def open(self, params):
+        """Sends the query for `params` and returns the streamed response."""
+        r = self.transport.request("GET", self.url, params=params, headers=self.headers, stream=True)
+        if not r.ok:
+            r.close()
+            r.raise_for_status()
+        return r
+
+
+Window = namedtuple("Window", "device day start end")  # day 'YYYYMMDD', start/end 'YYYY-MM-DDT00:00:00Z'
+COMPLETE_MARKER = ".complete"  # written into a day folder once all its windows are downloaded
+
+
+def is_complete(folder):
+    """Returns True if the day `folder` carries the completion marker."""
+    return os.path.isfile(os.path.join(folder, COMPLETE_MARKER))
+
+
+def mark_complete(folder, info=None):
+    """Atomically marks the day `folder` complete: the marker, with `info` as JSON, is renamed in when fully written."""
+    tmp = os.path.join(folder, f"{COMPLETE_MARKER}.{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(info or {}, f)
+    os.replace(tmp, os.path.join(folder, COMPLETE_MARKER))
+
+
+def day_folders(root="."):
+    """Returns the sorted YYYYMMDD day folder names in `root` that are valid dates."""
+    days = []
+    for name in os.listdir(root):
+        if re.fullmatch(r"\d{8}", name) and os.path.isdir(os.path.join(root, name)):
+            try:
+                days.append((datetime.strptime(name, "%Y%m%d"), name))
+            except ValueError:
+                continue
+    return [name for _, name in sorted(days)]
+
+
+def plan_catchup(devices, root=".", start=None, today=None):
+    """
+    Returns the (device, day) Windows still to download, ordered by day and then device.
+
+    Days run from `start` ('YYYY-MM-DD' or 'YYYYMMDD') up to yesterday, as today is not over yet. By default `start` is
+    the oldest incomplete day folder after the first complete one, so failed days are retried, else the day after the
+    newest complete day folder in `root`. Without any complete folder it is the newest day folder, which is fetched
+    again, and for an empty `root` it is yesterday. Days already marked complete are skipped.
+    """
+    today = (today or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    days = day_folders(root)
+    complete = {d for d in days if is_complete(os.path.join(root, d))}
+    if start:
+        day = datetime.strptime(start.replace("-", ""), "%Y%m%d")
+    elif complete:
+        retry = [d for d in days if d > min(complete) and d not in complete]  # failed or interrupted days
+        if retry:
+            day = datetime.strptime(retry[0], "%Y%m%d")
+        else:
+            day = datetime.strptime(max(complete), "%Y%m%d") + timedelta(days=1)
+    elif days:
+        day = datetime.strptime(days[-1], "%Y%m%d")
+    else:
+        day = today - timedelta(days=1)
+
+    windows = []
+    while day < today:
+        name, next_day = day.strftime("%Y%m%d"), day + timedelta(days=1)
+        if name not in complete:
+            start_time, end_time = day.strftime("%Y-%m-%dT00:00:00Z"), next_day.strftime("%Y-%m-%dT00:00:00Z")
+            windows += [Window(device, name, start_time, end_time) for device in devices]
+        day = next_day
+    return windows
@@ -0,0 +1,20 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import argparse
+
+from packing import PackedLabels
+
+
+def main():
+    """Exports a packed label file (labels.bin + labels.idx.npz) back to one YOLO .txt label file per image."""
+    parser = argparse.ArgumentParser(description="Export packed YOLO labels back to per-image .txt files")
+    parser.add_argument("pack", type=str, help="packed label file, e.g. new_dir/labels.bin")
+    parser.add_argument("out_dir", type=str, help="directory the .txt label files are written to")
+    args = parser.parse_args()
+
+    n = PackedLabels(args.pack).export(args.out_dir)
+    print(f"Exported {n} label files to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,26 @@
 
 import contextlib
 import json
+import tempfile
 from collections import defaultdict
+from multiprocessing import Pool
 
 import cv2
 import pandas as pd
-from PIL import Image
 
 from utils import *
 
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # scipy is optional, min_index falls back to blocked all-pairs search
+    cKDTree = None
+
 
 # Convert INFOLKS JSON file into YOLO-format labels ----------------------------
 def convert_infolks_json(name, files, img_path):
     """Converts INFOLKS JSON annotations to YOLO-format labels."""
     path = make_dirs()
+    sizes = ImageSizeCache()
 
     # Import json
     data = []
@@ -26,11 +33,14 @@ def convert_infolks_json(name, files, img_path):
 
     # Write images and shapes
     name = path + os.sep + name
+    index = ImageIndex()
+    data = [x for x in data if index.find(img_path, stem=Path(x["json_file"]).stem)]  # drop JSONs without images
+    index.report(name + "_missing.txt")
     _file_id, file_name, wh, cat = [], [], [], []
     for x in tqdm(data, desc="Files and Shapes"):
-        f = glob.glob(img_path + Path(x["json_file"]).stem + ".*")[0]
+        f = index.find(img_path, stem=Path(x["json_file"]).stem)
         file_name.append(f)
-        wh.append(exif_size(Image.open(f)))  # (width, height)
+        wh.append(sizes(f))  # (width, height)
         cat.extend(a["classTitle"].lower() for a in x["output"]["objects"])  # categories
 
         # filename
@@ -47,24 +57,23 @@ def convert_infolks_json(name, files, img_path):
     for i, x in enumerate(tqdm(data, desc="Annotations")):
         label_name = Path(file_name[i]).stem + ".txt"
 
-        with open(path + "/labels/" + label_name, "a") as file:
-            for a in x["output"]["objects"]:
+        # The INFOLKS bounding box format is [x-min, y-min, x-max, y-max]
+        objects = x["output"]["objects"]
+        boxes = [a["points"]["exterior"] for a in objects]
+        boxes, valid = normalize_boxes(boxes, *wh[i], fmt="xyxy", dtype=np.float32)
+        with LabelSink(path + "/labels/" + label_name, fmt="%g %.6f %.6f %.6f %.6f", mode="a") as sink:
+            for a, box, ok in zip(objects, boxes, valid):
                 # if a['classTitle'] == 'Missing product':
                 #    continue  # skip
 
                 category_id = names.index(a["classTitle"].lower())
-
-                # The INFOLKS bounding box format is [x-min, y-min, x-max, y-max]
-                box = np.array(a["points"]["exterior"], dtype=np.float32).ravel()
-                box[[0, 2]] /= wh[i][0]  # normalize x by width
-                box[[1, 3]] /= wh[i][1]  # normalize y by height
-                box = [box[[0, 2]].mean(), box[[1, 3]].mean(), box[2] - box[0], box[3] - box[1]]  # xywh
-                if (box[2] > 0.0) and (box[3] > 0.0):  # if w > 0 and h > 0
-                    file.write("{:g} {:.6f} {:.6f} {:.6f} {:.6f}\n".format(category_id, *box))
+                if ok:  # if w > 0 and h > 0
+                    sink.add(category_id, box)
 
     # Split data into train, test, and validate files
     split_files(name, file_name)
     write_data_data(name + ".data", nc=len(names))
+    sizes.save()
     print(f"Done. Output saved to {os.getcwd() + os.sep + path}")
 
 
@@ -73,6 +82,7 @@ def convert_vott_json(name, files, img_path):
     """Converts VoTT JSON files to YOLO-format labels and organizes dataset structure."""
     path = make_dirs()
     name = path + os.sep + name
+    sizes = ImageSizeCache()
 
     # Import json
     data = []
@@ -95,13 +105,12 @@ def convert_vott_json(name, files, img_path):
 
     # Write labels file
     n1, n2 = 0, 0
-    missing_images = []
+    index = ImageIndex()
     for i, x in enumerate(tqdm(data, desc="Annotations")):
-        f = glob.glob(img_path + x["asset"]["name"] + ".jpg")
-        if len(f):
-            f = f[0]
+        f = index.find(img_path, name=x["asset"]["name"] + ".jpg")
+        if f:
             file_name.append(f)
-            wh = exif_size(Image.open(f))  # (width, height)
+            wh = sizes(f)  # (width, height)
 
             n1 += 1
             if (len(f) > 0) and (wh[0] > 0) and (wh[1] > 0):
@@ -113,35 +122,35 @@ def convert_vott_json(name, files, img_path):
 
                 # write labelsfile
                 label_name = Path(f).stem + ".txt"
-                with open(path + "/labels/" + label_name, "a") as file:
-                    for a in x["regions"]:
+                # The VoTT bounding box format is [x-min, y-min, width, height]
+                boxes = [[a["boundingBox"][k] for k in ("left", "top", "width", "height")] for a in x["regions"]]
+                boxes, valid = normalize_boxes(boxes, *wh, fmt="xywh")
+                with LabelSink(path + "/labels/" + label_name, fmt="%g %.6f %.6f %.6f %.6f", mode="a") as sink:
+                    for a, box, ok in zip(x["regions"], boxes, valid):
                         category_id = names.index(a["tags"][0])
 
-                        # The INFOLKS bounding box format is [x-min, y-min, x-max, y-max]
-                        box = a["boundingBox"]
-                        box = np.array([box["left"], box["top"], box["width"], box["height"]]).ravel()
-                        box[[0, 2]] /= wh[0]  # normalize x by width
-                        box[[1, 3]] /= wh[1]  # normalize y by height
-                        box = [box[0] + box[2] / 2, box[1] + box[3] / 2, box[2], box[3]]  # xywh
-
-                        if (box[2] > 0.0) and (box[3] > 0.0):  # if w > 0 and h > 0
-                            file.write("{:g} {:.6f} {:.6f} {:.6f} {:.6f}\n".format(category_id, *box))
-        else:
-            missing_images.append(x["asset"]["name"])
+                        if ok:  # if w > 0 and h > 0
+                            sink.add(category_id, box)
 
     print(f"Attempted {i:g} json imports, found {n1:g} images, imported {n2:g} annotations successfully")
-    if len(missing_images):
-        print("WARNING, missing images:", missing_images)
+    index.report(name + "_missing.txt")
 
     # Split data into train, test, and validate files
     split_files(name, file_name)
+    sizes.save()
     print(f"Done. Output saved to {os.getcwd() + os.sep + path}")
 
 
 # Convert ath JSON file into YOLO-format labels --------------------------------
-def convert_ath_json(json_dir):  # dir contains json annotations and images
-    """Converts ath JSON annotations to YOLO-format labels, resizes images, and organizes data for training."""
+def convert_ath_json(json_dir, quality=None):  # dir contains json annotations and images
+    """
+    Converts ath JSON annotations to YOLO-format labels, resizes images, and organizes data for training.
+
+    Intact, upright JPEG/PNG images that need no resizing are passed through byte for byte (see
+    imageio_utils.passthrough_safe); all others are decoded as before and encoded with JPEG `quality`.
+    """
     dir = make_dirs()  # output directory
+    sizes = ImageSizeCache()
 
     jsons = []
     for dirpath, dirnames, filenames in os.walk(json_dir):
@@ -151,7 +160,7 @@ def convert_ath_json(json_dir):  # dir contains json annotations and images
 
     # Import json
     n1, n2, n3 = 0, 0, 0
-    missing_images, file_name = [], []
+    index, file_name = ImageIndex(), []
     for json_file in sorted(jsons):
         with open(json_file) as f:
             data = json.load(f)
@@ -169,79 +178,63 @@ def convert_ath_json(json_dir):  # dir contains json annotations and images
 
         # Write labels file
         for x in tqdm(data["_via_img_metadata"].values(), desc=f"Processing {json_file}"):
-            image_file = str(Path(json_file).parent / x["filename"])
-            f = glob.glob(image_file)  # image file
-            if len(f):
-                f = f[0]
+            f = index.find(str(Path(json_file).parent), name=x["filename"])  # image file
+            if f:
                 file_name.append(f)
-                wh = exif_size(Image.open(f))  # (width, height)
+                wh = sizes(f)  # (width, height)
 
                 n1 += 1  # all images
                 if len(f) > 0 and wh[0] > 0 and wh[1] > 0:
                     label_file = dir + "labels/" + Path(f).stem + ".txt"
 
-                    nlabels = 0
                     try:
-                        with open(label_file, "a") as file:  # write labelsfile
-                            # try:
-                            #     category_id = int(a['region_attributes']['class'])
-                            # except:
-                            #     category_id = int(a['region_attributes']['Class'])
-                            category_id = 0  # single-class
-
-                            for a in x["regions"]:
-                                # bounding box format is [x-min, y-min, x-max, y-max]
-                                box = a["shape_attributes"]
-                                box = np.array(
-                                    [box["x"], box["y"], box["width"], box["height"]], dtype=np.float32
-                                ).ravel()
-                                box[[0, 2]] /= wh[0]  # normalize x by width
-                                box[[1, 3]] /= wh[1]  # normalize y by height
-                                box = [
-                                    box[0] + box[2] / 2,
-                                    box[1] + box[3] / 2,
-                                    box[2],
-                                    box[3],
-                                ]  # xywh (left-top to center x-y)
-
-                                if box[2] > 0.0 and box[3] > 0.0:  # if w > 0 and h > 0
-                                    file.write("{:g} {:.6f} {:.6f} {:.6f} {:.6f}\n".format(category_id, *box))
-                                    n3 += 1
-                                    nlabels += 1
-
-                        if nlabels == 0:  # remove non-labelled images from dataset
-                            os.system(f"rm {label_file}")
+                        # try:
+                        #     category_id = int(a['region_attributes']['class'])
+                        # except:
+                        #     category_id = int(a['region_attributes']['Class'])
+                        category_id = 0  # single-class
+
+                        # bounding box format is [x-min, y-min, width, height]
+                        boxes = [
+                            [a["shape_attributes"][k] for k in ("x", "y", "width", "height")] for a in x["regions"]
+                        ]
+                        boxes, valid = normalize_boxes(boxes, *wh, fmt="xywh", dtype=np.float32)
+                        if not valid.any():  # skip non-labelled images
                             # print('no labels for %s' % f)
                             continue  # next file
 
+                        sink = LabelSink(label_file, fmt="%g %.6f %.6f %.6f %.6f", mode="a")  # write labelsfile
+                        for box in boxes[valid]:  # if w > 0 and h > 0
+                            sink.add(category_id, box)
+                        sink.write()
+                        n3 += int(valid.sum())
+
                         # write image
                         img_size = 4096  # resize to maximum
-                        img = cv2.imread(f)  # BGR
-                        assert img is not None, "Image Not Found " + f
-                        r = img_size / max(img.shape)  # size ratio
-                        if r < 1:  # downsize if necessary
-                            h, w, _ = img.shape
-                            img = cv2.resize(img, (int(w * r), int(h * r)), interpolation=cv2.INTER_AREA)
-
                         ifile = dir + "images/" + Path(f).name
-                        if cv2.imwrite(ifile, img):  # if success append image to list
-                            with open(dir + "data.txt", "a") as file:
-                                file.write(f"{ifile}\n")
-                            n2 += 1  # correct images
+                        r = img_size / max(wh)  # size ratio
+                        if r >= 1 and passthrough_safe(f):  # pixels unchanged, reuse the source bytes
+                            write_image(ifile, None, src=f)
+                        else:  # decode: rejects unreadable images and applies EXIF rotation like before
+                            img = cv2.imread(f)  # BGR
+                            assert img is not None, "Image Not Found " + f
+                            if r < 1:  # downsize if necessary
+                                h, w, _ = img.shape
+                                img = cv2.resize(img, (int(w * r), int(h * r)), interpolation=cv2.INTER_AREA)
+                            write_image(ifile, img, params=encode_params(ifile, quality))
+                        with open(dir + "data.txt", "a") as file:  # written, append image to list
+                            file.write(f"{ifile}\n")
+                        n2 += 1  # correct images
 
                     except Exception:
                         os.system(f"rm {label_file}")
                         print(f"problem with {f}")
 
-            else:
-                missing_images.append(image_file)
-
-    nm = len(missing_images)  # number missing
+    nm = len(index.missing)  # number missing
     print(
         f"\nFound {len(jsons):g} JSONs with {n3:g} labels over {n1:g} images. Found {n1 - nm:g} images, labelled {n2:g} images successfully"
     )
-    if len(missing_images):
-        print("WARNING, missing images:", missing_images)
+    index.report(dir + "missing.txt")
 
     # Write *.names file
     names = ["knife"]  # preserves sort order
@@ -251,82 +244,273 @@ def convert_ath_json(json_dir):  # dir contains json annotations and images
     # Split data into train, test, and validate files
     split_rows_simple(dir + "data.txt")
     write_data_data(dir + "data.data", nc=1)
+    sizes.save()
     print(f"Done. Output saved to {Path(dir).absolute()}")
 
 
-def convert_coco_json(json_dir="../coco/annotations/", use_segments=False, cls91to80=False):
-    """Converts COCO JSON format to YOLO label format, with options for segments and class mapping."""
-    save_dir = make_dirs()  # output directory
+def coco_image_labels(anns, w, h, use_segments=False, cls91to80=False, coco80=None, decimals=None):
+    """
+    Returns the YOLO label rows (cls, box or segments) of one image's COCO annotations, for image size `w` x `h`.
+
+    Duplicate boxes and segments are dropped in first-seen order; with `decimals` set, rows that agree after rounding to
+    that many places count as duplicates.
+    """
+    coco80 = coco80 or coco91_to_coco80_class()
+    anns = [ann for ann in anns if not ann["iscrowd"]]
+    # The COCO box format is [top left x, top left y, width, height]
+    boxes, valid = normalize_boxes([ann["bbox"] for ann in anns], w, h, fmt="xywh")
+
+    bboxes = []
+    segments = []
+    for ann, box, ok in zip(anns, boxes, valid):
+        if not ok:  # if w <= 0 and h <= 0
+            continue
+
+        cls = coco80[ann["category_id"] - 1] if cls91to80 else ann["category_id"] - 1  # class
+        bboxes.append([cls] + box.tolist())
+        # Segments
+        if use_segments:
+            if len(ann["segmentation"]) > 1:
+                s = merge_multi_segment(ann["segmentation"])
+                s = (np.concatenate(s, axis=0) / np.array([w, h])).reshape(-1).tolist()
+            else:
+                s = [j for i in ann["segmentation"] for j in i]  # all segments concatenated
+                s = (np.array(s).reshape(-1, 2) / np.array([w, h])).reshape(-1).tolist()
+            segments.append([cls] + s)
+
+    bboxes, segments = unique_rows(bboxes, decimals), unique_rows(segments, decimals)
+    return [segments[i] if use_segments else bboxes[i] for i in range(len(bboxes))]  # cls, box or segments
+
+
+def stream_coco_annotations(json_file, tmp_dir, use_segments=False, nbuckets=256):
+    """
+    Streams a COCO JSON file once, spilling its images and annotations into on-disk buckets by label file name.
+
+    Records are first spilled by image id, as an annotation may precede its image in the file, then regrouped one id
+    bucket at a time into `nbuckets` JSON-lines files of (first annotation index, file_name, width, height, anns)
+    lines. Images appending to the same label file (e.g. a.jpg and a.png) always land in the same bucket, so a bucket
+    can be converted on its own, in parallel with the others, without any in-memory index of the whole file.
+
+    Returns:
+        (list): paths of the non-empty bucket files.
+        (int): number of annotated images, the label files the buckets will write.
+    """
+    keep = ("image_id", "iscrowd", "bbox", "category_id") + (("segmentation",) if use_segments else ())
+    ids = [Path(tmp_dir) / f"id{i}.jsonl" for i in range(nbuckets)]
+    paths = [Path(tmp_dir) / f"{i}.jsonl" for i in range(nbuckets)]
+    n = 0
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(open(p, "w", encoding="utf-8")) for p in ids]
+        for key, x in iter_json_arrays(json_file, {"images", "annotations"}):
+            if key == "images":
+                i, record = x["id"], ["i", x["id"], x["width"], x["height"], x["file_name"]]
+            else:
+                i, record = x["image_id"], ["a", n, {k: x[k] for k in keep if k in x}]
+                n += 1
+            files[hash(i) % nbuckets].write(json.dumps(record, separators=(",", ":")) + "\n")
+    n = 0
+    with contextlib.ExitStack() as stack:
+        files = [stack.enter_context(open(p, "w", encoding="utf-8")) for p in paths]
+        for p in ids:
+            images, imgToAnns = read_coco_bucket(p)
+            p.unlink()
+            for img_id, (first, anns) in imgToAnns.items():
+                w, h, f = images[img_id]
+                record = [first, f, w, h, anns]
+                files[hash(Path(f).stem) % nbuckets].write(json.dumps(record, separators=(",", ":")) + "\n")
+                n += 1
+    return [p for p in paths if p.stat().st_size], n
+
+
+def read_coco_bucket(bucket):
+    """
+    Returns the image dict (id -> (width, height, file_name)) and image-annotations dict (id -> (first annotation
+    index, anns)) of one image id bucket.
+    """
+    images, imgToAnns = {}, {}
+    with open(bucket, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record[0] == "i":
+                images[record[1]] = tuple(record[2:])
+            else:
+                imgToAnns.setdefault(record[2]["image_id"], (record[1], []))[1].append(record[2])
+    return images, imgToAnns
+
+
+def write_coco_labels(args):
+    """Writes the label files of one shard of (file_name, width, height, anns) records and returns the shard size."""
+    fn, records, use_segments, cls91to80, decimals = args
     coco80 = coco91_to_coco80_class()
+    for f, w, h, anns in records:
+        with LabelSink((fn / f).with_suffix(".txt"), mode="a") as sink:
+            sink.extend(coco_image_labels(anns, w, h, use_segments, cls91to80, coco80, decimals))
+    return len(records)
 
-    # Import json
-    for json_file in sorted(Path(json_dir).resolve().glob("*.json")):
-        fn = Path(save_dir) / "labels" / json_file.stem.replace("instances_", "")  # folder name
-        fn.mkdir()
-        with open(json_file) as f:
-            data = json.load(f)
 
-        # Create image dict
-        images = {"{:g}".format(x["id"]): x for x in data["images"]}
-        # Create image-annotations dict
-        imgToAnns = defaultdict(list)
-        for ann in data["annotations"]:
-            imgToAnns[ann["image_id"]].append(ann)
+def write_coco_bucket(args):
+    """Converts one streamed annotation bucket to label files and returns the number of labelled images."""
+    fn, bucket, use_segments, cls91to80, decimals = args
+    with open(bucket, encoding="utf-8") as f:
+        records = sorted((json.loads(line) for line in f), key=lambda r: r[0])  # the order of the in-memory path
+    return write_coco_labels((fn, [r[1:] for r in records], use_segments, cls91to80, decimals))
 
-        # Write labels file
-        for img_id, anns in tqdm(imgToAnns.items(), desc=f"Annotations {json_file}"):
-            img = images[f"{img_id:g}"]
-            h, w, f = img["height"], img["width"], img["file_name"]
 
-            bboxes = []
-            segments = []
-            for ann in anns:
-                if ann["iscrowd"]:
-                    continue
-                # The COCO box format is [top left x, top left y, width, height]
-                box = np.array(ann["bbox"], dtype=np.float64)
-                box[:2] += box[2:] / 2  # xy top-left corner to center
-                box[[0, 2]] /= w  # normalize x
-                box[[1, 3]] /= h  # normalize y
-                if box[2] <= 0 or box[3] <= 0:  # if w <= 0 and h <= 0
+def shard_coco_records(records, n):
+    """Splits (file_name, ...) records into `n` shards, keeping every record of a label file in one shard in order."""
+    shards = [[] for _ in range(n)]
+    for r in records:
+        shards[hash(Path(r[0]).stem) % n].append(r)
+    return [x for x in shards if x]
+
+
+def convert_coco_file(
+    json_file, fn, use_segments=False, cls91to80=False, stream=False, workers=0, pool=None, decimals=None
+):
+    """Converts one COCO JSON file into YOLO label files in folder `fn`, see convert_coco_json() for the options."""
+    coco80 = coco91_to_coco80_class()
+    if stream:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            buckets, n = stream_coco_annotations(json_file, tmp_dir, use_segments)
+            tasks = [(fn, b, use_segments, cls91to80, decimals) for b in buckets]
+            results = pool.imap_unordered(write_coco_bucket, tasks) if pool else map(write_coco_bucket, tasks)
+            with tqdm(total=n, desc=f"Annotations {json_file}") as pbar:  # images, not buckets
+                for k in results:
+                    pbar.update(k)
+        return
+
+    with open(json_file) as f:
+        data = json.load(f)
+
+    # Create image dict
+    images = {"{:g}".format(x["id"]): x for x in data["images"]}
+    # Create image-annotations dict
+    imgToAnns = defaultdict(list)
+    for ann in data["annotations"]:
+        imgToAnns[ann["image_id"]].append(ann)
+
+    # Write labels file
+    if pool:
+        records = []
+        for img_id, anns in imgToAnns.items():
+            img = images[f"{img_id:g}"]
+            records.append((img["file_name"], img["width"], img["height"], anns))
+        tasks = [(fn, x, use_segments, cls91to80, decimals) for x in shard_coco_records(records, workers * 16)]
+        with tqdm(total=len(records), desc=f"Annotations {json_file}") as pbar:
+            for n in pool.imap_unordered(write_coco_labels, tasks):
+                pbar.update(n)
+        return
+
+    for img_id, anns in tqdm(imgToAnns.items(), desc=f"Annotations {json_file}"):
+        img = images[f"{img_id:g}"]
+        h, w, f = img["height"], img["width"], img["file_name"]
+
+        # Write
+        with LabelSink((fn / f).with_suffix(".txt"), mode="a") as sink:
+            sink.extend(coco_image_labels(anns, w, h, use_segments, cls91to80, coco80, decimals))
+
+
+def convert_coco_json(
+    json_dir="../coco/annotations/",
+    use_segments=False,
+    cls91to80=False,
+    stream=False,
+    workers=0,
+    decimals=None,
+    incremental=False,
+):
+    """
+    Converts COCO JSON format to YOLO label format, with options for segments and class mapping.
+
+    With `stream=True` the JSON is never loaded whole: images and annotations are read incrementally and spilled to
+    temporary per-label-file buckets, so peak memory does not grow with the annotation count. With `workers > 0` label
+    files are computed and written by a process pool; the output is identical to the serial path. `decimals` sets the
+    rounding tolerance for collapsing near-identical duplicate boxes. With `incremental=True` the output directory is
+    kept and a manifest limits the run to JSON files whose contents changed, removing labels of deleted JSON files;
+    changing `use_segments`, `cls91to80` or `decimals` converts every JSON file again.
+    """
+    save_dir = make_dirs(clean=not incremental)  # output directory
+    options = {"use_segments": use_segments, "cls91to80": cls91to80, "decimals": decimals}  # labels depend on these
+    manifest = Manifest(save_dir / "manifest.json", options) if incremental else None
+    # The pool is terminated if a conversion raises, and closed and joined once all files are done
+    with Pool(workers) if workers > 0 else contextlib.nullcontext() as pool:
+        # Import json
+        json_files = sorted(Path(json_dir).resolve().glob("*.json"))
+        for json_file in json_files:
+            fn = Path(save_dir) / "labels" / json_file.stem.replace("instances_", "")  # folder name
+            if manifest:
+                if not manifest.changed(str(json_file), [json_file]):
+                    print(f"Skipping unchanged {json_file}")
                     continue
+                manifest.begin(str(json_file), [fn])
+            fn.mkdir()
+            convert_coco_file(json_file, fn, use_segments, cls91to80, stream, workers, pool, decimals)
+            if manifest:
+                manifest.record(str(json_file), [fn])
+
+        if manifest:
+            manifest.prune(str(x) for x in json_files)
+            manifest.save()
+        if pool:
+            pool.close()
+            pool.join()
 
-                cls = coco80[ann["category_id"] - 1] if cls91to80 else ann["category_id"] - 1  # class
-                box = [cls] + box.tolist()
-                if box not in bboxes:
-                    bboxes.append(box)
-                # Segments
-                if use_segments:
-                    if len(ann["segmentation"]) > 1:
-                        s = merge_multi_segment(ann["segmentation"])
-                        s = (np.concatenate(s, axis=0) / np.array([w, h])).reshape(-1).tolist()
-                    else:
-                        s = [j for i in ann["segmentation"] for j in i]  # all segments concatenated
-                        s = (np.array(s).reshape(-1, 2) / np.array([w, h])).reshape(-1).tolist()
-                    s = [cls] + s
-                    if s not in segments:
-                        segments.append(s)
-
-            # Write
-            with open((fn / f).with_suffix(".txt"), "a") as file:
-                for i in range(len(bboxes)):
-                    line = (*(segments[i] if use_segments else bboxes[i]),)  # cls, box or segments
-                    file.write(("%g " * len(line)).rstrip() % line + "\n")
-
-
-def min_index(arr1, arr2):
+
+def min_index(arr1, arr2, max_elements=1 << 16):
     """
     Find a pair of indexes with the shortest distance.
 
+    Small inputs are compared all-pairs at once. Above `max_elements` pairs a KD-tree (scipy) finds the closest-pair
+    radius in O((N+M) log N) and only the pairs inside it are compared exactly, in groups of columns holding at most
+    `max_elements` of them; without scipy all pairs are compared in tiles of at most `max_elements` over both axes. A
+    block is larger only for a single column with more than `max_elements` tied pairs, bounded by N. All paths return
+    the same first (row-major) minimum, ties included.
+
     Args:
         arr1: (N, 2).
         arr2: (M, 2).
+        max_elements: largest distance block held in memory.
 
     Return:
         a pair of indexes(tuple).
     """
-    dis = ((arr1[:, None, :] - arr2[None, :, :]) ** 2).sum(-1)
-    return np.unravel_index(np.argmin(dis, axis=None), dis.shape)
+    n, m = len(arr1), len(arr2)
+    if n * m <= max_elements:
+        dis = ((arr1[:, None, :] - arr2[None, :, :]) ** 2).sum(-1)
+        return np.unravel_index(np.argmin(dis, axis=None), dis.shape)
+
+    best = None  # (squared distance, i, j), so tuple order picks the first row-major minimum across blocks
+    if cKDTree is not None:
+        tree = cKDTree(arr1)
+        d = tree.query(arr2, k=1)[0]
+        r = d.min() * (1 + 1e-6) + 1e-12
+        cols = np.flatnonzero(d <= r)  # columns with a pair inside the closest-pair radius
+        counts = tree.query_ball_point(arr2[cols], r, return_length=True)
+        groups, start, total = [], 0, 0
+        for k, c in enumerate(counts.tolist()):
+            if total and total + c > max_elements:
+                groups.append(cols[start:k])
+                start, total = k, 0
+            total += c
+        groups.append(cols[start:])
+        for g in groups:
+            candidates = tree.query_ball_point(arr2[g], r)  # every i within the radius of each j
+            j = np.repeat(g, [len(c) for c in candidates])
+            i = np.concatenate(candidates).astype(np.intp)
+            dis = ((arr1[i] - arr2[j]) ** 2).sum(-1)  # exact squared distances, same arithmetic as the all-pairs path
+            k = np.flatnonzero(dis == dis.min())
+            k = k[np.lexsort((j[k], i[k]))[0]]  # first minimum in row-major order
+            best = min(best or (np.inf,), (dis[k], i[k], j[k]))
+        return np.intp(best[1]), np.intp(best[2])
+
+    cols = min(m, max_elements)
+    rows = max(1, max_elements // cols)
+    for i0 in range(0, n, rows):
+        for j0 in range(0, m, cols):
+            dis = ((arr1[i0 : i0 + rows, None, :] - arr2[None, j0 : j0 + cols, :]) ** 2).sum(-1)
+            i, j = np.unravel_index(np.argmin(dis, axis=None), dis.shape)
+            best = min(best or (np.inf,), (dis[i, j], i + i0, j + j0))
+    return np.intp(best[1]), np.intp(best[2])
 
 
 def merge_multi_segment(segments):
@@ -396,6 +580,9 @@ if __name__ == "__main__":
             "../datasets/coco/annotations",  # directory with *.json
             use_segments=True,
             cls91to80=True,
+            stream=False,  # stream multi-GB instances_*.json files instead of loading them whole
+            workers=0,  # process pool size for label writing, 0 for serial
+            incremental=False,  # only reconvert JSON files that changed since the last run
         )
 
     elif source == "infolks":  # Infolks https://infolks.info/
@@ -0,0 +1,542 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import contextlib
+import functools
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from staging import stage_file
+
+ORIENTATION = 0x0112  # EXIF Orientation tag id, as utils.orientation
+
+
+def exif_orientation(b):
+    """Returns the EXIF Orientation tag value from a TIFF-structured byte block, or None if absent."""
+    try:
+        e = {b"II": "<", b"MM": ">"}[b[:2]]
+        off = struct.unpack(e + "I", b[4:8])[0]
+        for k in range(struct.unpack(e + "H", b[off : off + 2])[0]):  # IFD0 entries
+            p = off + 2 + 12 * k
+            if struct.unpack(e + "H", b[p : p + 2])[0] == ORIENTATION:
+                return struct.unpack(e + "H", b[p + 8 : p + 10])[0]
+    except (KeyError, struct.error):
+        pass
+    return None
+
+
+def jpeg_header(f, mcu=False):
+    """
+    Parses JPEG markers up to the first SOF frame, returning (width, height, orientation) or None.
+
+    With `mcu=True` the (width, height) of the minimum coded unit is appended, i.e. the block grid of lossless crops.
+    """
+    if f.read(2) != b"\xff\xd8":
+        return None
+    rotation = None
+    while True:
+        c = f.read(1)
+        while c and c != b"\xff":  # resync to the next marker
+            c = f.read(1)
+        while c == b"\xff":  # fill bytes
+            c = f.read(1)
+        if not c:
+            return None
+        m = c[0]
+        if m == 0x01 or 0xD0 <= m <= 0xD8:  # markers without a length field
+            continue
+        n = struct.unpack(">H", f.read(2))[0] - 2
+        if 0xC0 <= m <= 0xCF and m not in {0xC4, 0xC8, 0xCC}:  # SOFn: precision, height, width
+            h, w, nc = struct.unpack(">xHHB", f.read(6))
+            if not mcu:
+                return w, h, rotation
+            s = f.read(3 * nc)[1::3]  # per-component sampling factors, H << 4 | V
+            return w, h, rotation, (8 * max(x >> 4 for x in s), 8 * max(x & 15 for x in s)) if nc > 1 else (8, 8)
+        if m == 0xE1 and rotation is None:
+            data = f.read(n)
+            if data[:6] == b"Exif\x00\x00":
+                rotation = exif_orientation(data[6:])
+        else:
+            f.seek(n, 1)
+
+
+def png_header(f):
+    """Parses PNG chunks up to the first IDAT, returning (width, height, orientation) or None."""
+    if f.read(8) != b"\x89PNG\r\n\x1a\n":
+        return None
+    w = h = rotation = None
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            break
+        n, kind = struct.unpack(">I4s", head)
+        if kind == b"IHDR":
+            w, h = struct.unpack(">II", f.read(8))
+            f.seek(n - 8 + 4, 1)
+        elif kind == b"eXIf":
+            rotation = exif_orientation(f.read(n))
+            f.seek(4, 1)
+        elif kind == b"IDAT":
+            break
+        else:
+            f.seek(n + 4, 1)  # data + CRC
+    return (w, h, rotation) if w else None
+
+
+def image_header(path):
+    """Returns (width, height, orientation) of an image from its header bytes only, falling back to PIL."""
+    with open(path, "rb") as f:
+        for parse in jpeg_header, png_header:
+            f.seek(0)
+            with contextlib.suppress(struct.error):
+                if (x := parse(f)) is not None:
+                    return x
+    with Image.open(path) as img:
+        with contextlib.suppress(Exception):
+            return (*img.size, dict(img._getexif().items())[ORIENTATION])
+        return (*img.size, None)
+
+
+class ImageSizeCache:
+    """
+    Persistent image-dimension cache keyed by path, modification time and file size.
+
+    Cached images cost one stat() instead of an open and header read, so repeated conversions of the same image set
+    never touch image payloads. Usage: `sizes = ImageSizeCache(); w, h = sizes(path); sizes.save()`.
+    """
+
+    def __init__(self, file=None):
+        """Loads the cache from `file` (default ~/.cache/json2yolo/image_sizes.json) if it exists."""
+        file = file or Path.home() / ".cache" / "json2yolo" / "image_sizes.json"
+        self.file, self.changed = Path(file), False
+        self.cache = {}
+        if self.file.exists():
+            with contextlib.suppress(ValueError), open(self.file) as f:
+                self.cache = json.load(f)
+
+    def __call__(self, path, exif=True):
+        """Returns (width, height) of `path`, swapped for EXIF rotations 6 and 8 when `exif` is set like exif_size()."""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        x = self.cache.get(path)
+        if x is None or x[:2] != [st.st_mtime_ns, st.st_size]:
+            x = [st.st_mtime_ns, st.st_size, *image_header(path)]
+            self.cache[path], self.changed = x, True
+        w, h, rotation = x[2:]
+        return (h, w) if exif and rotation in {6, 8} else (w, h)
+
+    def __enter__(self):
+        """Returns the cache for use as a context manager that saves on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Saves the cache."""
+        self.save()
+
+    def save(self):
+        """Atomically writes the cache back to disk if anything changed."""
+        if self.changed:
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.file.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(self.cache, f, separators=(",", ":"))
+            os.replace(tmp, self.file)
+            self.changed = False
+
+
+class FrameCache:
+    """
+    Bounded LRU of decoded images so each source frame is decoded once and shared by all of its crops.
+
+    Frames are returned read-only: crops are views into the cached buffer, and drawing on one raises instead of
+    corrupting the frame for later crops; copy a crop before editing it. Usage: `frames = FrameCache(); im = frames(p)`.
+    """
+
+    def __init__(self, maxsize=8, flags=None):
+        """Creates a cache holding up to `maxsize` frames decoded with cv2.imread `flags` (default IMREAD_COLOR)."""
+        self.maxsize, self.flags = maxsize, flags
+        self.frames = OrderedDict()  # path -> frame
+        self.hits = self.misses = 0
+
+    def __call__(self, path):
+        """Returns the decoded frame of `path` like cv2.imread, or None if it cannot be read."""
+        key = os.path.abspath(path)
+        im = self.frames.get(key)
+        if im is not None:
+            self.hits += 1
+            self.frames.move_to_end(key)
+            return im
+        self.misses += 1
+        import cv2  # imported on use, so scripts that only convert labels do not need OpenCV
+
+        im = cv2.imread(str(path), cv2.IMREAD_COLOR if self.flags is None else self.flags)
+        if im is not None:
+            im.flags.writeable = False
+            self.frames[key] = im
+            if len(self.frames) > self.maxsize:
+                self.frames.popitem(last=False)  # evict least recently used
+        return im
+
+    def __contains__(self, path):
+        """Returns True if the frame of `path` is cached."""
+        return os.path.abspath(path) in self.frames
+
+    def clear(self):
+        """Drops all cached frames."""
+        self.frames.clear()
+
+
+def jpeg_restart_layout(data):
+    """
+    Splits a baseline JPEG in bytes `data` into its header and the entropy-coded segments of its restart intervals.
+
+    Returns a dict with the header, the offset of the SOF height field, the image and MCU sizes, the (gw, gh) pixel size
+    of one interval and the segments in raster order, or None if the image has no restart markers, EXIF rotation, a
+    progressive or multi-scan layout, or intervals that do not tile whole MCU rows.
+    """
+    x = jpeg_header(io.BytesIO(data), mcu=True)
+    if not x or x[2] not in {None, 1}:
+        return None
+    w, h, _, (mw, mh) = x
+    i, sof, interval = 2, None, 0
+    while i + 4 <= len(data) and data[i] == 0xFF:
+        m = data[i + 1]
+        if m == 0xFF:  # fill byte
+            i += 1
+            continue
+        n = struct.unpack(">H", data[i + 2 : i + 4])[0]
+        if m in {0xC0, 0xC1}:  # baseline and extended sequential Huffman SOF
+            sof, nc = i + 5, data[i + 9]
+        elif 0xC2 <= m <= 0xCF and m not in {0xC4, 0xC8, 0xCC}:  # progressive, lossless or arithmetic
+            return None
+        elif m == 0xDD:  # DRI, restart interval in MCUs
+            interval = struct.unpack(">H", data[i + 4 : i + 6])[0]
+        elif m == 0xDA:  # SOS, entropy-coded data follows
+            if sof is None or not interval or data[i + 4] != nc:  # the first scan must hold all components
+                return None
+            start = i + 2 + n
+            break
+        i += 2 + n
+    else:
+        return None
+    scan = np.frombuffer(data, np.uint8, data.rfind(b"\xff\xd9") - start, start)
+    rst = np.flatnonzero((scan[:-1] == 0xFF) & ((scan[1:] & 0xF8) == 0xD0)) + start  # RSTn, data FFs are stuffed FF00
+    bounds = zip(np.r_[start, rst + 2].tolist(), np.r_[rst, start + len(scan)].tolist())
+    segments = [data[i:j].rstrip(b"\xff") for i, j in bounds]  # drop fill bytes before markers
+    nx, ny = -(-w // mw), -(-h // mh)  # MCUs per row and column
+    if len(segments) != -(-nx * ny // interval):
+        return None
+    if nx % interval == 0:
+        grid = (interval * mw, mh)  # several intervals per MCU row
+    elif interval % nx == 0:
+        grid = (nx * mw, interval // nx * mh)  # intervals of whole MCU rows
+    else:
+        return None
+    return {"header": data[:start], "sof": sof, "size": (w, h), "mcu": (mw, mh), "grid": grid, "segments": segments}
+
+
+def jpeg_region_bounds(layout, box):
+    """Returns the (c0, r0, c1, r1) range of restart intervals covering `box` plus one MCU of margin."""
+    (w, h), (mw, mh), (gw, gh) = layout["size"], layout["mcu"], layout["grid"]
+    x0, y0, x1, y1 = (int(x) for x in box)
+    c0, r0 = max(x0 - mw, 0) // gw, max(y0 - mh, 0) // gh
+    return c0, r0, min(-(-(x1 + mw) // gw), -(-w // gw)), min(-(-(y1 + mh) // gh), -(-h // gh))
+
+
+def jpeg_decode_region(layout, box, flags=None):
+    """
+    Decodes only the restart intervals of a jpeg_restart_layout() covering `box` (x0, y0, x1, y1).
+
+    The intervals are renumbered into a smaller valid JPEG, so no other part of the frame is entropy-decoded or
+    transformed. One MCU of margin keeps chroma upsampling at the region border identical to a full decode. Returns the
+    decoded region and its (x, y) origin in the frame, decoded with cv2.imdecode `flags` (default IMREAD_COLOR).
+    """
+    import cv2
+
+    (w, h), (gw, gh) = layout["size"], layout["grid"]
+    nx = -(-w // gw)  # interval columns
+    c0, r0, c1, r1 = jpeg_region_bounds(layout, box)
+    segments = [layout["segments"][r * nx + c] for r in range(r0, r1) for c in range(c0, c1)]
+    ox, oy = c0 * gw, r0 * gh
+    sof = layout["sof"]
+    header = layout["header"][:sof] + struct.pack(">HH", min(r1 * gh, h) - oy, min(c1 * gw, w) - ox)
+    scan = b"".join(x + bytes((0xFF, 0xD0 + k % 8)) for k, x in enumerate(segments[:-1])) + segments[-1]
+    data = header + layout["header"][sof + 4 :] + scan + b"\xff\xd9"
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR if flags is None else flags), (ox, oy)
+
+
+class RegionReader:
+    """
+    Reads image regions for crops, decoding as little of each frame as the request allows.
+
+    Per request the cheapest of these is used: a slice of a frame already in the FrameCache; for JPEGs with restart
+    markers only the restart intervals covering the region; DCT-domain reduced decoding (cv2.IMREAD_REDUCED_*) when the
+    crop is downscaled by 2x or more anyway, combined with the former where possible; else a full cached decode.
+    Usage: `read = RegionReader(); crop = read(path, (x0, y0, x1, y1))`.
+    """
+
+    REDUCED = (2, 4, 8)  # factors of cv2.IMREAD_REDUCED_COLOR_<f>
+
+    def __init__(self, frames=None, max_fraction=0.5, maxsize=8):
+        """
+        Creates a reader sharing `frames` (a FrameCache, new by default) for full decodes.
+
+        Restart-interval decoding is used when it touches less than `max_fraction` of the frame; the layouts of the
+        last `maxsize` JPEGs are kept so crops of one frame read and split its bytes once.
+        """
+        self.frames = frames if frames is not None else FrameCache()
+        self.max_fraction, self.maxsize = max_fraction, maxsize
+        self.layouts = OrderedDict()  # path -> jpeg_restart_layout() or None
+        self.counts = defaultdict(int)  # strategy -> reads
+
+    def layout(self, path):
+        """Returns the cached jpeg_restart_layout() of `path`, or None for other images."""
+        key = os.path.abspath(path)
+        if key not in self.layouts:
+            x = None
+            if Path(path).suffix.lower() in {".jpg", ".jpeg"}:
+                with open(path, "rb") as f:
+                    data = f.read(1 << 16)
+                    if b"\xff\xdd" in data:  # a DRI marker precedes the scan, otherwise skip reading the payload
+                        with contextlib.suppress(struct.error, IndexError, TypeError):
+                            x = jpeg_restart_layout(data + f.read())
+            self.layouts[key] = x
+            if len(self.layouts) > self.maxsize:
+                self.layouts.popitem(last=False)
+        return self.layouts[key]
+
+    def __call__(self, path, box, scale=1.0):
+        """
+        Returns the pixels of `box` (x0, y0, x1, y1) of image `path` like cv2.imread(path)[y0:y1, x0:x1], resized by
+        `scale` if not 1, or None if the image cannot be read. Unscaled full-frame crops are read-only cache views.
+        """
+        import cv2
+
+        x0, y0, x1, y1 = (int(x) for x in box)
+        f = max([k for k in self.REDUCED if k * scale <= 1], default=1)  # DCT reduction factor
+        flags = getattr(cv2, f"IMREAD_REDUCED_COLOR_{f}") if f > 1 else cv2.IMREAD_COLOR
+        layout = None if f == 1 and path in self.frames else self.layout(path)
+        if layout:
+            (w, h), (gw, gh) = layout["size"], layout["grid"]
+            c0, r0, c1, r1 = jpeg_region_bounds(layout, box)
+            if (c1 - c0) * gw * (r1 - r0) * gh >= self.max_fraction * w * h:  # decoded area, rounded up to intervals
+                layout = None
+        if layout:
+            im, (ox, oy) = jpeg_decode_region(layout, box, flags)
+            how = "region"
+        elif f > 1:
+            im, ox, oy = cv2.imread(str(path), flags), 0, 0
+            how = "reduced"
+        else:
+            im, ox, oy = self.frames(path), 0, 0
+            how = "full"
+        if im is None:
+            return None
+        self.counts[how] += 1
+        im = im[(y0 - oy) // f : -(-(y1 - oy) // f), (x0 - ox) // f : -(-(x1 - ox) // f)]
+        if scale != 1:
+            size = (max(round((x1 - x0) * scale), 1), max(round((y1 - y0) * scale), 1))
+            im = cv2.resize(im, size, interpolation=cv2.INTER_AREA)
+        return im
+
+
+JPEG_SUBSAMPLING = {"444": 0x111111, "422": 0x211111, "420": 0x221111}  # cv2.IMWRITE_JPEG_SAMPLING_FACTOR values
+
+
+def encode_params(path, quality=None, subsampling=None, compression=None):
+    """
+    Returns cv2.imwrite params for the format of `path`; unset options keep the OpenCV defaults.
+
+    Args:
+        quality: JPEG/WebP quality 0-100 (WebP above 100 is lossless).
+        subsampling: JPEG chroma subsampling, one of JPEG_SUBSAMPLING.
+        compression: PNG zlib level 0-9.
+    """
+    import cv2
+
+    suffix, p = Path(path).suffix.lower(), []
+    if suffix in {".jpg", ".jpeg"}:
+        if quality is not None:
+            p += [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+        if subsampling:
+            p += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, JPEG_SUBSAMPLING[str(subsampling)]]
+    elif suffix == ".webp" and quality is not None:
+        p += [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+    elif suffix == ".png" and compression is not None:
+        p += [cv2.IMWRITE_PNG_COMPRESSION, int(compression)]
+    return p
+
+
+def jpeg_mcu(path):
+    """Returns the (width, height) MCU size of a JPEG without EXIF rotation, or None if not losslessly croppable."""
+    with open(path, "rb") as f, contextlib.suppress(struct.error):
+        x = jpeg_header(f, mcu=True)
+        if x and x[2] in {None, 1}:  # cv2.imread pixels match the stored ones
+            return x[3]
+    return None
+
+
+def jpeg_crop_ready(src, dst, box):
+    """Returns True if jpegtran is installed, `src` and `dst` are JPEGs and `box` starts on the MCU grid of `src`."""
+    jpeg = {".jpg", ".jpeg"}
+    if not shutil.which("jpegtran") or Path(src).suffix.lower() not in jpeg or Path(dst).suffix.lower() not in jpeg:
+        return False
+    mcu = jpeg_mcu(src)
+    return bool(mcu) and int(box[0]) % mcu[0] == 0 and int(box[1]) % mcu[1] == 0
+
+
+def jpeg_crop(src, dst, box):
+    """
+    Crops JPEG `src` to `box` (x0, y0, x1, y1) with jpegtran, moving DCT blocks without decoding or re-encoding.
+
+    Returns False without writing if jpegtran is not installed or the box origin is not on the MCU grid.
+    """
+    if not jpeg_crop_ready(src, dst, box):
+        return False
+    exe, (x0, y0, x1, y1) = shutil.which("jpegtran"), (int(x) for x in box)
+    cmd = [exe, "-copy", "none", "-crop", f"{x1 - x0}x{y1 - y0}+{x0}+{y0}", "-outfile", str(dst), str(src)]
+    return subprocess.run(cmd, capture_output=True, check=False).returncode == 0
+
+
+def passthrough_safe(path):
+    """
+    Returns True if the bytes of JPEG or PNG `path` can be reused as they are for its decoded pixels.
+
+    The header must parse to a positive size without an EXIF rotation, which cv2.imread would apply to the pixels, and
+    the file must end with its format's end marker, so truncated files are decoded and rejected as before.
+    """
+    try:
+        w, h, rotation = image_header(path)
+    except (OSError, TypeError, ValueError, struct.error):
+        return False
+    if not (w > 0 and h > 0) or rotation not in {None, 1}:
+        return False
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 16))
+        tail = f.read()
+    suffix = Path(path).suffix.lower()
+    if suffix in {".jpg", ".jpeg"}:
+        return tail.rstrip(b"\0").endswith(b"\xff\xd9")  # EOI, ignoring zero padding
+    return suffix == ".png" and tail.endswith(b"IEND\xaeB`\x82")
+
+
+def write_image(path, im, src=None, box=None, params=(), lossless=False):
+    """
+    Writes image `im` to `path` and returns how: 'passthrough', 'lossless' or 'encoded'.
+
+    If `im` holds the unchanged pixels of file `src` (or its crop to `box`), the source bytes are reused when `path` has
+    the same format: whole images are reflinked or copied, and with `lossless=True` MCU-aligned JPEG crops are cut by
+    jpegtran. This avoids the CPU cost and generational loss of re-encoding; `params` apply only to encoded images.
+    `im` may be a callable returning the image, so it is decoded only if it has to be encoded.
+    """
+    if src is not None and Path(src).suffix.lower() == Path(path).suffix.lower():
+        if box is None:
+            stage_file(src, path, "reflink")
+            return "passthrough"
+        if lossless and jpeg_crop(src, path, box):
+            return "lossless"
+    import cv2
+
+    if callable(im):
+        im = im()
+    if not cv2.imwrite(str(path), im, list(params)):
+        raise OSError(f"cv2.imwrite failed for {path}")
+    return "encoded"
+
+
+def imread_crop(path, box):
+    """Returns the `box` (x0, y0, x1, y1) crop of image `path` decoded by cv2.imread, raising OSError if unreadable."""
+    import cv2
+
+    im = cv2.imread(str(path))
+    if im is None:
+        raise OSError(f"cv2.imread failed for {path}")
+    x0, y0, x1, y1 = (int(x) for x in box)
+    return im[y0:y1, x0:x1]
+
+
+class ImageWriter:
+    """
+    Writes images on a background thread pool, at most once per output path.
+
+    cv2.imwrite releases the GIL, so JPEG encoding overlaps with parsing and decoding the next file. At most
+    `max_pending` images are queued at once, bounding the frames kept alive by pending crops. Images must not be
+    modified after submission (FrameCache crops are read-only). Usage: `write = ImageWriter(); write(p, im)`, then
+    `failed = write.close()`.
+    """
+
+    def __init__(
+        self, threads=2, max_pending=16, fmt=None, quality=None, subsampling=None, compression=None, lossless=False
+    ):
+        """
+        Creates a writer with `threads` encoder threads.
+
+        `fmt` ('jpg', 'png', 'webp') replaces the suffix of every output path, `quality`, `subsampling` and
+        `compression` are passed to encode_params, and `lossless` enables MCU-aligned JPEG crops by jpegtran.
+        """
+        self.fmt, self.lossless = fmt, lossless
+        self.settings = {"quality": quality, "subsampling": subsampling, "compression": compression}
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix="imwrite")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.written = set()  # output paths submitted this run
+        self.failed = {}  # path -> exception
+        self.counts = defaultdict(int)  # method -> images
+
+    def __call__(self, path, im, src=None, box=None):
+        """
+        Queues `im` for writing to `path` (see write_image for `src` and `box`) and returns the final output path, or
+        None without writing if that path was already submitted.
+
+        `im` may be a callable returning the image. It is not called for a crop jpegtran can cut losslessly, and is
+        otherwise called on this thread, as RegionReader and FrameCache are not thread-safe.
+        """
+        path = Path(path).with_suffix(f".{self.fmt}") if self.fmt else Path(path)
+        key = os.path.abspath(path)
+        with self.lock:
+            if key in self.written:
+                self.counts["skipped"] += 1
+                return None
+            self.written.add(key)
+        if callable(im):
+            if self.lossless and src is not None and box is not None and jpeg_crop_ready(src, path, box):
+                im = functools.partial(imread_crop, src, box)  # decoded on the encoder thread only if jpegtran fails
+            else:
+                im = im()
+        self.slots.acquire()  # blocks while max_pending images are queued
+        self.pool.submit(self._write, path, im, src, box)
+        return path
+
+    def _write(self, path, im, src, box):
+        """Writes one image on an encoder thread, counting methods and recording failures."""
+        import cv2
+
+        try:
+            how = write_image(path, im, src, box, encode_params(path, **self.settings), self.lossless)
+            with self.lock:
+                self.counts[how] += 1
+        except (OSError, ValueError, cv2.error) as e:  # unreadable source, bad settings or failed encode
+            self.failed[str(path)] = e
+        finally:
+            self.slots.release()
+
+    def close(self):
+        """Waits for all queued writes and returns a dict of failed paths to exceptions."""
+        self.pool.shutdown(wait=True)
+        return self.failed
+
+    def report(self):
+        """Prints one summary of how images were written."""
+        if self.counts:
+            print("Images written: " + ", ".join(f"{v} {k}" for k, v in sorted(self.counts.items())))
@@ -5,6 +5,8 @@ from datetime import timedelta
 from apscheduler.schedulers.blocking import BlockingScheduler
 import re
 
+from downloads import DownloadLedger, Downloader, ResourceStream, Transport, pooled_session
+
 def convert_date_to_timestamp(date_str):
     """
     Convert a date string to a timestamp.
@@ -19,7 +21,7 @@ def convert_date_to_timestamp(date_str):
         print(f"Invalid date format: {e}")
         return None
 
-def fetch_data_from_http_service(url, device_name, start_time, end_time):
+def fetch_data_from_http_service(url, device_name, start_time, end_time, transport=None):
     """
     Fetch data from an HTTP service using the provided parameters.
 
@@ -27,8 +29,13 @@ def fetch_data_from_http_service(url, device_name, start_time, end_time):
     :param device_name: The name of the device to query.
     :param start_time: The start time for the query (e.g., '2023-01-01T00:00:00Z').
     :param end_time: The end time for the query (e.g., '2023-01-02T00:00:00Z').
+    :param transport: Optional Transport (timeouts, retries with backoff, rate limits) whose connections are reused;
+        without one a Transport is opened for this call and closed again.
     :return: The response data from the HTTP service.
     """
+    if transport is None:
+        with Transport() as t:
+            return fetch_data_from_http_service(url, device_name, start_time, end_time, t)
     headers = {'Content-Type': 'application/json'}
     payload = {
         "deviceName": device_name,
@@ -38,7 +45,7 @@ def fetch_data_from_http_service(url, device_name, start_time, end_time):
     print(type(payload))
     print(payload)
     try:
-        response = requests.get(url, params=payload, headers=headers)
+        response = transport.get(url, params=payload, headers=headers)
         print(response.status_code)
         # print(response.json())
         # print(response.encoding)
@@ -49,7 +56,7 @@ def fetch_data_from_http_service(url, device_name, start_time, end_time):
         print(f"An error occurred: {e}")
         return None
 
-def download_imgs(url, device_names, start_time, end_time):
+def download_imgs(url, device_names, start_time, end_time, workers=16, per_host=8, ledger="downloads.sqlite", rps=None, bandwidth=None):
     """
     Download images from the specified URL for a given device and time range.
 
@@ -57,6 +64,11 @@ def download_imgs(url, device_names, start_time, end_time):
     :param device_name: The name of the device to query.
     :param start_time: The start time for the query (e.g., '2023-01-01T00:00:00Z').
     :param end_time: The end time for the query (e.g., '2023-01-02T00:00:00Z').
+    :param workers: Number of concurrent image downloads.
+    :param per_host: Maximum concurrent connections to one image host.
+    :param ledger: SQLite download ledger; images already downloaded are skipped, failed or missing ones retried.
+    :param rps: Maximum requests per second to the backend and image hosts, None for no limit.
+    :param bandwidth: Maximum download bandwidth in bytes per second, None for no limit.
     """
     start_timestamp = convert_date_to_timestamp(start_time)
     end_timestamp = convert_date_to_timestamp(end_time)
@@ -68,45 +80,51 @@ def download_imgs(url, device_names, start_time, end_time):
     os.makedirs(time_date, exist_ok=True)
     # 10号电梯（KRIPCH_122203166_28），9号电梯（KRIPCH_108226008_43）
     total_count = 0
+    day_urls = []
+    ledger = DownloadLedger(ledger) if ledger else None
+    # 带超时、指数退避重试、限速和统计的传输层，元数据请求与图片下载共用
+    transport = Transport(rps=rps, bandwidth=bandwidth, session=pooled_session(per_host, max(16, workers)))
+    downloader = Downloader(workers=workers, per_host=per_host, transport=transport, ledger=ledger)
     
+    def listed(resources):
+        """Yields (image URL, save path) for each streamed resource and collects the day's image URLs."""
+        for item in resources:
+            day_urls.append(item['pic'])
+            # 图片URL与保存路径，文件名取自URL
+            yield item['pic'], os.path.join(time_date, item['pic'].split("/")[-1])
+
     for device_name in device_names:
-        data = fetch_data_from_http_service(url, device_name, start_timestamp, end_timestamp)
-        if data:
-            print("Data fetched successfully:")
-            print(data.keys())
-            dict_data = data['data']
-            print(len(dict_data))
-            total_count += len(dict_data)
-            # 将数据写入本地 txt 文件
-            # 动态生成文件名
-            url_txtfile_name = f"image_data_{time_date}.txt"
-            try:
-                with open(url_txtfile_name, "w", encoding="utf-8") as txtfile:
-                    for idx, item in enumerate(dict_data):
-                        # 将每个数据项转换为字符串并写入文件
-                        # print(item.keys())
-                        image_url = item['pic']
-                        print(image_url)
-                        # txtfile.write(image_url + "\n")
-                        try:
-                            response = requests.get(image_url)
-                            response.raise_for_status()  # 检查请求是否成功
-                            # image_file_name = f"{file_prefix}_image_{idx + 1}.jpg"  # 动态生成图片文件名
-                            # image_file_name = f"image_{idx + 1}.jpg"  # 动态生成图片文件名
-                            # Extract the file name from the image URL
-                            image_file_name = image_url.split("/")[-1]
-                            image_file_path = os.path.join(time_date, image_file_name)
-                            with open(image_file_path, "wb") as img_file:
-                                img_file.write(response.content)  # 保存图片内容
-                            print(f"Image {idx + 1} has been downloaded: {image_file_name}")
-                        except requests.exceptions.RequestException as e:
-                            print(f"Failed to download image {idx + 1} from {image_url}: {e}")
-                # print(f"Image URLs have been written to {url_txtfile_name}")
-            except IOError as e:
-                print(f"Failed to write data to file: {e}")
+        payload = {"deviceName": device_name, "start_time": start_timestamp, "end_time": end_timestamp}
+        print(payload)
+        # 流式解析元数据，每解析出一条就送入下载队列，元数据请求与图片下载重叠进行；响应过大时按时间拆分子窗口
+        resources = ResourceStream(transport, url, payload, headers={'Content-Type': 'application/json'})
+        # 并发下载，复用连接池中的连接，边下载边写盘；账本中已完成的文件跳过，只重试失败或缺失的
+        for idx, result in enumerate(downloader.map(listed(resources))):
+            if result.error is None:
+                print(f"Image {idx + 1} has been downloaded: {os.path.basename(result.path)}")
+            else:
+                print(f"Failed to download image from {result.url}: {result.error}")
+        if resources.error is None:
+            print(f"Data fetched successfully: {resources.count} images in {resources.windows} request(s)")
+            total_count += resources.count
         else:
             print("Failed to fetch data.")
 
+    # 将当天所有设备的图片URL写入本地 txt 文件，所有设备处理完后一次写入，不再互相覆盖
+    url_txtfile_name = f"image_data_{time_date}.txt"
+    try:
+        with open(url_txtfile_name, "w", encoding="utf-8") as txtfile:
+            txtfile.writelines(image_url + "\n" for image_url in day_urls)
+        print(f"Image URLs have been written to {url_txtfile_name}")
+    except IOError as e:
+        print(f"Failed to write data to file: {e}")
+
+    downloader.close()
+    transport.report()
+    transport.close()
+    if ledger:
+        ledger.report()
+        ledger.close()
     print(f"Total count of images: {total_count}")
     print("All images have been downloaded.")
 
@@ -1,9 +1,15 @@
+import argparse
 import os
-import requests
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from datetime import timedelta
 from apscheduler.schedulers.blocking import BlockingScheduler
-import re
+
+from downloads import DownloadLedger, Downloader, ResourceStream, Transport, mark_complete, plan_catchup
+
+URL = "http://iot.krzhibo.com/admin/common/cloudData/getResourceAll"
+# 10号电梯（KRIPCH_122203166_28），9号电梯（KRIPCH_108226008_43）
+DEVICE_NAMES = ["KRIPCH_108226008_43", "KRIPCH_122203166_28"]
 
 def convert_date_to_timestamp(date_str):
     """
@@ -19,142 +25,111 @@ def convert_date_to_timestamp(date_str):
         print(f"Invalid date format: {e}")
         return None
 
-def fetch_data_from_http_service(url, device_name, start_time, end_time):
+def download_imgs(url=URL, device_names=DEVICE_NAMES, root=".", start=None, workers=16, windows=4, dry_run=False):
     """
-    Fetch data from an HTTP service using the provided parameters.
+    Catch up on every missing (device, day) window from the newest complete day folder up to yesterday.
+
+    Windows are fetched concurrently, and each day folder is marked complete once all its devices were downloaded
+    without errors, so a failed or interrupted day is planned again on the next run.
 
     :param url: The endpoint URL of the HTTP service.
-    :param device_name: The name of the device to query.
-    :param start_time: The start time for the query (e.g., '2023-01-01T00:00:00Z').
-    :param end_time: The end time for the query (e.g., '2023-01-02T00:00:00Z').
-    :return: The response data from the HTTP service.
+    :param device_names: The names of the devices to query.
+    :param root: Directory holding the YYYYMMDD day folders, the URL lists and the download ledger.
+    :param start: First day to fetch ('YYYY-MM-DD'), by default the day after the newest complete day folder.
+    :param workers: Number of concurrent image downloads, shared by all windows.
+    :param windows: Number of (device, day) windows fetched concurrently.
+    :param dry_run: Only print the plan, without fetching anything.
+    :return: The planned windows.
     """
-    headers = {'Content-Type': 'application/json'}
-    payload = {
-        "deviceName": device_name,
-        "start_time": start_time,
-        "end_time": end_time
-    }
-    print(type(payload))
-    print(payload)
-    try:
-        response = requests.get(url, params=payload, headers=headers)
-        print(response.status_code)
-        # print(response.json())
-        # print(response.encoding)
-        # print(response.url)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-        return None
+    # 从最近一个已完成的日期文件夹的下一天开始，列出到昨天为止所有(设备, 日期)下载窗口
+    plan = plan_catchup(device_names, root, start)
+    print(f"Catch-up plan: {len(plan)} window(s) over {len({w.day for w in plan})} day(s)")
+    for w in plan:
+        print(f"  {w.day} {w.device}: {w.start} -> {w.end}")
+    if dry_run or not plan:
+        return plan
 
-def download_imgs():
-    """
-    Download images from the specified URL for a given device and time range.
+    ledger = DownloadLedger(os.path.join(root, "downloads.sqlite"))  # 下载账本，重复运行或崩溃重启时跳过已完成的图片
+    transport = Transport()  # 带超时、指数退避重试和统计的传输层，所有窗口共用一个连接池
+    downloader = Downloader(workers=workers, transport=transport, ledger=ledger)  # 所有窗口共用的并发下载线程池
 
-    :param url: The endpoint URL of the HTTP service.
-    :param device_name: The name of the device to query.
-    :param start_time: The start time for the query (e.g., '2023-01-01T00:00:00Z').
-    :param end_time: The end time for the query (e.g., '2023-01-02T00:00:00Z').
-    """
-    url = "http://iot.krzhibo.com/admin/common/cloudData/getResourceAll"
-    device_names = ["KRIPCH_108226008_43", "KRIPCH_122203166_28"]
-    # 获取当前目录下的文件夹
-    folders = [name for name in os.listdir('.') if os.path.isdir(name)]
-    # 过滤出符合 yyyymmdd 格式的文件夹
-    date_pattern = re.compile(r'^\d{8}$')
-    date_folders = [f for f in folders if date_pattern.match(f)]
-    # 获取离当前最近的日期
-    today = datetime.now()
-    closest_folder = None
-    min_diff = None
-    formatted_next_day = None
-    for folder in date_folders:
+    def run(w):
+        """Downloads one (device, day) window and returns its image URLs and whether everything succeeded."""
         try:
-            folder_date = datetime.strptime(folder, "%Y%m%d")
-            diff = abs((folder_date - today).days)
-            if min_diff is None or diff < min_diff:
-                min_diff = diff
-                closest_folder = folder
-            # 获取 closest_folder+1 的日期并格式化
-            folder_date_obj = datetime.strptime(closest_folder, "%Y%m%d")
-            next_day_obj = folder_date_obj + timedelta(days=1)
-            formatted_next_day = next_day_obj.strptime("%Y-%m-%dT%H:%M:%SZ")
-            print(f"Formatted next day: {formatted_next_day}")
-        except ValueError:
-            continue
-    print(f"Closest date folder: {closest_folder}")
-    print(formatted_next_day)
-    current_date_str = datetime.now().strptime("%Y-%m-%dT%H:%M:%SZ")
-    print(f"Current date in required format: {current_date_str}")
+            folder = os.path.join(root, w.day)
+            os.makedirs(folder, exist_ok=True)
+            start_timestamp, end_timestamp = convert_date_to_timestamp(w.start), convert_date_to_timestamp(w.end)
+            payload = {"deviceName": w.device, "start_time": start_timestamp, "end_time": end_timestamp}
+            # 流式解析元数据，每解析出一条就送入下载队列，元数据请求与图片下载重叠进行；响应过大时按时间拆分子窗口
+            resources = ResourceStream(transport, url, payload, headers={'Content-Type': 'application/json'})
+            urls = []
 
-    delta_days = (current_date_str - formatted_next_day).days
-    print(f"Start time and end time are {delta_days} day(s) apart.")
+            def listed():
+                """Yields (image URL, save path) for each streamed resource and collects the window's image URLs."""
+                for item in resources:
+                    urls.append(item['pic'])
+                    # 图片URL与保存路径，文件名取自URL；账本中已完成的文件跳过，只重试失败或缺失的
+                    yield item['pic'], os.path.join(folder, item['pic'].split("/")[-1])
 
-    if delta_days >= 1:
-        for idx in range(delta_days):
-            current_start_time = (formatted_next_day + timedelta(days=idx)).strftime("%Y-%m-%dT00:00:00Z")
-            current_end_time = (formatted_next_day + timedelta(days=idx + 1)).strftime("%Y-%m-%dT00:00:00Z")
-            print(f"Downloading images from {current_start_time} to {current_end_time}")
+            failed = 0
+            for result in downloader.map(listed()):
+                if result.error is not None:
+                    failed += 1
+                    print(f"Failed to download image from {result.url}: {result.error}")
+            if resources.error is not None:
+                print(f"Failed to fetch data: {w.device} {w.day}")
+                return urls, False
+            print(f"{w.day} {w.device}: {len(urls)} images, {failed} failed")
+            return urls, failed == 0
+        except (OSError, KeyError, TypeError, sqlite3.Error) as e:  # folder, malformed resource or ledger errors
+            print(f"Failed to download {w.device} {w.day}: {e}")
+            return [], False
 
-            start_timestamp = convert_date_to_timestamp(current_start_time)
-            end_timestamp = convert_date_to_timestamp(current_end_time)
-            if start_timestamp and end_timestamp:
-                print(f"Start timestamp: {start_timestamp}")
-                print(f"End timestamp: {end_timestamp}")
+    # 多个窗口并发下载，按计划顺序收集结果；一天的所有设备完成后写出当天的URL列表并原子地标记完成
+    expected = {day: sum(w.day == day for w in plan) for day in {w.day for w in plan}}
+    results = {day: [] for day in expected}
+    with ThreadPoolExecutor(max_workers=windows) as pool:
+        for w, (urls, ok) in zip(plan, pool.map(run, plan)):
+            results[w.day].append((urls, ok))
+            if len(results[w.day]) < expected[w.day]:
+                continue
+            day_urls = [image_url for urls, _ in results[w.day] for image_url in urls]
+            url_txtfile_name = os.path.join(root, f"image_data_{w.day}.txt")
+            try:
+                with open(url_txtfile_name, "w", encoding="utf-8") as txtfile:
+                    txtfile.writelines(image_url + "\n" for image_url in day_urls)
+            except IOError as e:
+                print(f"Failed to write data to file: {e}")
+                continue
+            if all(ok for _, ok in results[w.day]):
+                mark_complete(os.path.join(root, w.day), {"images": len(day_urls), "devices": list(device_names)})
+                print(f"Day {w.day} complete: {len(day_urls)} images")
+            else:
+                print(f"Day {w.day} incomplete, it will be retried on the next run")
 
-            time_date = current_start_time[:10].replace("-", "")
-            os.makedirs(time_date, exist_ok=True)
-            # 10号电梯（KRIPCH_122203166_28），9号电梯（KRIPCH_108226008_43）
-            total_count = 0
-            
-            for device_name in device_names:
-                data = fetch_data_from_http_service(url, device_name, start_timestamp, end_timestamp)
-                if data:
-                    print("Data fetched successfully:")
-                    print(data.keys())
-                    dict_data = data['data']
-                    print(len(dict_data))
-                    total_count += len(dict_data)
-                    # 将数据写入本地 txt 文件
-                    # 动态生成文件名
-                    url_txtfile_name = f"image_data_{time_date}.txt"
-                    try:
-                        with open(url_txtfile_name, "w", encoding="utf-8") as txtfile:
-                            for idx, item in enumerate(dict_data):
-                                # 将每个数据项转换为字符串并写入文件
-                                # print(item.keys())
-                                image_url = item['pic']
-                                print(image_url)
-                                # txtfile.write(image_url + "\n")
-                                try:
-                                    response = requests.get(image_url)
-                                    response.raise_for_status()  # 检查请求是否成功
-                                    # image_file_name = f"{file_prefix}_image_{idx + 1}.jpg"  # 动态生成图片文件名
-                                    # image_file_name = f"image_{idx + 1}.jpg"  # 动态生成图片文件名
-                                    # Extract the file name from the image URL
-                                    image_file_name = image_url.split("/")[-1]
-                                    image_file_path = os.path.join(time_date, image_file_name)
-                                    with open(image_file_path, "wb") as img_file:
-                                        img_file.write(response.content)  # 保存图片内容
-                                    print(f"Image {idx + 1} has been downloaded: {image_file_name}")
-                                except requests.exceptions.RequestException as e:
-                                    print(f"Failed to download image {idx + 1} from {image_url}: {e}")
-                        # print(f"Image URLs have been written to {url_txtfile_name}")
-                    except IOError as e:
-                        print(f"Failed to write data to file: {e}")
-                else:
-                    print("Failed to fetch data.")
+    downloader.close()
+    transport.report()
+    transport.close()
+    ledger.report()
+    ledger.close()
+    return plan
 
-            print(f"Total count of images: {total_count}")
-            print("All images have been downloaded.")
 
 # Example usage
 if __name__ == "__main__":
-    
-    scheduler = BlockingScheduler()
-
-    # scheduler.add_job(func=download_imgs, args=(), trigger='cron', day_of_week='mon', hour=9, minute=0)
-    scheduler.add_job(lambda: download_imgs(), 'cron', day_of_week='mon', hour=9, minute=0)
-    scheduler.start()
+    parser = argparse.ArgumentParser(description="Catch up on missing (device, day) image downloads")
+    parser.add_argument("--root", type=str, default=".", help="directory holding the YYYYMMDD day folders")
+    parser.add_argument("--start", type=str, default=None, help="first day to fetch, YYYY-MM-DD")
+    parser.add_argument("--windows", type=int, default=4, help="(device, day) windows fetched concurrently")
+    parser.add_argument("--workers", type=int, default=16, help="concurrent image downloads")
+    parser.add_argument("--dry_run", action="store_true", help="print the catch-up plan and exit")
+    parser.add_argument("--once", action="store_true", help="run once now instead of every Monday at 9:00")
+    opt = parser.parse_args()
+    kwargs = {"root": opt.root, "start": opt.start, "workers": opt.workers, "windows": opt.windows,
+              "dry_run": opt.dry_run}
+    if opt.dry_run or opt.once:
+        download_imgs(**kwargs)
+    else:
+        scheduler = BlockingScheduler()
+        scheduler.add_job(download_imgs, 'cron', kwargs=kwargs, day_of_week='mon', hour=9, minute=0)
+        scheduler.start()
@@ -1,9 +1,17 @@
 import os
 import json
-import shutil
 from pycocotools import mask
 import numpy as np
 
+from labelstore import LabelMeStore
+from staging import Stager
+
+
+def whole(values):
+    """Returns float `values` with whole numbers as int, as LabelMe writes integer pixel coordinates."""
+    return [int(v) if v.is_integer() else v for v in values]
+
+
 # 定义所有文件夹路径
 # folder_paths = [
 #     '/Users/jinyfeng/projects/ai-construction/20250426',
@@ -62,6 +70,8 @@ if not os.path.exists(images_folder):
     os.makedirs(images_folder, exist_ok=True)
 if not os.path.exists(labels_folder):
     os.makedirs(labels_folder, exist_ok=True)
+store_folder = None  # 标注列存缓存目录，设置后每个文件夹缓存为 <文件夹名>.npz，只重新解析新增或改动的JSON文件
+stage = Stager("reflink")  # reflink 暂存图像（写时复制，与源数据互不影响），不支持时回退为复制
 
 coco_images = []
 coco_annotations = []
@@ -88,93 +98,80 @@ for folder_path in folder_paths:
             middle_four_dict[middle_four] += 1
             image_idx = middle_four_dict[middle_four]
     # 遍历文件夹中的所有 JSON 文件
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith('.json'):
-            file_path = os.path.join(folder_path, file_name)
-            # new_jpg_name = f"{folder_name}_{file_name.replace('.json', '.jpg')}"
-            jpg_name = f"{file_name.replace('.json', '.jpg')}"
-            jpg_file_path = os.path.join(folder_path, jpg_name)
-            new_jpg_name = f"{folder_name}_{jpg_name}"
-            new_jpg_path = os.path.join(images_folder, new_jpg_name)
-            shutil.copy(jpg_file_path, new_jpg_path)
-
-            # 打开并读取 JSON 文件
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            if data_type == 'val':
-                middle_four = jpg_name[2:6]
-                
-                if middle_four not in middle_four_dict:
-                    middle_four_dict[middle_four] = 1
-                    image_idx = 1
-                else:
-                    middle_four_dict[middle_four] += 1
-                    image_idx = middle_four_dict[middle_four]
-
-            image_id = int(f"{middle_four}_{image_idx:03d}")
-            img_height = data.get("imageHeight", 0)
-            img_width = data.get("imageWidth", 0)
-
-            if 'shapes' in data:
-                coco_image = {
-                    "file_name": new_jpg_name,
-                    "height": img_height,
-                    "width": img_width,
-                    "id": image_id
-                }
-                coco_images.append(coco_image)
-
-                for shape in data['shapes']:
-                    label = shape['label']
-                    if label == 'ALC条板':
-                        print(f"Label: {label}")
-                        continue
-                    
-                    category_id = shape['group_id']
-                    # category_id = 3 if category_id == 5 else (category_id-1) 
-                    # category_id = 4 if category_id == 5 else (category_id) 
-                    category_name = shape['label']
-                    if category_name not in category_set:
-                        coco_categories.append({
-                            "id": category_id,
-                            "name": category_name
-                        })
-                        category_set.add(category_name)
-                    
-                    # 使用 pycocotools 计算多边形面积
-                    points = shape['points']
-                    # COCO segmentation 格式需要一维列表
-                    segmentation = [coord for point in points for coord in point]
-                    
-                    # print(type(img_height), type(img_width))
-                    # print(type(segmentation), type(segmentation[0]), segmentation)
-                    # print(np.array(segmentation).shape)
-                    # print(np.array(segmentation).reshape(-1, 2).shape)
-                    # print(np.array(segmentation).reshape(-1, 2))
-                    # print(type(np.array(segmentation).reshape(-1, 2)))
-
-                    rle = mask.frPyObjects(np.array([segmentation], dtype=np.float64), img_height, img_width)
-                    area = float(mask.area(rle)[0])
-
-                    x_coords = [point[0] for point in shape['points']]
-                    y_coords = [point[1] for point in shape['points']]
-                    x_min, x_max = min(x_coords), max(x_coords)
-                    y_min, y_max = min(y_coords), max(y_coords)
-                    width = x_max - x_min
-                    height = y_max - y_min
-                    annotation_id += 1
-
-                    coco_annotations.append({
-                        "id": annotation_id,
-                        "image_id": coco_image["id"],
-                        "category_id": category_id,
-                        "bbox": [x_min, y_min, width, height],
-                        "area": area,
-                        "segmentation": segmentation,
-                        "iscrowd": 0
-                    })
-                    
+    store = os.path.join(store_folder, f'{folder_name}.npz') if store_folder else None
+    for rec in LabelMeStore.open(folder_path, store):
+        file_name = rec.file
+        if rec.error:
+            print(f"跳过无法解析的文件 {file_name}: {rec.error}")
+            continue
+        # new_jpg_name = f"{folder_name}_{file_name.replace('.json', '.jpg')}"
+        jpg_name = f"{file_name.replace('.json', '.jpg')}"
+        jpg_file_path = os.path.join(folder_path, jpg_name)
+        new_jpg_name = f"{folder_name}_{jpg_name}"
+        new_jpg_path = os.path.join(images_folder, new_jpg_name)
+        stage(jpg_file_path, new_jpg_path)
+
+        if data_type == 'val':
+            middle_four = jpg_name[2:6]
+
+            if middle_four not in middle_four_dict:
+                middle_four_dict[middle_four] = 1
+                image_idx = 1
+            else:
+                middle_four_dict[middle_four] += 1
+                image_idx = middle_four_dict[middle_four]
+
+        if not rec.has_shapes:  # 没有 shapes 字段的 JSON 不写入 images
+            continue
+
+        image_id = int(f"{middle_four}_{image_idx:03d}")
+        img_height = rec.height or 0
+        img_width = rec.width or 0
+
+        coco_image = {
+            "file_name": new_jpg_name,
+            "height": img_height,
+            "width": img_width,
+            "id": image_id
+        }
+        coco_images.append(coco_image)
+
+        for category_name, category_id, points, box in zip(rec.labels.tolist(), rec.group_ids.tolist(), rec.points, rec.boxes.tolist()):
+            if category_name == 'ALC条板':
+                print(f"Label: {category_name}")
+                continue
+
+            category_id = None if category_id < 0 else category_id
+            # category_id = 3 if category_id == 5 else (category_id-1) 
+            # category_id = 4 if category_id == 5 else (category_id) 
+            if category_name not in category_set:
+                coco_categories.append({
+                    "id": category_id,
+                    "name": category_name
+                })
+                category_set.add(category_name)
+
+            # 使用 pycocotools 计算多边形面积
+            # COCO segmentation 格式需要一维列表
+            segmentation = whole(points.ravel().tolist())
+            rle = mask.frPyObjects(np.array([segmentation], dtype=np.float64), img_height, img_width)
+            area = float(mask.area(rle)[0])
+
+            x_min, y_min, x_max, y_max = whole(box)
+            width = x_max - x_min
+            height = y_max - y_min
+            annotation_id += 1
+
+            coco_annotations.append({
+                "id": annotation_id,
+                "image_id": coco_image["id"],
+                "category_id": category_id,
+                "bbox": [x_min, y_min, width, height],
+                "area": area,
+                "segmentation": segmentation,
+                "iscrowd": 0
+            })
+
 # 保存 COCO 格式的 json（每张图片一个 json 文件）
 coco_json = {
     "images": coco_images,
@@ -185,3 +182,4 @@ coco_json = {
 coco_json_path = os.path.join(labels_folder, f'wuliao_{data_type}.json')
 with open(coco_json_path, 'w', encoding='utf-8') as coco_f:
     json.dump(coco_json, coco_f, ensure_ascii=False, indent=2)
+stage.report()
@@ -1,8 +1,9 @@
 import os
 import json
-import shutil
 import random
 
+from staging import Stager
+
 # 定义所有文件夹路径
 # folder_paths = [
 #     '/Users/jinyfeng/projects/ai-construction/20250426',
@@ -64,6 +65,8 @@ train_val_labels_folder = 'D:/jinyfeng/datas/shajiangche/train_val_labels'
 
 os.makedirs(train_val_images_folder, exist_ok=True)
 os.makedirs(train_val_labels_folder, exist_ok=True)
+stage = Stager("reflink")  # reflink 暂存图像（写时复制，与源数据互不影响），不支持时回退为复制
+stage_json = Stager("copy")  # 标注 JSON 可能被原地编辑，始终完整复制
 # 遍历每个文件夹路径
 for folder_path in folder_paths:
     print(f"Processing folder: {folder_path}")
@@ -79,9 +82,9 @@ for folder_path in folder_paths:
             new_jpg_name = f"{folder_name}_{jpg_name}"
 
             new_jpg_path = os.path.join(train_val_images_folder, new_jpg_name)
-            shutil.copy(jpg_file_path, new_jpg_path)
+            stage(jpg_file_path, new_jpg_path)
             new_file_path = os.path.join(train_val_labels_folder, new_jpg_name.replace('.jpg', '.json'))
-            shutil.copy(file_path, new_file_path)
+            stage_json(file_path, new_file_path)
 
             # # 打开并读取 JSON 文件
             # with open(file_path, 'r', encoding='utf-8') as f:
@@ -124,3 +127,5 @@ for folder_path in folder_paths:
             #                 group_id -= 1
             #                 out_f.write(str(group_id)+f" "+f"{x_min} {y_min} {x_max} {y_max}\n")
 
+stage.report()
+stage_json.report()
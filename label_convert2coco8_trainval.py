@@ -1,8 +1,9 @@
 import os
 import json
-import shutil
 import random
 
+from staging import Stager
+
 # 定义所有文件夹路径
 # folder_paths = [
 #     '/Users/jinyfeng/projects/ai-construction/20250426',
@@ -69,6 +70,8 @@ if not os.path.exists(val_images_folder):
     os.makedirs(val_images_folder)
 if not os.path.exists(val_labels_folder):
     os.makedirs(val_labels_folder) 
+stage = Stager("reflink")  # reflink 暂存图像（写时复制，与源数据互不影响），不支持时回退为复制
+stage_json = Stager("copy")  # 标注 JSON 可能被原地编辑，始终完整复制
 
 # 遍历每个文件夹路径
 for folder_path in folder_paths:
@@ -91,9 +94,9 @@ for folder_path in folder_paths:
         new_jpg_name = f"{folder_name}_{jpg_name}"
 
         new_jpg_path = os.path.join(train_images_folder, new_jpg_name)
-        shutil.copy(jpg_file_path, new_jpg_path)
+        stage(jpg_file_path, new_jpg_path)
         new_file_path = os.path.join(train_labels_folder, new_jpg_name.replace('.jpg', '.json'))
-        shutil.copy(file_path, new_file_path)
+        stage_json(file_path, new_file_path)
 
     for file_name in val_files:
         file_path = os.path.join(folder_path, file_name)
@@ -102,9 +105,9 @@ for folder_path in folder_paths:
         new_jpg_name = f"{folder_name}_{jpg_name}"
 
         new_jpg_path = os.path.join(val_images_folder, new_jpg_name)
-        shutil.copy(jpg_file_path, new_jpg_path)
+        stage(jpg_file_path, new_jpg_path)
         new_file_path = os.path.join(val_labels_folder, new_jpg_name.replace('.jpg', '.json'))
-        shutil.copy(file_path, new_file_path)
+        stage_json(file_path, new_file_path)
 
     # # 遍历文件夹中的所有 JSON 文件
     # for file_name in os.listdir(folder_path):
@@ -160,3 +163,5 @@ for folder_path in folder_paths:
             #                 group_id -= 1
             #                 out_f.write(str(group_id)+f" "+f"{x_min} {y_min} {x_max} {y_max}\n")
 
+stage.report()
+stage_json.report()
@@ -1,5 +1,7 @@
 # Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
 
+import contextlib
+import io
 import json
 import os
 from pathlib import Path
@@ -9,38 +11,57 @@ import yaml
 from PIL import Image
 from tqdm import tqdm
 
+from packing import LabelSink, ShardWriter
 from utils import make_dirs
 
 
-def convert(file, zip=True):
-    """Converts Labelbox JSON labels to YOLO format and saves them, with optional zipping."""
+def convert(file, zip=True, shard_size=0):
+    """
+    Converts Labelbox JSON labels to YOLO format and saves them, with optional zipping.
+
+    With `shard_size` > 0 images and labels are written straight into tar shards of at most `shard_size` bytes plus a
+    shard index under `<stem>/shards` (see packing.ShardWriter) instead of loose files, and no zip pass is needed.
+    """
     names = []  # class names
     file = Path(file)
     save_dir = make_dirs(file.stem)
     with open(file) as f:
         data = json.load(f)  # load JSON
 
-    for img in tqdm(data, desc=f"Converting {file}"):
-        im_path = img["Labeled Data"]
-        im = Image.open(requests.get(im_path, stream=True).raw if im_path.startswith("http") else im_path)  # open
-        width, height = im.size  # image size
-        label_path = save_dir / "labels" / Path(img["External ID"]).with_suffix(".txt").name
-        image_path = save_dir / "images" / img["External ID"]
-        im.save(image_path, quality=95, subsampling=0)
+    with ShardWriter(save_dir / "shards", max_size=shard_size) if shard_size else contextlib.nullcontext() as shards:
+        for img in tqdm(data, desc=f"Converting {file}"):
+            im_path = img["Labeled Data"]
+            im = Image.open(requests.get(im_path, stream=True).raw if im_path.startswith("http") else im_path)  # open
+            width, height = im.size  # image size
+            label_path = save_dir / "labels" / Path(img["External ID"]).with_suffix(".txt").name
+            image_path = save_dir / "images" / img["External ID"]
+            if shards:
+                buffer = io.BytesIO()  # encoded in memory, written into the shard with its label
+                im.save(
+                    buffer, format=Image.registered_extensions()[image_path.suffix.lower()], quality=95, subsampling=0
+                )
+            else:
+                im.save(image_path, quality=95, subsampling=0)
 
-        for label in img["Label"]["objects"]:
-            # box
-            top, left, h, w = label["bbox"].values()  # top, left, height, width
-            xywh = [(left + w / 2) / width, (top + h / 2) / height, w / width, h / height]  # xywh normalized
+            sink = LabelSink(label_path, mode="a")
+            for label in img["Label"]["objects"]:
+                # box
+                top, left, h, w = label["bbox"].values()  # top, left, height, width
+                xywh = [(left + w / 2) / width, (top + h / 2) / height, w / width, h / height]  # xywh normalized
 
-            # class
-            cls = label["value"]  # class name
-            if cls not in names:
-                names.append(cls)
+                # class
+                cls = label["value"]  # class name
+                if cls not in names:
+                    names.append(cls)
 
-            line = names.index(cls), *xywh  # YOLO format (class_index, xywh)
-            with open(label_path, "a") as f:
-                f.write(("%g " * len(line)).rstrip() % line + "\n")
+                sink.add(names.index(cls), xywh)  # YOLO format (class_index, xywh)
+            if shards:
+                files = {image_path.suffix[1:]: buffer.getvalue()}
+                if sink.rows:
+                    files["txt"] = sink.format()
+                shards.write(image_path.stem, files)
+            elif sink.rows:
+                sink.write()
 
     # Save dataset.yaml
     d = {
@@ -56,7 +77,7 @@ def convert(file, zip=True):
         yaml.dump(d, f, sort_keys=False)
 
     # Zip
-    if zip:
+    if zip and not shard_size:
         print(f"Zipping as {save_dir}.zip...")
         os.system(f"zip -qr {save_dir}.zip {save_dir}")
 
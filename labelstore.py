@@ -0,0 +1,198 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import contextlib
+import json
+import os
+from collections import defaultdict, namedtuple
+from pathlib import Path
+
+import numpy as np
+
+
+class LabelMeRecord(
+    namedtuple(
+        "LabelMeRecord", "file image_path width height labels group_ids shape_types points boxes error has_shapes"
+    )
+):
+    """
+    One annotated image of a LabelMeStore, with its shapes as columns.
+
+    `labels` and `shape_types` are string arrays, `group_ids` an int64 array (-1 where null), `points` a list of
+    per-shape (K, 2) views of the points buffer and `boxes` their (N, 4) xyxy bounding rectangles. `width` and `height`
+    are None when the JSON has no image size, `error` holds the parse error of an unreadable JSON file and `has_shapes`
+    is False when the JSON has no "shapes" key at all.
+    """
+
+    __slots__ = ()
+
+    def xywh(self):
+        """Returns the float64 (N, 4) top-left xywh boxes, computed like normalize_boxes(points, fmt='points')."""
+        b = self.boxes.astype(np.float64)
+        return np.concatenate((b[:, :2], b[:, 2:] - b[:, :2]), 1)
+
+    def shapes(self):
+        """Returns the shapes as LabelMe JSON style dicts, for code written against the JSON layout."""
+        return [
+            {"label": str(a), "points": p.tolist(), "group_id": None if g < 0 else int(g), "shape_type": str(t)}
+            for a, g, t, p in zip(self.labels, self.group_ids.tolist(), self.shape_types, self.points)
+        ]
+
+
+class LabelMeStore:
+    """
+    Columnar store of a LabelMe folder, compiled once from its per-image JSON files into one .npz file.
+
+    An image table (JSON file, imagePath, size, JSON stat signature, parse error, shapes key flag, shape offsets) and a
+    shape table (label id, group id, shape type id, point offsets, xyxy box) index one (P, 2) points buffer. The buffer
+    is float32 when that represents every coordinate exactly, else float64, so converters reading the store give the
+    same labels as from JSON. Given a store file, `open()` recompiles only the JSON files added or modified since the
+    store was written. Usage:
+
+        for x in LabelMeStore.open(json_dir, "labelme.npz"):
+            persons = x.boxes[x.labels == "person"]
+    """
+
+    VERSION = 2  # layout of the saved arrays, stores of another version are rebuilt
+
+    def __init__(self, file):
+        """Loads the arrays of a store written by save()."""
+        with np.load(file) as z:
+            for k in z.files:
+                setattr(self, k, z[k])
+
+    @classmethod
+    def open(cls, json_dir, file=None):
+        """
+        Returns the store of `json_dir`. With a `file` path the store is loaded from it, recompiled first if stale or
+        missing; without one every JSON file is parsed and nothing is written.
+        """
+        files = sorted(f for f in os.listdir(json_dir) if f.endswith(".json"))
+        stats = [(st.st_mtime_ns, st.st_size) for st in (os.stat(os.path.join(json_dir, f)) for f in files)]
+        stats = np.array(stats, dtype=np.int64).reshape(-1, 2)
+        if file is None:
+            return cls.compile(json_dir, files, stats)
+        file, old = Path(file), None
+        if file.exists():
+            with contextlib.suppress(Exception):  # unreadable or older layout, rebuild
+                old = cls(file)
+            if old is not None and int(getattr(old, "version", 0)) != cls.VERSION:
+                old = None
+        if old is not None and old.files.tolist() == files and np.array_equal(old.stats, stats):
+            return old
+        store = cls.compile(json_dir, files, stats, old)
+        store.save(file)
+        return store
+
+    @staticmethod
+    def parse(file):
+        """
+        Parses a LabelMe JSON file to (imagePath, (w, h), error, labels, group ids, types, point counts, points, has
+        shapes key).
+        """
+        try:
+            with open(file, encoding="utf-8") as f:
+                data = json.load(f)
+            shapes = data.get("shapes") or []
+            points = [np.asarray(x.get("points") or [], dtype=np.float64).reshape(-1, 2) for x in shapes]
+            size = (data.get("imageWidth", -1) or -1, data.get("imageHeight", -1) or -1)
+            return (
+                data.get("imagePath") or "",
+                size,
+                "",
+                [str(x.get("label", "")) for x in shapes],
+                [-1 if x.get("group_id") is None else int(x["group_id"]) for x in shapes],
+                [x.get("shape_type") or "polygon" for x in shapes],
+                [len(p) for p in points],
+                np.concatenate(points) if points else np.zeros((0, 2)),
+                "shapes" in data,
+            )
+        except (OSError, ValueError, TypeError, AttributeError) as e:  # unreadable, invalid JSON or malformed shapes
+            return "", (-1, -1), f"{type(e).__name__}: {e}", [], [], [], [], np.zeros((0, 2)), False
+
+    @classmethod
+    def compile(cls, json_dir, files, stats, old=None):
+        """Builds the store of `files` in `json_dir` with `stats` signatures, reusing unchanged entries of `old`."""
+        reuse = {}
+        if old is not None:
+            reuse = {f: i for i, (f, st) in enumerate(zip(old.files.tolist(), old.stats.tolist()))}
+        vocab = {"labels": {}, "types": {}}  # string -> id
+        rows = defaultdict(list)
+        for f, st in zip(files, stats.tolist()):
+            i = reuse.get(f)
+            if i is not None and old.stats[i].tolist() == st:  # unchanged, copy its rows
+                a, b = old.shape_index[i : i + 2]
+                p, q = old.point_index[a], old.point_index[b]
+                x = (old.image_paths[i], old.sizes[i], old.errors[i], old.labels[old.label_ids[a:b]],
+                     old.group_ids[a:b], old.types[old.type_ids[a:b]], np.diff(old.point_index[a : b + 1]),
+                     old.points[p:q], old.has_shapes[i])  # fmt: skip
+            else:
+                x = cls.parse(os.path.join(json_dir, f))
+            for k, v in zip(("image_paths", "sizes", "errors"), x[:3]):
+                rows[k].append(v)
+            rows["has_shapes"].append(bool(x[8]))
+            rows["n_shapes"].append(len(x[3]))
+            rows["label_ids"] += [vocab["labels"].setdefault(str(v), len(vocab["labels"])) for v in x[3]]
+            rows["group_ids"] += list(x[4])
+            rows["type_ids"] += [vocab["types"].setdefault(str(v), len(vocab["types"])) for v in x[5]]
+            rows["n_points"] += list(x[6])
+            rows["points"].append(x[7])
+
+        self = cls.__new__(cls)
+        self.version = np.array(cls.VERSION)
+        self.files, self.stats = np.array(files, dtype=str), stats
+        self.has_shapes = np.array(rows["has_shapes"], dtype=bool)
+        self.image_paths, self.errors = np.array(rows["image_paths"], dtype=str), np.array(rows["errors"], dtype=str)
+        self.sizes = np.array(rows["sizes"], dtype=np.int64).reshape(-1, 2)
+        self.shape_index = np.concatenate(([0], np.cumsum(rows["n_shapes"], dtype=np.int64)))
+        self.labels, self.types = (np.array(list(vocab[k]), dtype=str) for k in ("labels", "types"))
+        self.label_ids, self.type_ids = (np.array(rows[k], dtype=np.int32) for k in ("label_ids", "type_ids"))
+        self.group_ids = np.array(rows["group_ids"], dtype=np.int64)
+        self.point_index = np.concatenate(([0], np.cumsum(rows["n_points"], dtype=np.int64)))
+        points = np.concatenate(rows["points"]) if rows["points"] else np.zeros((0, 2))
+        if np.array_equal(points.astype(np.float32), points):
+            points = points.astype(np.float32)  # exact, half the size
+        self.points = points
+
+        # Bounding rectangles of all shapes in one pass, nan for shapes without points
+        self.boxes = np.full((len(self.group_ids), 4), np.nan, dtype=points.dtype)
+        k = np.diff(self.point_index) > 0
+        if k.any():
+            i = self.point_index[:-1][k]
+            self.boxes[k] = np.concatenate((np.minimum.reduceat(points, i), np.maximum.reduceat(points, i)), 1)
+        return self
+
+    def save(self, file):
+        """Atomically writes the store to `file`."""
+        file = Path(file)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        tmp = file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, **{k: v for k, v in vars(self).items() if isinstance(v, np.ndarray)})
+        os.replace(tmp, file)
+
+    def __len__(self):
+        """Returns the number of JSON files."""
+        return len(self.files)
+
+    def __getitem__(self, i):
+        """Returns the LabelMeRecord of the `i`-th JSON file in sorted order."""
+        a, b = self.shape_index[i], self.shape_index[i + 1]
+        pi = self.point_index[a : b + 1]
+        w, h = self.sizes[i].tolist()
+        return LabelMeRecord(
+            str(self.files[i]),
+            str(self.image_paths[i]),
+            w if w > 0 else None,
+            h if h > 0 else None,
+            self.labels[self.label_ids[a:b]],
+            self.group_ids[a:b],
+            self.types[self.type_ids[a:b]],
+            np.split(self.points[pi[0] : pi[-1]], pi[1:-1] - pi[0]) if b > a else [],
+            self.boxes[a:b],
+            str(self.errors[i]) or None,
+            bool(self.has_shapes[i]),
+        )
+
+    def __iter__(self):
+        """Yields the LabelMeRecord of every JSON file in sorted order."""
+        return (self[i] for i in range(len(self)))
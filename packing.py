@@ -0,0 +1,327 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import json
+import os
+import tarfile
+import time
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+
+class LabelSink:
+    """
+    Buffers the YOLO rows of one label file and writes them with a single formatted write.
+
+    Rows of any length (boxes or segments) are formatted by one %-operation over the whole file instead of one write per
+    box, and `atomic=True` writes a temporary file renamed over `path`, so readers never see a partial label file.
+    Usage: `with LabelSink(path) as sink: sink.add(cls, *xywh)`.
+    """
+
+    def __init__(self, path, fmt=None, mode="w", atomic=False, pack=None):
+        """
+        Creates a sink for `path`; `fmt` is a whole-row format like '%g %.6f %.6f %.6f %.6f' (default '%g' each).
+
+        With a PackedLabelWriter `pack` the rows are packed under the file name of `path` and no file is written.
+        """
+        self.path, self.fmt, self.mode, self.atomic, self.pack = Path(path), fmt, mode, atomic, pack
+        self.rows = []
+
+    def add(self, *row):
+        """Buffers one row given as values or iterables of values, e.g. add(cls, box) with box an array."""
+        self.rows.append([x for v in row for x in (np.ravel(v).tolist() if np.ndim(v) else [v])])
+
+    def extend(self, rows):
+        """Buffers several rows."""
+        for row in rows:
+            self.add(row)
+
+    def format(self):
+        """Returns the text of all buffered rows, built with a single %-format call."""
+        if not self.rows:
+            return ""
+        fmt = "\n".join(self.fmt or ("%g " * len(r)).rstrip() for r in self.rows) + "\n"
+        return fmt % tuple(x for r in self.rows for x in r)
+
+    def write(self):
+        """Writes the buffered rows to `path` in one call and clears the buffer."""
+        text = self.format()
+        if self.pack is not None:
+            self.pack.add(self.path.name, text, self.fmt, append="a" in self.mode)
+        elif self.atomic and "w" in self.mode:
+            tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp")
+            with open(tmp, self.mode) as f:
+                f.write(text)
+            os.replace(tmp, self.path)
+        else:
+            with open(self.path, self.mode) as f:
+                f.write(text)
+        self.rows = []
+
+    def __enter__(self):
+        """Returns the sink for use as a context manager that writes on a clean exit."""
+        return self
+
+    def __exit__(self, exc_type, *args):
+        """Writes the buffered rows unless the block raised."""
+        if exc_type is None:
+            self.write()
+
+
+PACKED_FORMAT = "%g %g %g %g %g"  # default row format of packed labels, as LabelSink writes 5-column rows
+
+
+def packed_index(path):
+    """Returns the offsets index path of the packed label file `path`, e.g. labels.bin -> labels.idx.npz."""
+    return Path(path).with_suffix(".idx.npz")
+
+
+class PackedLabelWriter:
+    """
+    Packs the YOLO box labels of a dataset into one memory-mappable file instead of one small .txt file per image.
+
+    Rows are appended to a temporary file as float32 [cls, cx, cy, w, h] as they arrive. close() sorts them by label
+    file name into `path` (e.g. labels.bin) and writes the int64 offsets index next to it, see PackedLabels. Rows are
+    packed from their formatted text, which float32 holds to the printed precision, so PackedLabels.export() writes the
+    same .txt files as LabelSink would have. The temporary file is opened only while rows are appended, and is deleted
+    if the `with` block raises. Usage:
+
+        with PackedLabelWriter("labels.bin") as writer, LabelSink(label_path, pack=writer) as sink:
+            sink.extend(rows)
+    """
+
+    def __init__(self, path):
+        """Starts packing into `path`."""
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp = self.path.with_name(f".{self.path.name}.{os.getpid()}.rows")
+        self.tmp.write_bytes(b"")
+        self.fmt, self.n = None, 0
+        self.segments = {}  # label file name -> [(start row, row count), ...] in arrival order
+
+    def add(self, name, text, fmt=None, append=False):
+        """Packs the formatted rows `text` of label file `name`, replacing its earlier rows unless `append`."""
+        fmt = fmt or PACKED_FORMAT
+        if self.fmt is None:
+            self.fmt = fmt
+        elif fmt != self.fmt:
+            raise ValueError(f"packed labels share one row format, got '{fmt}' after '{self.fmt}'")
+        rows = np.array(text.split(), dtype=np.float32)
+        if rows.size != 5 * text.count("\n"):
+            raise ValueError(f"{name}: packed labels hold 5-column box rows [cls, cx, cy, w, h]")
+        with open(self.tmp, "ab") as f:
+            rows.tofile(f)
+        segment = (self.n, rows.size // 5)
+        self.n += segment[1]
+        self.segments[name] = self.segments.get(name, []) + [segment] if append else [segment]
+
+    def close(self):
+        """Writes the packed rows sorted by label file name to `path` and its index, and returns `path`."""
+        data = np.fromfile(self.tmp, dtype=np.float32).reshape(-1, 5)
+        segments = [(name, *x) for name, v in self.segments.items() for x in v]
+        self.write(self.path, segments, data, self.fmt)
+        os.remove(self.tmp)
+        return self.path
+
+    @classmethod
+    def merge(cls, path, parts):
+        """Merges the packed label files `parts`, e.g. one per worker process, into `path` and deletes them."""
+        parts = [PackedLabels(p) for p in parts]
+        fmts = {p.fmt for p in parts if len(p)}
+        if len(fmts) > 1:
+            raise ValueError(f"packed labels share one row format, got {sorted(fmts)}")
+        segments, start = [], 0
+        for p in parts:
+            segments += [(name, start + a, b - a) for name, a, b in zip(p.names.tolist(), p.offsets, p.offsets[1:])]
+            start += len(p.rows)
+        data = np.concatenate([p.rows for p in parts]) if parts else np.zeros((0, 5), dtype=np.float32)
+        cls.write(path, segments, data, fmts.pop() if fmts else None)
+        for p in parts:
+            del p.rows  # release the memmap before deleting its file
+            for f in (p.path, packed_index(p.path)):
+                os.remove(f)
+        return Path(path)
+
+    @staticmethod
+    def write(path, segments, data, fmt=None):
+        """Atomically writes the rows of `segments` (name, start, count) of `data`, stably sorted by name, to `path`."""
+        segments = sorted(segments, key=lambda x: x[0])  # stable, appended rows keep their order
+        names = [x[0] for x in segments]
+        starts = np.array([x[1] for x in segments], dtype=np.int64)
+        counts = np.array([x[2] for x in segments], dtype=np.int64)
+        ends = np.cumsum(counts)
+        order = np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+        first = np.flatnonzero([i == 0 or names[i] != names[i - 1] for i in range(len(names))])
+        offsets = np.concatenate(([0], ends[first[1:] - 1], ends[-1:])).astype(np.int64)
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        index = {"names": np.array(names, dtype=str)[first], "offsets": offsets, "fmt": np.array(fmt or PACKED_FORMAT)}
+        for file, save in (
+            (path, lambda f: data[order].tofile(f)),
+            (packed_index(path), lambda f: np.savez(f, **index)),
+        ):
+            tmp = file.with_name(f".{file.name}.{os.getpid()}.tmp")
+            with open(tmp, "wb") as f:
+                save(f)
+            os.replace(tmp, file)
+
+    def __enter__(self):
+        """Returns the writer for use as a context manager that closes it on a clean exit."""
+        return self
+
+    def __exit__(self, exc_type, *args):
+        """Closes the writer, or discards the packed rows if the block raised."""
+        if exc_type is None:
+            self.close()
+        else:
+            self.tmp.unlink(missing_ok=True)
+
+
+class PackedLabels:
+    """
+    Reads a PackedLabelWriter file: every row as one read-only (N, 5) float32 memmap, sliced per label file.
+
+    `names` are the sorted label file names and rows[offsets[i]:offsets[i + 1]] the rows of names[i]. Usage:
+
+        labels = PackedLabels("labels.bin")
+        rows = labels["image_0001.txt"]  # (n, 5) cls, cx, cy, w, h
+        labels.export("labels/")  # back to one .txt file per image
+    """
+
+    def __init__(self, path):
+        """Opens the packed label file `path` and loads its index."""
+        self.path = Path(path)
+        with np.load(packed_index(path)) as z:
+            self.names, self.offsets, self.fmt = z["names"], z["offsets"], str(z["fmt"])
+        n = int(self.offsets[-1])
+        self.rows = np.memmap(self.path, dtype=np.float32, mode="r", shape=(n, 5)) if n else np.zeros((0, 5), "f4")
+
+    def __len__(self):
+        """Returns the number of label files."""
+        return len(self.names)
+
+    def __contains__(self, name):
+        """Returns True if label file `name` is packed."""
+        i = np.searchsorted(self.names, name)
+        return i < len(self.names) and self.names[i] == name
+
+    def __getitem__(self, key):
+        """Returns the (n, 5) rows of label file `key`, given by name or by index in sorted order."""
+        if isinstance(key, str):
+            if key not in self:
+                raise KeyError(key)
+            key = np.searchsorted(self.names, key)
+        return self.rows[self.offsets[key] : self.offsets[key + 1]]
+
+    def __iter__(self):
+        """Yields (name, rows) of every label file in sorted order."""
+        return ((name, self[i]) for i, name in enumerate(self.names.tolist()))
+
+    def export(self, out_dir):
+        """Writes every label file back to `out_dir` as .txt with the packed row format, and returns their number."""
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for name, rows in tqdm(self, total=len(self), desc=f"Exporting {self.path.name}"):
+            with LabelSink(out_dir / name, fmt=self.fmt) as sink:
+                sink.extend(rows)
+        return len(self)
+
+
+class ShardWriter:
+    """
+    Writes converted samples into size-bounded tar shards with a JSON index instead of a tree of loose files.
+
+    The files of a sample share its key and are stored next to each other (WebDataset layout), e.g. `img_001.jpg` and
+    `img_001.txt`, so shards are transferred and read sequentially. A new shard `<prefix>-000001.tar` is started when
+    the next sample would push the current one past `max_size` bytes or `max_count` samples. Each shard is written under
+    a temporary name and renamed when complete, and close() writes `<prefix>-index.json` with the samples, size and
+    per-sample byte offsets of every shard. Members are appended as USTAR blocks with the shard file opened only for
+    the write, and the incomplete shard is deleted if the `with` block raises. Usage:
+
+        with ShardWriter(save_dir / "shards", max_size=1 << 30) as shards:
+            shards.write("img_001", {"jpg": Path("img_001.jpg"), "txt": "0 0.5 0.5 0.2 0.2\\n"})
+    """
+
+    def __init__(self, dir, prefix="shard", max_size=1 << 30, max_count=None):
+        """Starts writing shards into `dir`; values of `files` may be bytes, str or Paths of files to store."""
+        self.dir, self.prefix, self.max_size, self.max_count = Path(dir), prefix, max_size, max_count
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.mtime = int(time.time())
+        self.shards, self.tmp, self.offset = [], None, 0  # temporary file and end offset of the open shard
+
+    @staticmethod
+    def member_size(n):
+        """Returns the bytes a member of `n` bytes occupies in a tar file: a header block plus padded data blocks."""
+        return tarfile.BLOCKSIZE + -(-n // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+    def full(self, size):
+        """Returns True if a sample of `size` tar bytes does not fit the open, non-empty shard."""
+        shard = self.shards[-1]
+        end = -(-(self.offset + size + 2 * tarfile.BLOCKSIZE) // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+        return shard["samples"] > 0 and (
+            end > self.max_size or bool(self.max_count and shard["samples"] >= self.max_count)
+        )
+
+    def write(self, key, files):
+        """Writes the sample `key` with `files` {extension: data} as members `<key>.<extension>`."""
+        data = {}
+        for ext, x in files.items():
+            if isinstance(x, Path):
+                x = x.read_bytes()
+            data[ext] = x.encode() if isinstance(x, str) else bytes(x)
+        if self.tmp is None or self.full(sum(self.member_size(len(x)) for x in data.values())):
+            self.next_shard()
+
+        shard = self.shards[-1]
+        shard["keys"].append(key)
+        shard["offsets"].append(self.offset)
+        shard["samples"] += 1
+        with open(self.tmp, "ab") as f:
+            for ext, x in data.items():
+                info = tarfile.TarInfo(f"{key}.{ext}")
+                info.size, info.mtime, info.mode = len(x), self.mtime, 0o644
+                f.write(info.tobuf(tarfile.USTAR_FORMAT, tarfile.ENCODING, "surrogateescape"))
+                f.write(x + bytes(self.member_size(len(x)) - tarfile.BLOCKSIZE - len(x)))  # data padded to blocks
+                self.offset += self.member_size(len(x))
+
+    def next_shard(self):
+        """Completes the current shard, if any, and starts the next one."""
+        self.close_shard()
+        name = f"{self.prefix}-{len(self.shards):06d}.tar"
+        self.shards.append({"name": name, "samples": 0, "size": 0, "keys": [], "offsets": []})
+        self.tmp, self.offset = self.dir / f".{name}.tmp", 0
+        self.tmp.write_bytes(b"")
+
+    def close_shard(self):
+        """Ends the current shard with the tar end-of-archive blocks, padded to a record, and renames it."""
+        if self.tmp:
+            end = -(-(self.offset + 2 * tarfile.BLOCKSIZE) // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+            with open(self.tmp, "ab") as f:
+                f.write(bytes(end - self.offset))
+            shard = self.shards[-1]
+            shard["size"] = end
+            os.replace(self.tmp, self.dir / shard["name"])
+            self.tmp = None
+
+    def close(self):
+        """Completes the last shard, writes the shard index and returns its path."""
+        self.close_shard()
+        index = self.dir / f"{self.prefix}-index.json"
+        with open(index, "w") as f:
+            json.dump({"shards": self.shards, "samples": sum(x["samples"] for x in self.shards)}, f)
+        print(f"Wrote {sum(x['samples'] for x in self.shards)} samples to {len(self.shards)} shards in {self.dir}")
+        return index
+
+    def __enter__(self):
+        """Returns the writer for use as a context manager that closes it on a clean exit."""
+        return self
+
+    def __exit__(self, exc_type, *args):
+        """Closes the writer, or deletes the incomplete shard if the block raised."""
+        if exc_type is None:
+            self.close()
+        elif self.tmp:
+            self.tmp.unlink(missing_ok=True)
+            self.tmp = None
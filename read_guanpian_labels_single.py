@@ -9,17 +9,21 @@ import argparse
 from pathlib import Path
 from PIL import Image
 import cv2
-import time
-import numpy as np
-import shutil
 
-def read_image_and_json(image_folder, json_folder, image_save_folder, label_save_folder):
+from packing import LabelSink
+from staging import Stager
+from utils import Diagnostics, normalize_boxes, unique_rows
+
+def read_image_and_json(image_folder, json_folder, image_save_folder, label_save_folder, stage_mode="reflink", report=None, strict=False):
     """
     读取图像文件夹和JSON标注文件夹，提取标注的坐标位置
     
     Args:
         image_folder (str): 图像文件夹路径
         json_folder (str): JSON标注文件夹路径
+        stage_mode (str): 图像暂存方式 hardlink/reflink/symlink/copy
+        report (str): 跳过记录的 JSONL 报告路径，默认为 <label_save_folder>_diagnostics.jsonl
+        strict (bool): 遇到第一个被跳过的文件或框即中止
     """
     
     # 检查文件夹是否存在
@@ -44,6 +48,8 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
         return
     
     print(f"找到 {len(json_files)} 个JSON标注文件")
+    diag = Diagnostics(report or os.path.normpath(label_save_folder) + "_diagnostics.jsonl", strict=strict)
+    stage = Stager(stage_mode)  # 每张图像只暂存一次，目标已相同时跳过
     
     # 遍历每个JSON文件
     for json_file in json_files:
@@ -64,8 +70,7 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
                 img_height = data['imageHeight']
                 print(f"  图像尺寸: {img_width} x {img_height}")
             else:
-                print("  警告: 图像尺寸信息缺失，跳过该文件")
-                time.sleep(60)
+                diag.skip("missing_size", json_file, "  警告: 图像尺寸信息缺失，跳过该文件")
                 continue
             # 根据JSON格式提取坐标信息
             if 'shapes' in data:
@@ -74,8 +79,7 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
                 image_filename = json_file.replace('.json', '.jpg')
                 image_path = os.path.join(image_folder, image_filename)
                 if not os.path.exists(image_path):
-                    print(f"  警告: 图像文件 '{image_filename}' 不存在，跳过显示")
-                    time.sleep(60)
+                    diag.skip("missing_image", json_file, f"  警告: 图像文件 '{image_filename}' 不存在，跳过显示", image=image_path)
                     continue
 
                 for i, shape in enumerate(data['shapes']):
@@ -87,52 +91,45 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
                         guanpian_cnt += 1
                 
                 if guanpian_cnt > 1:
-                    print(f"  警告: guanpian类别数量过多 ({guanpian_cnt} 个)，跳过该文件")
-                    time.sleep(60)
+                    diag.skip("multiple_guanpian", json_file, f"  警告: guanpian类别数量过多 ({guanpian_cnt} 个)，跳过该文件", count=guanpian_cnt)
                     continue
 
-                bboxes = []                
+                shapes = []
                 for i, shape in enumerate(data['shapes']):
                     label = shape.get('label', 'unknown')
                     label = label.lower()
                     group_id = shape.get('group_id', 'unknown')
                     print(f"    标签: {label}")
                     print(f"    组ID: {group_id}")
+                    if label == 'gp':
+                        shapes.append(shape)
+
+                # cls = int(group_id) - 1
+                boxes, valid = normalize_boxes([shape.get('points', []) for shape in shapes], img_width, img_height, fmt="points")
+
+                bboxes = []
+                for box, ok in zip(boxes, valid):
+                    if not ok:  # if w <= 0 and h <= 0
+                        diag.skip("invalid_box", json_file, f"    警告: 更新后gp框无效，跳过该框", label="gp", box=box.tolist())
+                        continue
 
-                    # cls = int(group_id) - 1
-                    points = shape.get('points', [])
-                    x_coords = [point[0] for point in points]
-                    y_coords = [point[1] for point in points]
-                    x_min, x_max = min(x_coords), max(x_coords)
-                    y_min, y_max = min(y_coords), max(y_coords)
-                    if label == 'gp':                        
-                        box = np.array([x_min, y_min, x_max-x_min, y_max-y_min], dtype=np.float64)
-                        box[:2] += box[2:] / 2  # xy top-left corner to center
-                        box[[0, 2]] /= img_width  # normalize x
-                        box[[1, 3]] /= img_height  # normalize y
-                        if box[2] <= 0 or box[3] <= 0:  # if w <= 0 and h <= 0
-                            print(f"    警告: 更新后gp框无效，跳过该框")
-                            time.sleep(60)
-                            continue
-                        
-                        cls = 0
-                        box = [cls] + box.tolist()
-                        # print(f"Box: {box}")
-                        if box not in bboxes:
-                            bboxes.append(box)
+                    cls = 0
+                    box = [cls] + box.tolist()
+                    # print(f"Box: {box}")
+                    bboxes.append(box)
 
+                bboxes = unique_rows(bboxes)  # 哈希去重，保持原有顺序
                 image_save_path = os.path.join(image_save_folder, image_filename)
-                shutil.copyfile(image_path, image_save_path)
+                stage(image_path, image_save_path)
                 label_save_path = os.path.join(label_save_folder, image_filename.replace('.jpg', '.txt'))
-                with open(label_save_path, "a+") as file:
-                    for i in range(len(bboxes)):
-                        line = (*(bboxes[i]),)  # cls, box or segments
-                        file.write(("%g " * len(line)).rstrip() % line + "\n")
+                with LabelSink(label_save_path, mode="a") as sink:
+                    sink.extend(bboxes)  # cls, box or segments
 
         except Exception as e:
-            print(f"  处理文件 {json_file} 时出错: {e}")
-            time.sleep(60)
+            diag.error(json_file, e, f"  处理文件 {json_file} 时出错: {e}")
             continue
+    stage.report()
+    diag.report()
     
 
 def main():
@@ -141,6 +138,9 @@ def main():
     parser.add_argument('--json_folder', type=str, default='/home/common_datas/jinyfeng/datas/suidao/guanpian_det/20260126/label_S20260126174446_E20260126174750', help='JSON标注文件夹路径')
     parser.add_argument('--image_save_folder', type=str, default='/home/jinyfeng/datas/suidao/guanpian_det/20260126/new_images_S20260126174446_E20260126174750', help='处理后图像保存文件夹路径')
     parser.add_argument('--label_save_folder', type=str, default='/home/jinyfeng/datas/suidao/guanpian_det/20260126/new_label_S20260126174446_E20260126174750', help='处理后JSON保存文件夹路径')
+    parser.add_argument('--stage_mode', type=str, default='reflink', choices=['hardlink', 'reflink', 'symlink', 'copy'], help='图像暂存方式')
+    parser.add_argument('--report', type=str, default=None, help='跳过记录的 JSONL 报告路径')
+    parser.add_argument('--strict', action='store_true', help='遇到第一个被跳过的文件或框即中止')
 
     args = parser.parse_args()
     
@@ -148,7 +148,7 @@ def main():
     print(f"图像文件夹: {args.image_folder}")
     print(f"JSON文件夹: {args.json_folder}")
     
-    read_image_and_json(args.image_folder, args.json_folder, args.image_save_folder, args.label_save_folder)
+    read_image_and_json(args.image_folder, args.json_folder, args.image_save_folder, args.label_save_folder, args.stage_mode, report=args.report, strict=args.strict)
     
     print("\n处理完成!")
 
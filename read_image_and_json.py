@@ -9,105 +9,21 @@ import argparse
 from pathlib import Path
 from PIL import Image
 import cv2
-import time
+import numpy as np
 
-def scale_person_bbox(x_min, y_min, x_max, y_max, img_width, img_height):
-    """
-    将类别为person的边界框高度放大1.5倍，宽度放大2倍，超出图像范围的部分忽略
-    
-    Args:
-        x_min, y_min, x_max, y_max: 原始边界框坐标
-        img_width, img_height: 图像宽度和高度
-    
-    Returns:
-        新的边界框坐标 (x_min_new, y_min_new, x_max_new, y_max_new)
-    """
-    # 计算原始中心点
-    center_x = (x_min + x_max) / 2
-    center_y = (y_min + y_max) / 2
-    
-    # 计算原始宽高
-    width = x_max - x_min
-    height = y_max - y_min
-    
-    # 放大后的宽高
-    new_width = width * 2
-    new_height = height * 1.5
-    
-    # 计算新的边界框坐标
-    x_min_new = center_x - new_width / 2
-    x_max_new = center_x + new_width / 2
-    y_min_new = center_y - new_height / 2
-    y_max_new = center_y + new_height / 2
-    
-    # 确保不超出图像边界
-    x_min_new = max(0, x_min_new)
-    x_max_new = min(img_width, x_max_new)
-    y_min_new = max(0, y_min_new)
-    y_max_new = min(img_height, y_max_new)
-    
-    return x_min_new, y_min_new, x_max_new, y_max_new
-
-# 如果aqm或fgmj有标注，更新其坐标
-def update_coords(obj_coords, person_ori_coords, person_new_coords):
-    updated_coords = []
-    for obj_bbox in obj_coords:
-        x_min_obj, y_min_obj, x_max_obj, y_max_obj = obj_bbox
-        updated = False
-        for idx, (x_min_p, y_min_p, x_max_p, y_max_p) in enumerate(person_ori_coords):
-            # 判断obj_bbox是否完全在person_ori_bbox内
-            if (x_min_obj >= x_min_p and y_min_obj >= y_min_p and
-                x_max_obj <= x_max_p and y_max_obj <= y_max_p):
-                # 计算在原person框内的相对位置
-                px0, py0, px1, py1 = x_min_p, y_min_p, x_max_p, y_max_p
-                nx0, ny0, nx1, ny1 = person_new_coords[idx]
-                pw, ph = px1 - px0, py1 - py0
-                nw, nh = nx1 - nx0, ny1 - ny0
-                # 相对比例
-                rel_xmin = (x_min_obj - px0) / pw if pw > 0 else 0
-                rel_ymin = (y_min_obj - py0) / ph if ph > 0 else 0
-                rel_xmax = (x_max_obj - px0) / pw if pw > 0 else 0
-                rel_ymax = (y_max_obj - py0) / ph if ph > 0 else 0
-                # 映射到新person框
-                x_min_new = nx0 + rel_xmin * nw
-                y_min_new = ny0 + rel_ymin * nh
-                x_max_new = nx0 + rel_xmax * nw
-                y_max_new = ny0 + rel_ymax * nh
-                updated_coords.append((x_min_new, y_min_new, x_max_new, y_max_new))
-                print(f"    坐标 {obj_bbox} 属于person框 {person_ori_coords[idx]}，更新为 {updated_coords[-1]}")
-                updated = True
-                break
-        if not updated:
-            # 没有匹配person框，保持原坐标
-            updated_coords.append(obj_bbox)
-            print(f"    坐标 {obj_bbox} 未匹配到person框，保持不变")
-    return updated_coords
+from imageio_utils import RegionReader
+from utils import Diagnostics, expand_boxes
 
-# 如果aqm或fgmj有标注，更新其坐标
-def update_coords_v1(obj_coord, person_new_coord):
-        
-    x_min_obj, y_min_obj, x_max_obj, y_max_obj = obj_coord
-    
-    # 计算在原person框内的相对位置
-    nx0, ny0, nx1, ny1 = person_new_coord
-
-    # 映射到新person框
-    x_min_new = x_min_obj - nx0
-    y_min_new = y_min_obj - ny0
-    x_max_new = x_max_obj - nx0
-    y_max_new = y_max_obj - ny0
-
-    updated_coord = (x_min_new, y_min_new, x_max_new, y_max_new)
-    
-    return updated_coord
-
-def read_image_and_json(image_folder, json_folder, image_save_folder, label_save_folder):
+def read_image_and_json(image_folder, json_folder, image_save_folder, label_save_folder, frames=None, report=None, strict=False):
     """
     读取图像文件夹和JSON标注文件夹，提取标注的坐标位置
     
     Args:
         image_folder (str): 图像文件夹路径
         json_folder (str): JSON标注文件夹路径
+        frames (FrameCache): 整帧解码缓存，可在多次调用间共享；默认新建
+        report (str): 跳过记录的 JSONL 报告路径，默认为 <label_save_folder>_diagnostics.jsonl
+        strict (bool): 遇到第一个被跳过的文件或框即中止
     """
     
     # 检查文件夹是否存在
@@ -132,6 +48,8 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
         return
     
     print(f"找到 {len(json_files)} 个JSON标注文件")
+    diag = Diagnostics(report or os.path.normpath(label_save_folder) + "_diagnostics.jsonl", strict=strict)  # 跳过原因写入 JSONL 报告
+    read = RegionReader(frames)  # 只解码裁剪所需的区域，无法局部解码时整帧解码并缓存
     
     # 遍历每个JSON文件
     coco_images = []
@@ -158,8 +76,7 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
                 img_height = data['imageHeight']
                 print(f"  图像尺寸: {img_width} x {img_height}")
             else:
-                print("  警告: 图像尺寸信息缺失，跳过该文件")
-                time.sleep(60)
+                diag.skip("missing_size", json_file, "  警告: 图像尺寸信息缺失，跳过该文件")
                 continue
             # 根据JSON格式提取坐标信息
             if 'shapes' in data:
@@ -179,11 +96,18 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
                         person_y1, person_y2 = min(y_coords), max(y_coords)
                         
                         if img_width is not None and img_height is not None:
-                            person_x1_new, person_y1_new, person_x2_new, person_y2_new = scale_person_bbox(person_x1, person_y1, person_x2, person_y2, img_width, img_height)
+                            # 宽度放大2倍、高度放大1.5倍，超出图像范围的部分忽略
+                            person_x1_new, person_y1_new, person_x2_new, person_y2_new = expand_boxes([[person_x1, person_y1, person_x2, person_y2]], img_width, img_height, scale=(2, 1.5))[0]
                         continue
                 
                 if person_cnt > 1:
-                    print(f"  警告: person类别数量过多 ({person_cnt} 个)，跳过该文件")
+                    diag.skip("multiple_person", json_file, f"  警告: person类别数量过多 ({person_cnt} 个)，跳过该文件", count=person_cnt)
+                    continue
+
+                image_filename = json_file.replace('.json', '.jpg')
+                image_path = os.path.join(image_folder, image_filename)
+                if not os.path.exists(image_path):
+                    diag.skip("missing_image", json_file, f"  警告: 图像文件 '{image_filename}' 不存在，跳过该文件", image=image_path)
                     continue
 
                 coco_image_id += 1
@@ -201,7 +125,7 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
 
                     if label == 'aqm':
                         aqm_ori_coord = (x_min, y_min, x_max, y_max)
-                        aqm_new_coord = update_coords_v1(aqm_ori_coord, (person_x1_new, person_y1_new, person_x2_new, person_y2_new))
+                        aqm_new_coord = np.subtract(aqm_ori_coord, (int(person_x1_new), int(person_y1_new)) * 2)  # 映射到裁剪图坐标
                         
                         if label != 'unknown' and group_id != 'unknown' and label not in category_set:
                             coco_categories.append({
@@ -210,6 +134,7 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
                             })
                             category_set.add(label)
                         
+                        px0, py0, px1, py1 = aqm_new_coord.tolist()
                         coco_annotations.append({
                             "id": annotation_id + 1,
                             "image_id": coco_image_id,
@@ -223,7 +148,7 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
 
                     elif label == 'fgmj':
                         fgmj_ori_coord = (x_min, y_min, x_max, y_max)
-                        fgmj_new_coord = update_coords_v1(fgmj_ori_coord, (person_x1_new, person_y1_new, person_x2_new, person_y2_new))
+                        fgmj_new_coord = np.subtract(fgmj_ori_coord, (int(person_x1_new), int(person_y1_new)) * 2)  # 映射到裁剪图坐标
                         
                         if label != 'unknown' and group_id != 'unknown' and label not in category_set:
                             coco_categories.append({
@@ -246,14 +171,7 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
                     elif label == 'person':
                         person_new_coords = (person_x1_new, person_y1_new, person_x2_new, person_y2_new)
                         
-                        image_filename = json_file.replace('.json', '.jpg')
-                        image_path = os.path.join(image_folder, image_filename)
-                        if not os.path.exists(image_path):
-                            print(f"  警告: 图像文件 '{image_filename}' 不存在，跳过显示")
-                        
-                        image = cv2.imread(image_path)
-
-                        image_crop = image[int(person_y1_new):int(person_y2_new), int(person_x1_new):int(person_x2_new)]
+                        image_crop = read(image_path, (person_x1_new, person_y1_new, person_x2_new, person_y2_new))
                         new_height, new_width = image_crop.shape[:2]
                         # new_name = f"{image_folder.split('/')[-1]}_{image_filename.replace('.jpg', '')}_{idx+1}.jpg"
                         new_name = f"{image_folder.split('/')[-1]}_{image_filename}"
@@ -266,7 +184,6 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
                         # cv2.waitKey(0)
                         # cv2.destroyAllWindows()
                         # cv2.imwrite(f"updated_{image_filename}", image_crop)
-                        time.sleep(120)
                         cv2.imwrite(os.path.join(image_save_folder, new_name), image_crop)
             
                         coco_image = {
@@ -286,8 +203,9 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
             with open(coco_json_path, 'w') as f:
                 json.dump(coco_json, f)
         except Exception as e:
-            print(f"  处理文件 {json_file} 时出错: {e}")
+            diag.error(json_file, e, f"  处理文件 {json_file} 时出错: {e}")
             continue
+    diag.report()
     
     
 
@@ -297,6 +215,8 @@ def main():
     parser.add_argument('--json_folder', type=str, default='/home/jinyfeng/datas/suidao/label_16f3d2dbf72b7506c8252dcf147f6758_raw', help='JSON标注文件夹路径')
     parser.add_argument('--image_save_folder', type=str, default='/home/jinyfeng/datas/suidao/new_16f3d2dbf72b7506c8252dcf147f6758_raw_crop', help='处理后图像保存文件夹路径')
     parser.add_argument('--label_save_folder', type=str, default='/home/jinyfeng/datas/suidao/new_label_16f3d2dbf72b7506c8252dcf147f6758_raw_crop', help='处理后JSON保存文件夹路径')
+    parser.add_argument('--report', type=str, default=None, help='跳过记录的 JSONL 报告路径')
+    parser.add_argument('--strict', action='store_true', help='遇到第一个被跳过的文件或框即中止')
 
     args = parser.parse_args()
     
@@ -304,7 +224,7 @@ def main():
     print(f"图像文件夹: {args.image_folder}")
     print(f"JSON文件夹: {args.json_folder}")
     
-    read_image_and_json(args.image_folder, args.json_folder, args.image_save_folder, args.label_save_folder)
+    read_image_and_json(args.image_folder, args.json_folder, args.image_save_folder, args.label_save_folder, report=args.report, strict=args.strict)
     
     print("\n处理完成!")
 
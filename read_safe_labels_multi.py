@@ -4,75 +4,155 @@
 """
 
 import os
-import json
 import argparse
-from pathlib import Path
-from PIL import Image
-import cv2
-import time
+import contextlib
 import numpy as np
-import shutil
+import glob
+from functools import partial
+from multiprocessing import Pool, util
 
-def scale_person_bbox(x_min, y_min, x_max, y_max, img_width, img_height):
+from imageio_utils import JPEG_SUBSAMPLING, ImageWriter, RegionReader, jpeg_mcu
+from labelstore import LabelMeStore
+from packing import LabelSink, PackedLabelWriter
+from utils import Diagnostics, crop_boxes
+
+def process_json_file(rec, image_folder, image_save_folder, label_save_folder, read, diag, writer, pack=None):
     """
-    将类别为person的边界框高度放大1.5倍，宽度放大2倍，超出图像范围的部分忽略
-    
-    Args:
-        x_min, y_min, x_max, y_max: 原始边界框坐标
-        img_width, img_height: 图像宽度和高度
-    
+    处理单个JSON文件的标注记录(LabelMeRecord)：按person分组裁剪图像并写出对应的YOLO标签
+
+    每个(源图, group_id)的裁剪图只提交一次给后台编码线程 writer，编码与下一个JSON的解析重叠；
+    pack 为 PackedLabelWriter 时标签打包写入，不写txt
+
     Returns:
-        新的边界框坐标 (x_min_new, y_min_new, x_max_new, y_max_new)
+        写出的标签文件数，跳过或出错时为0
     """
-    # 计算原始中心点
-    center_x = (x_min + x_max) / 2
-    center_y = (y_min + y_max) / 2
+    json_file = rec.file
     
-    # 计算原始宽高
-    width = x_max - x_min
-    height = y_max - y_min
-    
-    # 放大后的宽高
-    new_width = width * 1.2
-    new_height = height * 1.2
-    
-    # 计算新的边界框坐标
-    x_min_new = center_x - new_width / 2
-    x_max_new = center_x + new_width / 2
-    y_min_new = center_y - new_height / 2
-    y_max_new = center_y + new_height / 2
-    
-    # 确保不超出图像边界
-    x_min_new = max(0, x_min_new)
-    x_max_new = min(img_width, x_max_new)
-    y_min_new = max(0, y_min_new)
-    y_max_new = min(img_height, y_max_new)
-    
-    return x_min_new, y_min_new, x_max_new, y_max_new
-
-# 如果aqm或fgmj有标注，更新其坐标
-def update_coords_v1(obj_coord, person_new_coord):
+    try:
+        if rec.error:  # JSON文件无法解析
+            raise ValueError(rec.error)
         
-    x_min_obj, y_min_obj, x_max_obj, y_max_obj = obj_coord
-    
-    # 计算在原person框内的相对位置
-    nx0, ny0, nx1, ny1 = person_new_coord
+        print(f"\n处理文件: {json_file}")
+        
+        # 获取图像尺寸
+        if rec.width is not None and rec.height is not None:
+            img_width = rec.width
+            img_height = rec.height
+            print(f"  图像尺寸: {img_width} x {img_height}")
+        else:
+            diag.skip("missing_size", json_file, "  警告: 图像尺寸信息缺失，跳过该文件")
+            return 0
+        image_filename = json_file.replace('.json', '.jpg')
+        image_path = os.path.join(image_folder, image_filename)
+        if not os.path.exists(image_path):
+            diag.skip("missing_image", json_file, f"  警告: 图像文件 '{image_filename}' 不存在，跳过显示", image=image_path)
+            return 0
+
+        # 收集person与aqm/fgmj框，组ID取自标签后缀，如 person-1、aqm-1、fgmj-1
+        labels, boxes = np.char.lower(rec.labels), rec.boxes.astype(np.float64)
+        is_person = np.char.find(labels, 'person') >= 0
+        is_aqm = np.char.find(labels, 'aqm') >= 0
+        is_child = ~is_person & (is_aqm | (np.char.find(labels, 'fgmj') >= 0))
+        persons, children = boxes[is_person], boxes[is_child]
+        person_ids = [x.split('-')[1] for x in labels[is_person].tolist()]
+        child_ids = [x.split('-')[1] for x in labels[is_child].tolist()]
+        child_labels = np.where(is_aqm[is_child], 'aqm', 'fgmj').tolist()
+
+        # 如果person的宽度低于61，则舍弃
+        keep = persons[:, 2] - persons[:, 0] >= 61       # 63/65/75
+        for i in np.flatnonzero(~keep):
+            print(f"{json_file} person-{person_ids[i]} width is small !")
+        group_list = [x for x, k in zip(person_ids, keep) if k]
+        print(f'group_list:{group_list}')
+
+        # 无损裁剪时裁剪框起点对齐到JPEG的MCU网格，裁剪图不经解码和重新编码直接生成
+        align = (writer.lossless and jpeg_mcu(image_path)) or (1, 1)
+        # 所有person框一次放大1.2倍并裁剪到图像内，aqm/fgmj按组ID归属并映射为裁剪图内的归一化坐标
+        crops, assign, boxes = crop_boxes(persons[keep], children, img_width, img_height, scale=(1.2, 1.2),
+                                          person_ids=group_list, child_ids=child_ids, align=align)
+
+        sinks = {}  # new_name -> LabelSink，每个标签文件只写一次
+        for label, i, box in zip(child_labels, assign, boxes):
+            if i < 0:  # 没有找到对应group_id的person，跳过该框
+                continue
+            if box[2] <= 0 or box[3] <= 0:  # if w <= 0 and h <= 0
+                diag.skip("invalid_box", json_file, f"    警告: 更新后{label}框无效，跳过该框", label=label, box=box.tolist())
+                continue
+            if box[0] > 1 or box[0] < 0 or box[1] > 1 or box[1] < 0:
+                diag.skip("box_out_of_range", json_file, f"    警告: 更新后{label}框坐标超出范围，跳过该框", label=label, box=box.tolist())
+                continue
 
-    # 映射到新person框
-    x_min_new = x_min_obj - nx0
-    y_min_new = y_min_obj - ny0
-    x_max_new = x_max_obj - nx0
-    y_max_new = y_max_obj - ny0
+            group_id = group_list[i]
+            stem = image_filename.replace('.jpg', '_' + str(group_id))
+            new_name = f"{image_folder.split('/')[-1]}_{stem}.jpg"
+            if new_name not in sinks:
+                # 每个组的裁剪图只编码一次，由后台线程写盘；可无损裁剪时不解码
+                writer(os.path.join(image_save_folder, new_name), partial(decode, read, image_path, crops[i]),
+                       src=image_path, box=crops[i])
+                label_save_path = os.path.join(label_save_folder, new_name.replace('.jpg', '.txt'))
+                sinks[new_name] = LabelSink(label_save_path, pack=pack)
+            sinks[new_name].add(0 if label == 'aqm' else 1, box)  # cls, box or segments
 
-    return x_min_new, y_min_new, x_max_new, y_max_new
-    
-def read_image_and_json(image_folder, json_folder, image_save_folder, label_save_folder):
+        for sink in sinks.values():
+            sink.write()
+        return len(sinks)
+
+    except Exception as e:
+        diag.error(json_file, e, f"  处理文件 {json_file} 时出错: {e}")
+    return 0
+
+
+def decode(read, image_path, box):
+    """只解码裁剪区域，或返回整帧缓存的只读视图；无法读取时报错"""
+    image_crop = read(image_path, box)
+    if image_crop is None:
+        raise OSError(f"无法读取图像: {image_path}")
+    return image_crop
+
+
+def init_worker(report, strict, encode, pack):
+    """进程池初始化：每个工作进程拥有自己的区域解码器和帧缓存、后台编码线程、逐行落盘的跳过日志和标签打包文件"""
+    global worker_read, worker_diag, worker_writer, worker_pack
+    worker_read = RegionReader()
+    worker_diag = Diagnostics(worker_file(report, os.getppid(), os.getpid()), strict=strict)
+    worker_writer = ImageWriter(threads=1, **encode)
+    util.Finalize(None, close_writer, args=(worker_writer, worker_diag), exitpriority=10)  # 进程正常退出前写完剩余图像
+    worker_pack = PackedLabelWriter(worker_file(pack, os.getppid(), os.getpid())) if pack else None
+    if worker_pack:
+        util.Finalize(worker_pack, worker_pack.close, exitpriority=10)  # 进程正常退出前写出打包标签，由主进程合并
+
+
+def close_writer(writer, diag):
+    """等待后台编码线程写完所有裁剪图，写盘失败的图像计入跳过记录"""
+    for path, e in writer.close().items():
+        diag.record("write_failed", path, f"  写出图像 {path} 失败: {e}", error=repr(e))
+
+
+def worker_file(path, ppid, pid="*"):
+    """返回工作进程的跳过日志或标签打包文件的路径（pid 为 '*' 时为匹配本次运行所有工作进程文件的模式）"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{ppid}-{pid}{ext}"
+
+
+def process_json_task(args):
+    """进程池任务：处理一个JSON文件，返回写出的标签文件数"""
+    return process_json_file(*args, worker_read, worker_diag, worker_writer, worker_pack)
+
+
+def read_image_and_json(image_folder, json_folder, image_save_folder, label_save_folder, frames=None, report=None, strict=False, workers=0, encode=None, store=None, pack=False):
     """
     读取图像文件夹和JSON标注文件夹，提取标注的坐标位置
     
     Args:
         image_folder (str): 图像文件夹路径
         json_folder (str): JSON标注文件夹路径
+        frames (FrameCache): 整帧解码缓存，可在多次调用间共享；默认新建
+        report (str): 跳过记录的 JSONL 报告路径，默认为 <label_save_folder>_diagnostics.jsonl
+        strict (bool): 遇到第一个被跳过的文件或框即中止
+        workers (int): 进程池大小，0 为单进程；输出文件名与单进程完全一致
+        encode (dict): 裁剪图的写出设置，即 ImageWriter 的 fmt/quality/subsampling/compression/lossless 参数
+        store (str): 标注列存缓存(LabelMeStore)路径，默认不缓存，每次解析全部JSON文件
+        pack (bool): 所有标签打包写入可内存映射的 <label_save_folder>.bin(见 packing.PackedLabels)，不再每个裁剪图写一个txt
     """
     
     # 检查文件夹是否存在
@@ -89,237 +169,53 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
     if not os.path.exists(label_save_folder):
         os.makedirs(label_save_folder)
     
-    # 获取所有JSON文件
-    json_files = [f for f in os.listdir(json_folder) if f.endswith('.json')]
+    # 获取所有JSON文件(按文件名排序)，标注从列存缓存读取，只重新解析上次运行后新增或修改的JSON
+    records = LabelMeStore.open(json_folder, store)
+    json_files = records.files.tolist()
     
     if not json_files:
         print(f"警告: 在 '{json_folder}' 中没有找到JSON文件")
         return
     
     print(f"找到 {len(json_files)} 个JSON标注文件")
-    
-    # 遍历每个JSON文件
-    for json_file in json_files:
-        json_path = os.path.join(json_folder, json_file)
-        
+    report = report or os.path.normpath(label_save_folder) + "_diagnostics.jsonl"
+    diag = Diagnostics(report, strict=strict)
+    n_labels = 0
+    encode = encode or {}
+    pack = os.path.normpath(label_save_folder) + ".bin" if pack else None
+
+    if workers > 0:
+        # 多进程：每个标注记录独立解码、裁剪和写盘，结果按文件顺序返回；
+        # 各进程的跳过记录逐行写入各自的日志，进程崩溃也不会丢失，结束后合并进总报告
+        tasks = [(rec, image_folder, image_save_folder, label_save_folder) for rec in records]
+        pool = Pool(workers, initializer=init_worker, initargs=(report, strict, encode, pack))
         try:
-            # 读取JSON文件
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            print(f"\n处理文件: {json_file}")
-            
-            # 获取图像尺寸
-            img_width = None
-            img_height = None
-            if 'imageWidth' in data and 'imageHeight' in data:
-                img_width = data['imageWidth']
-                img_height = data['imageHeight']
-                print(f"  图像尺寸: {img_width} x {img_height}")
-            else:
-                print("  警告: 图像尺寸信息缺失，跳过该文件")
-                time.sleep(60)
-                continue
-            # 根据JSON格式提取坐标信息
-            if 'shapes' in data:
-                person_cnt = 0
-                person_x1, person_x2 = 0, 0
-                person_y1, person_y2 = 0, 0
-                person_x1_new, person_y1_new, person_x2_new, person_y2_new = 0, 0, 0, 0
-                
-                new_crop_height, new_crop_width = 0, 0
-                image_filename = json_file.replace('.json', '.jpg')
-                image_path = os.path.join(image_folder, image_filename)
-                if not os.path.exists(image_path):
-                    print(f"  警告: 图像文件 '{image_filename}' 不存在，跳过显示")
-                    time.sleep(60)
-                    continue
-
-                group_list = []
-                # 初始化一个字典，用于根据group_id存储new_crop_height, new_crop_width, image_crop, new_name等信息
-                group_info_list = []
-                for i, shape in enumerate(data['shapes']):
-                    label = shape.get('label', 'unknown')
-                    label = label.lower()
-                    # person类别处理
-                    if 'person' in label:
-                        person_cnt += 1
-                        group_id = label.split('-')[1]
-                        # print('group_id=======', group_id)
-                        
-                        points = shape.get('points', [])
-                        x_coords = [point[0] for point in points]
-                        y_coords = [point[1] for point in points]
-                        person_x1, person_x2 = min(x_coords), max(x_coords)
-                        person_y1, person_y2 = min(y_coords), max(y_coords)
-                        person_width = person_x2-person_x1
-                        
-                        # 如果person的宽度低于61，则舍弃
-                        if person_width < 61:       # 63/65/75
-                            print(f"{json_file} {label} width is small !")
-                            continue
-                        
-                        group_list.append(group_id)                        
-                        
-                        if img_width is not None and img_height is not None:
-                            person_x1_new, person_y1_new, person_x2_new, person_y2_new = scale_person_bbox(person_x1, person_y1, person_x2, person_y2, img_width, img_height)                            
-                            person_new_coords = (person_x1_new, person_y1_new, person_x2_new, person_y2_new)
-                            image = cv2.imread(image_path)
-                            image_crop = image[int(person_y1_new):int(person_y2_new), int(person_x1_new):int(person_x2_new)]
-                            new_crop_height, new_crop_width = image_crop.shape[:2]
-                            
-                            # new_name = f"{image_folder.split('/')[-1]}_{image_filename.replace('.jpg', '')}_{idx+1}.jpg"
-                            new_name = f"{image_folder.split('/')[-1]}_{image_filename.replace('.jpg', "_"+str(group_id))}.jpg"
-                            # print('new_name=======', new_name)
-                            
-                            group_info_list.append({
-                                "group_id": group_id,
-                                "new_crop_height": new_crop_height,
-                                "new_crop_width": new_crop_width,
-                                "image_crop": image_crop,
-                                "new_name": new_name,
-                                "person_new_coords": person_new_coords
-                            })
-
-                            # cv2.rectangle(image_crop, (int(aqm_new_coord[0]), int(aqm_new_coord[1])), 
-                            #               (int(aqm_new_coord[2]), int(aqm_new_coord[3])), (0, 255, 0), 2)
-                            # cv2.rectangle(image_crop, (int(fgmj_new_coord[0]), int(fgmj_new_coord[1])), 
-                            #               (int(fgmj_new_coord[2]), int(fgmj_new_coord[3])), (255, 0, 0), 2)
-                            # cv2.imshow("Image", image)
-                            # cv2.waitKey(0)
-                            # cv2.destroyAllWindows()
-                            # cv2.imwrite(f"updated_{image_filename}", image_crop)
-                            # time.sleep(120)
-                            # cv2.imwrite(os.path.join(image_save_folder, new_name), image_crop)                        
-                
-                print(f'group_list:{group_list}')
-                # time.sleep(120)
-
-                bboxes = []                
-                for i, shape in enumerate(data['shapes']):
-                    label = shape.get('label', 'unknown')
-                    label = label.lower()
-
-                    group_id = label.split('-')[1]
-                    print(f"    标签: {label}")
-                    print(f"    组ID: {group_id}")
-                    # cls = int(group_id) - 1
-                    points = shape.get('points', [])
-                    x_coords = [point[0] for point in points]
-                    y_coords = [point[1] for point in points]
-                    x_min, x_max = min(x_coords), max(x_coords)
-                    y_min, y_max = min(y_coords), max(y_coords)
-                    
-                    group_info = next((info for info in group_info_list if info["group_id"] == group_id), None)
-                    if group_info is None:
-                        # print(f"    警告: 没有找到对应的group_id {group_id} 的person信息，跳过该框")
-                        # time.sleep(120)
-                        continue
-
-                    if 'aqm' in label:
-                        if group_id in group_list:
-                            print(f"{group_id} in {group_list}")
-                            
-                            new_crop_height = group_info["new_crop_height"]
-                            new_crop_width = group_info["new_crop_width"]
-                            image_crop = group_info["image_crop"]
-                            new_name = group_info["new_name"]
-                            person_new_coords = group_info["person_new_coords"]
-                            # print(f"    person_new_coords: {person_new_coords}")
-                            # time.sleep(120)
-                            aqm_ori_coord = (x_min, y_min, x_max, y_max)
-                            # print(f"    aqm_ori_coord: {aqm_ori_coord}")
-                            x_min_new, y_min_new, x_max_new, y_max_new = update_coords_v1(aqm_ori_coord, (person_new_coords[0], person_new_coords[1], person_new_coords[2], person_new_coords[3]))
-                            # print(f"    aqm_new_coord: {(x_min_new, y_min_new, x_max_new, y_max_new)}")
-                            # if image_crop is not None:
-                            #     cv2.rectangle(image_crop, (int(x_min_new), int(y_min_new)), 
-                            #                   (int(x_max_new), int(y_max_new)), (0, 255, 0), 2)
-                            #     cv2.imwrite(f"debug_aqm_{image_filename}", image_crop)
-                            #     time.sleep(120)
-                            box = np.array([x_min_new, y_min_new, x_max_new-x_min_new, y_max_new-y_min_new], dtype=np.float64)
-                            # print(f"    box (xywh): {box}")
-                            box[:2] += box[2:] / 2  # xy top-left corner to center
-                            # print(f"    box (cxcywh): {box}")
-                            box[[0, 2]] /= new_crop_width  # normalize x
-                            box[[1, 3]] /= new_crop_height  # normalize y
-                            if box[2] <= 0 or box[3] <= 0:  # if w <= 0 and h <= 0
-                                print(f"    警告: 更新后aqm框无效，跳过该框")
-                                time.sleep(60)
-                                continue
-                            if box[0] > 1 or box[0] < 0 or box[1] > 1 or box[1] < 0:
-                                print(f"    警告: 更新后aqm框坐标超出范围，跳过该框")
-                                # print(f"    box: {box}", f"new_crop_width: {new_crop_width}", f"new_crop_height: {new_crop_height}")
-                                time.sleep(60)
-                                continue
-                            
-                            cls = 0
-                            box = [cls] + box.tolist()
-                            # print(f"Box: {box}")
-                            if box not in bboxes:
-                                bboxes.append(box)
-
-                            cv2.imwrite(os.path.join(image_save_folder, new_name), image_crop)
-
-                            label_save_path = os.path.join(label_save_folder, new_name.replace('.jpg', '.txt'))
-                            with open(label_save_path, "a+") as file:
-                                line = (*(box),)  # cls, box or segments
-                                file.write(("%g " * len(line)).rstrip() % line + "\n")
-                                # for i in range(len(bboxes)):
-                                #     line = (*(bboxes[i]),)  # cls, box or segments
-                                #     file.write(("%g " * len(line)).rstrip() % line + "\n")
-                        
-                    elif 'fgmj' in label:
-                        if group_id in group_list:
-                            print(f"{group_id} in {group_list}")
-                            # time.sleep(120)
-
-                            new_crop_height = group_info["new_crop_height"]
-                            new_crop_width = group_info["new_crop_width"]
-                            image_crop = group_info["image_crop"]
-                            new_name = group_info["new_name"]
-                            person_new_coords = group_info["person_new_coords"]
-
-                            fgmj_ori_coord = (x_min, y_min, x_max, y_max)
-                            x_min_new, y_min_new, x_max_new, y_max_new  = update_coords_v1(fgmj_ori_coord, (person_new_coords[0], person_new_coords[1], person_new_coords[2], person_new_coords[3]))
-                            # if image_crop is not None:
-                            #     cv2.rectangle(image_crop, (int(x_min_new), int(y_min_new)), 
-                            #                   (int(x_max_new), int(y_max_new)), (0, 255, 0), 2)
-                            #     cv2.imwrite(f"debug_fgmj_{image_filename}", image_crop)
-                            #     time.sleep(120)
-                            box = np.array([x_min_new, y_min_new, x_max_new-x_min_new, y_max_new-y_min_new], dtype=np.float64)
-                            box[:2] += box[2:] / 2  # xy top-left corner to center
-                            box[[0, 2]] /= new_crop_width  # normalize x
-                            box[[1, 3]] /= new_crop_height  # normalize y
-                            if box[2] <= 0 or box[3] <= 0:  # if w <= 0 and h <= 0
-                                print(f"    警告: 更新后fgmj框无效，跳过该框")
-                                time.sleep(60)
-                                continue
-                            if box[0] > 1 or box[0] < 0 or box[1] > 1 or box[1] < 0:
-                                print(f"    警告: 更新后fgmj框坐标超出范围，跳过该框")
-                                print(f"    box: {box}")
-                                time.sleep(60)
-                                continue
-                            cls = 1
-                            box = [cls] + box.tolist()
-                            # print(f"Box: {box}")
-                            # if box not in bboxes:
-                            #     bboxes.append(box)
-                            
-                            cv2.imwrite(os.path.join(image_save_folder, new_name), image_crop)
-                            
-                            label_save_path = os.path.join(label_save_folder, new_name.replace('.jpg', '.txt'))
-                            with open(label_save_path, "a+") as file:
-                                line = (*(box),)  # cls, box or segments
-                                file.write(("%g " * len(line)).rstrip() % line + "\n")
-                                # for i in range(len(bboxes)):
-                                #     line = (*(bboxes[i]),)  # cls, box or segments
-                                #     file.write(("%g " * len(line)).rstrip() % line + "\n")
-
+            for n in pool.imap(process_json_task, tasks, chunksize=8):
+                n_labels += n
+            pool.close()  # 正常关闭，工作进程退出前写完排队的裁剪图
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            diag.merge(sorted(glob.glob(worker_file(report, os.getpid()))))
+        if pack:
+            PackedLabelWriter.merge(pack, sorted(glob.glob(worker_file(pack, os.getpid()))))
+    else:
+        read = RegionReader(frames)  # 只解码裁剪所需的区域，无法局部解码时整帧解码并缓存
+        writer = ImageWriter(**encode)  # JPEG编码在后台线程进行
+        try:
+            # 出错时丢弃未写完的打包标签
+            with PackedLabelWriter(pack) if pack else contextlib.nullcontext() as packer:
+                # 遍历每个JSON文件
+                for rec in records:
+                    n_labels += process_json_file(rec, image_folder, image_save_folder, label_save_folder, read, diag, writer, packer)
+        finally:
+            close_writer(writer, diag)
+        writer.report()
 
-        except Exception as e:
-            print(f"  处理文件 {json_file} 时出错: {e}")
-            time.sleep(60)
-            continue
+    print(f"\n汇总: {len(json_files)} 个JSON文件，写出 {n_labels} 个标签文件")
+    diag.report()
     
     
 
@@ -330,6 +226,15 @@ def main():
     parser.add_argument('--json_folder', type=str, default='/home/jinyfeng/datas/suidao/safe_det/labels_2897f7c79704abf07bf74d05ed0e585a_raw_v2', help='JSON标注文件夹路径')
     parser.add_argument('--image_save_folder', type=str, default='/home/jinyfeng/datas/suidao/safe_det/new_2897f7c79704abf07bf74d05ed0e585a_raw_crop', help='处理后图像保存文件夹路径')
     parser.add_argument('--label_save_folder', type=str, default='/home/jinyfeng/datas/suidao/safe_det/new_labels_2897f7c79704abf07bf74d05ed0e585a_raw_crop', help='处理后JSON保存文件夹路径')
+    parser.add_argument('--report', type=str, default=None, help='跳过记录的 JSONL 报告路径')
+    parser.add_argument('--strict', action='store_true', help='遇到第一个被跳过的文件或框即中止')
+    parser.add_argument('--workers', type=int, default=0, help='进程池大小，0 为单进程')
+    parser.add_argument('--format', type=str, default=None, choices=['jpg', 'png', 'webp'], help='裁剪图输出格式，默认与文件名一致(jpg)')
+    parser.add_argument('--quality', type=int, default=None, help='JPEG/WebP 编码质量 0-100')
+    parser.add_argument('--subsampling', type=str, default=None, choices=list(JPEG_SUBSAMPLING), help='JPEG 色度抽样')
+    parser.add_argument('--store', type=str, default=None, help='标注列存缓存(LabelMeStore)路径，默认不缓存')
+    parser.add_argument('--pack', action='store_true', help='标签打包写入 <label_save_folder>.bin，不再每个裁剪图写一个txt')
+    parser.add_argument('--lossless_crop', action='store_true', help='裁剪框对齐到MCU网格并用jpegtran无损裁剪JPEG')
     
     
     args = parser.parse_args()
@@ -338,7 +243,8 @@ def main():
     print(f"图像文件夹: {args.image_folder}")
     print(f"JSON文件夹: {args.json_folder}")
     
-    read_image_and_json(args.image_folder, args.json_folder, args.image_save_folder, args.label_save_folder)
+    read_image_and_json(args.image_folder, args.json_folder, args.image_save_folder, args.label_save_folder, report=args.report, strict=args.strict, workers=args.workers, store=args.store, pack=args.pack,
+                        encode={"fmt": args.format, "quality": args.quality, "subsampling": args.subsampling, "lossless": args.lossless_crop})
     
     print("\n处理完成!")
 
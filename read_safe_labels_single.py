@@ -4,110 +4,28 @@
 """
 
 import os
-import json
 import argparse
-from pathlib import Path
-from PIL import Image
+import contextlib
 import cv2
-import time
 import numpy as np
-import shutil
 
-def scale_person_bbox(x_min, y_min, x_max, y_max, img_width, img_height):
-    """
-    将类别为person的边界框高度放大1.5倍，宽度放大2倍，超出图像范围的部分忽略
-    
-    Args:
-        x_min, y_min, x_max, y_max: 原始边界框坐标
-        img_width, img_height: 图像宽度和高度
-    
-    Returns:
-        新的边界框坐标 (x_min_new, y_min_new, x_max_new, y_max_new)
-    """
-    # 计算原始中心点
-    center_x = (x_min + x_max) / 2
-    center_y = (y_min + y_max) / 2
-    
-    # 计算原始宽高
-    width = x_max - x_min
-    height = y_max - y_min
-    
-    # 放大后的宽高
-    new_width = width * 1.2
-    new_height = height * 1.2
-    
-    # 计算新的边界框坐标
-    x_min_new = center_x - new_width / 2
-    x_max_new = center_x + new_width / 2
-    y_min_new = center_y - new_height / 2
-    y_max_new = center_y + new_height / 2
-    
-    # 确保不超出图像边界
-    x_min_new = max(0, x_min_new)
-    x_max_new = min(img_width, x_max_new)
-    y_min_new = max(0, y_min_new)
-    y_max_new = min(img_height, y_max_new)
-    
-    return x_min_new, y_min_new, x_max_new, y_max_new
+from imageio_utils import RegionReader
+from labelstore import LabelMeStore
+from packing import LabelSink, PackedLabelWriter
+from utils import Diagnostics, crop_boxes, unique_rows
 
-# 如果aqm或fgmj有标注，更新其坐标
-def update_coords(obj_coords, person_ori_coords, person_new_coords):
-    updated_coords = []
-    for obj_bbox in obj_coords:
-        x_min_obj, y_min_obj, x_max_obj, y_max_obj = obj_bbox
-        updated = False
-        for idx, (x_min_p, y_min_p, x_max_p, y_max_p) in enumerate(person_ori_coords):
-            # 判断obj_bbox是否完全在person_ori_bbox内
-            if (x_min_obj >= x_min_p and y_min_obj >= y_min_p and
-                x_max_obj <= x_max_p and y_max_obj <= y_max_p):
-                # 计算在原person框内的相对位置
-                px0, py0, px1, py1 = x_min_p, y_min_p, x_max_p, y_max_p
-                nx0, ny0, nx1, ny1 = person_new_coords[idx]
-                pw, ph = px1 - px0, py1 - py0
-                nw, nh = nx1 - nx0, ny1 - ny0
-                # 相对比例
-                rel_xmin = (x_min_obj - px0) / pw if pw > 0 else 0
-                rel_ymin = (y_min_obj - py0) / ph if ph > 0 else 0
-                rel_xmax = (x_max_obj - px0) / pw if pw > 0 else 0
-                rel_ymax = (y_max_obj - py0) / ph if ph > 0 else 0
-                # 映射到新person框
-                x_min_new = nx0 + rel_xmin * nw
-                y_min_new = ny0 + rel_ymin * nh
-                x_max_new = nx0 + rel_xmax * nw
-                y_max_new = ny0 + rel_ymax * nh
-                updated_coords.append((x_min_new, y_min_new, x_max_new, y_max_new))
-                print(f"    坐标 {obj_bbox} 属于person框 {person_ori_coords[idx]}，更新为 {updated_coords[-1]}")
-                updated = True
-                break
-        if not updated:
-            # 没有匹配person框，保持原坐标
-            updated_coords.append(obj_bbox)
-            print(f"    坐标 {obj_bbox} 未匹配到person框，保持不变")
-    return updated_coords
-
-# 如果aqm或fgmj有标注，更新其坐标
-def update_coords_v1(obj_coord, person_new_coord):
-        
-    x_min_obj, y_min_obj, x_max_obj, y_max_obj = obj_coord
-    
-    # 计算在原person框内的相对位置
-    nx0, ny0, nx1, ny1 = person_new_coord
-
-    # 映射到新person框
-    x_min_new = x_min_obj - nx0
-    y_min_new = y_min_obj - ny0
-    x_max_new = x_max_obj - nx0
-    y_max_new = y_max_obj - ny0
-
-    return x_min_new, y_min_new, x_max_new, y_max_new
-    
-def read_image_and_json(image_folder, json_folder, image_save_folder, label_save_folder):
+def read_image_and_json(image_folder, json_folder, image_save_folder, label_save_folder, frames=None, report=None, strict=False, store=None, pack=False):
     """
     读取图像文件夹和JSON标注文件夹，提取标注的坐标位置
     
     Args:
         image_folder (str): 图像文件夹路径
         json_folder (str): JSON标注文件夹路径
+        frames (FrameCache): 整帧解码缓存，可在多次调用间共享；默认新建
+        report (str): 跳过记录的 JSONL 报告路径，默认为 <label_save_folder>_diagnostics.jsonl
+        strict (bool): 遇到第一个被跳过的文件或框即中止
+        store (str): 标注列存缓存(LabelMeStore)路径，默认不缓存，每次解析全部JSON文件
+        pack (bool): 所有标签打包写入可内存映射的 <label_save_folder>.bin(见 packing.PackedLabels)，不再每张图写一个txt
     """
     
     # 检查文件夹是否存在
@@ -124,169 +42,83 @@ def read_image_and_json(image_folder, json_folder, image_save_folder, label_save
     if not os.path.exists(label_save_folder):
         os.makedirs(label_save_folder)
     
-    # 获取所有JSON文件
-    json_files = [f for f in os.listdir(json_folder) if f.endswith('.json')]
+    # 获取所有JSON文件，标注从列存缓存读取，只重新解析上次运行后新增或修改的JSON
+    records = LabelMeStore.open(json_folder, store)
+    json_files = records.files.tolist()
     
     if not json_files:
         print(f"警告: 在 '{json_folder}' 中没有找到JSON文件")
         return
     
     print(f"找到 {len(json_files)} 个JSON标注文件")
-    
-    # 遍历每个JSON文件
-    for json_file in json_files:
-        json_path = os.path.join(json_folder, json_file)
+    diag = Diagnostics(report or os.path.normpath(label_save_folder) + "_diagnostics.jsonl", strict=strict)
+    read = RegionReader(frames)  # 只解码裁剪所需的区域，无法局部解码时整帧解码并缓存
+    pack_file = os.path.normpath(label_save_folder) + ".bin"
+    # 出错或 strict 模式中止时丢弃未写完的打包标签
+    with PackedLabelWriter(pack_file) if pack else contextlib.nullcontext() as packer:
+        # 遍历每个JSON文件
+        for rec in records:
+            json_file = rec.file
         
-        try:
-            # 读取JSON文件
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            try:
+                if rec.error:  # JSON文件无法解析
+                    raise ValueError(rec.error)
             
-            print(f"\n处理文件: {json_file}")
+                print(f"\n处理文件: {json_file}")
             
-            # 获取图像尺寸
-            img_width = None
-            img_height = None
-            if 'imageWidth' in data and 'imageHeight' in data:
-                img_width = data['imageWidth']
-                img_height = data['imageHeight']
-                print(f"  图像尺寸: {img_width} x {img_height}")
-            else:
-                print("  警告: 图像尺寸信息缺失，跳过该文件")
-                time.sleep(60)
-                continue
-            # 根据JSON格式提取坐标信息
-            if 'shapes' in data:
-                person_cnt = 0
-                person_x1, person_x2 = 0, 0
-                person_y1, person_y2 = 0, 0
-                person_x1_new, person_y1_new, person_x2_new, person_y2_new = 0, 0, 0, 0
-                
-                new_crop_height, new_crop_width = 0, 0
+                # 获取图像尺寸
+                img_width = rec.width
+                img_height = rec.height
+                if img_width is not None and img_height is not None:
+                    print(f"  图像尺寸: {img_width} x {img_height}")
+                else:
+                    diag.skip("missing_size", json_file, "  警告: 图像尺寸信息缺失，跳过该文件")
+                    continue
+                # 根据JSON格式提取坐标信息
                 image_filename = json_file.replace('.json', '.jpg')
                 image_path = os.path.join(image_folder, image_filename)
                 if not os.path.exists(image_path):
-                    print(f"  警告: 图像文件 '{image_filename}' 不存在，跳过显示")
-                    time.sleep(60)
+                    diag.skip("missing_image", json_file, f"  警告: 图像文件 '{image_filename}' 不存在，跳过显示", image=image_path)
                     continue
 
-                for i, shape in enumerate(data['shapes']):
-                    label = shape.get('label', 'unknown')
-                    label = label.lower()
-                    group_id = shape.get('group_id', 'unknown')
-                    # person类别处理
-                    if label == 'person':
-                        person_cnt += 1
-                        points = shape.get('points', [])
-                        x_coords = [point[0] for point in points]
-                        y_coords = [point[1] for point in points]
-                        person_x1, person_x2 = min(x_coords), max(x_coords)
-                        person_y1, person_y2 = min(y_coords), max(y_coords)
-                        
-                        if img_width is not None and img_height is not None:
-                            person_x1_new, person_y1_new, person_x2_new, person_y2_new = scale_person_bbox(person_x1, person_y1, person_x2, person_y2, img_width, img_height)                            
-                            person_new_coords = (person_x1_new, person_y1_new, person_x2_new, person_y2_new)
-                            image = cv2.imread(image_path)
-                            image_crop = image[int(person_y1_new):int(person_y2_new), int(person_x1_new):int(person_x2_new)]
-                            new_crop_height, new_crop_width = image_crop.shape[:2]
-                            
-                            # new_name = f"{image_folder.split('/')[-1]}_{image_filename.replace('.jpg', '')}_{idx+1}.jpg"
-                            new_name = f"{image_folder.split('/')[-1]}_{image_filename}"
-                            print('new_name=======', new_name)
-                            
-                            # cv2.rectangle(image_crop, (int(aqm_new_coord[0]), int(aqm_new_coord[1])), 
-                            #               (int(aqm_new_coord[2]), int(aqm_new_coord[3])), (0, 255, 0), 2)
-                            # cv2.rectangle(image_crop, (int(fgmj_new_coord[0]), int(fgmj_new_coord[1])), 
-                            #               (int(fgmj_new_coord[2]), int(fgmj_new_coord[3])), (255, 0, 0), 2)
-                            # cv2.imshow("Image", image)
-                            # cv2.waitKey(0)
-                            # cv2.destroyAllWindows()
-                            # cv2.imwrite(f"updated_{image_filename}", image_crop)
-                            # time.sleep(120)
-                            cv2.imwrite(os.path.join(image_save_folder, new_name), image_crop)                        
-                
-                if person_cnt > 1:
-                    print(f"  警告: person类别数量过多 ({person_cnt} 个)，跳过该文件")
-                    # prefix = os.path.dirname(image_folder)
-                    # base_name = os.path.basename(image_folder)
-                    # tmp_save_folder = os.path.join(prefix, base_name+"_multi_person")
-                    
-                    time.sleep(60)
-                    continue
-
-                bboxes = []                
-                image_crop = None
-                for i, shape in enumerate(data['shapes']):
-                    label = shape.get('label', 'unknown')
-                    label = label.lower()
-                    group_id = shape.get('group_id', 'unknown')
-                    print(f"    标签: {label}")
-                    print(f"    组ID: {group_id}")
-                    # cls = int(group_id) - 1
-                    points = shape.get('points', [])
-                    x_coords = [point[0] for point in points]
-                    y_coords = [point[1] for point in points]
-                    x_min, x_max = min(x_coords), max(x_coords)
-                    y_min, y_max = min(y_coords), max(y_coords)
-                    
+                # 收集person与aqm/fgmj框
+                labels = np.char.lower(rec.labels)
+                persons = rec.boxes[labels == 'person']
+                is_child = np.isin(labels, ('aqm', 'fgmj'))
+                children, child_labels = rec.boxes[is_child], labels[is_child].tolist()
 
-                    if label == 'aqm':
-                        aqm_ori_coord = (x_min, y_min, x_max, y_max)
-                        x_min_new, y_min_new, x_max_new, y_max_new = update_coords_v1(aqm_ori_coord, (person_x1_new, person_y1_new, person_x2_new, person_y2_new))
-                        if image_crop is not None:
-                            cv2.rectangle(image_crop, (int(x_min_new), int(y_min_new)), 
-                                          (int(x_max_new), int(y_max_new)), (0, 255, 0), 2)
-                            cv2.imwrite(f"debug_aqm_{image_filename}", image_crop)
-                            time.sleep(120)
-                        box = np.array([x_min_new, y_min_new, x_max_new-x_min_new, y_max_new-y_min_new], dtype=np.float64)
-                        box[:2] += box[2:] / 2  # xy top-left corner to center
-                        box[[0, 2]] /= new_crop_width  # normalize x
-                        box[[1, 3]] /= new_crop_height  # normalize y
-                        if box[2] <= 0 or box[3] <= 0:  # if w <= 0 and h <= 0
-                            print(f"    警告: 更新后aqm框无效，跳过该框")
-                            time.sleep(60)
-                            continue
-                        
-                        cls = 0
-                        box = [cls] + box.tolist()
-                        # print(f"Box: {box}")
-                        if box not in bboxes:
-                            bboxes.append(box)
-                        
-                    elif label == 'fgmj':
-                        fgmj_ori_coord = (x_min, y_min, x_max, y_max)
-                        x_min_new, y_min_new, x_max_new, y_max_new  = update_coords_v1(fgmj_ori_coord, (person_x1_new, person_y1_new, person_x2_new, person_y2_new))
-                        # if image_crop is not None:
-                        #     cv2.rectangle(image_crop, (int(x_min_new), int(y_min_new)), 
-                        #                   (int(x_max_new), int(y_max_new)), (0, 255, 0), 2)
-                        #     cv2.imwrite(f"debug_fgmj_{image_filename}", image_crop)
-                        #     time.sleep(120)
-                        box = np.array([x_min_new, y_min_new, x_max_new-x_min_new, y_max_new-y_min_new], dtype=np.float64)
-                        box[:2] += box[2:] / 2  # xy top-left corner to center
-                        box[[0, 2]] /= new_crop_width  # normalize x
-                        box[[1, 3]] /= new_crop_height  # normalize y
-                        if box[2] <= 0 or box[3] <= 0:  # if w <= 0 and h <= 0
-                            print(f"    警告: 更新后fgmj框无效，跳过该框")
-                            time.sleep(60)
-                            continue
-                        
-                        cls = 1
-                        box = [cls] + box.tolist()
-                        # print(f"Box: {box}")
-                        if box not in bboxes:
-                            bboxes.append(box)
+                if len(persons) > 1:
+                    diag.skip("multiple_person", json_file, f"  警告: person类别数量过多 ({len(persons)} 个)，跳过该文件", count=len(persons))
+                    continue
+                if not len(persons):
+                    diag.skip("no_person", json_file, "  警告: 没有person框，跳过该文件")
+                    continue
 
+                # person框放大1.2倍并裁剪到图像内，aqm/fgmj全部归属该person，一次映射为裁剪图内的归一化坐标
+                crops, _, boxes = crop_boxes(persons, children, img_width, img_height, scale=(1.2, 1.2),
+                                             person_ids=[0], child_ids=[0] * len(children))
+                image_crop = read(image_path, crops[0])
+                new_name = f"{image_folder.split('/')[-1]}_{image_filename}"
+                print('new_name=======', new_name)
+                cv2.imwrite(os.path.join(image_save_folder, new_name), image_crop)
+
+                bboxes = []
+                for label, box in zip(child_labels, boxes):
+                    if box[2] <= 0 or box[3] <= 0:  # if w <= 0 and h <= 0
+                        diag.skip("invalid_box", json_file, f"    警告: 更新后{label}框无效，跳过该框", label=label, box=box.tolist())
+                        continue
+                    cls = 0 if label == 'aqm' else 1
+                    bboxes.append([cls] + box.tolist())
+
+                bboxes = unique_rows(bboxes)  # 哈希去重，保持原有顺序
                 label_save_path = os.path.join(label_save_folder, new_name.replace('.jpg', '.txt'))
-                with open(label_save_path, "a+") as file:
-                    for i in range(len(bboxes)):
-                        line = (*(bboxes[i]),)  # cls, box or segments
-                        file.write(("%g " * len(line)).rstrip() % line + "\n")
-
+                with LabelSink(label_save_path, mode="a", pack=packer) as sink:
+                    sink.extend(bboxes)  # cls, box or segments
 
-        except Exception as e:
-            print(f"  处理文件 {json_file} 时出错: {e}")
-            time.sleep(60)
-            continue
+            except Exception as e:
+                diag.error(json_file, e, f"  处理文件 {json_file} 时出错: {e}")
+                continue
+    diag.report()
     
     
 
@@ -297,6 +129,10 @@ def main():
     parser.add_argument('--json_folder', type=str, default='/home/jinyfeng/datas/suidao/safe_det/labels_16f3d2dbf72b7506c8252dcf147f6758_raw_v2', help='JSON标注文件夹路径')
     parser.add_argument('--image_save_folder', type=str, default='/home/jinyfeng/datas/suidao/safe_det/new_16f3d2dbf72b7506c8252dcf147f6758_raw_v2_crop', help='处理后图像保存文件夹路径')
     parser.add_argument('--label_save_folder', type=str, default='/home/jinyfeng/datas/suidao/safe_det/new_labels_16f3d2dbf72b7506c8252dcf147f6758_raw_v2_crop', help='处理后JSON保存文件夹路径')
+    parser.add_argument('--report', type=str, default=None, help='跳过记录的 JSONL 报告路径')
+    parser.add_argument('--strict', action='store_true', help='遇到第一个被跳过的文件或框即中止')
+    parser.add_argument('--store', type=str, default=None, help='标注列存缓存(LabelMeStore)路径，默认不缓存')
+    parser.add_argument('--pack', action='store_true', help='标签打包写入 <label_save_folder>.bin，不再每张图写一个txt')
     
     args = parser.parse_args()
     
@@ -304,7 +140,8 @@ def main():
     print(f"图像文件夹: {args.image_folder}")
     print(f"JSON文件夹: {args.json_folder}")
     
-    read_image_and_json(args.image_folder, args.json_folder, args.image_save_folder, args.label_save_folder)
+    read_image_and_json(args.image_folder, args.json_folder, args.image_save_folder, args.label_save_folder, report=args.report, strict=args.strict,
+                        store=args.store, pack=args.pack)
     
     print("\n处理完成!")
 
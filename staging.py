@@ -0,0 +1,295 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+from collections import defaultdict
+from pathlib import Path
+
+from packing import LabelSink, PackedLabelWriter, ShardWriter
+
+
+def file_signature(file):
+    """Returns the [mtime_ns, size] stat signature of a file, or None if it does not exist."""
+    try:
+        st = os.stat(file)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def file_hash(file, chunk_size=1 << 20):
+    """Returns the SHA-1 hex digest of a file's contents."""
+    h = hashlib.sha1()
+    with open(file, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Input -> output manifest for incremental, resumable conversions.
+
+    Each entry maps a key (usually the annotation file) to the stat signature and content hash of its input files and to
+    the output files it produced. Only inputs whose contents changed are regenerated; a changed mtime with identical
+    contents is just re-stamped. Every completed entry is appended to a journal immediately, so a crashed run resumes
+    where it stopped, and save() compacts the journal into the manifest. The conversion `options` are stored in the
+    manifest header: when they differ from the recorded ones, all recorded outputs are deleted and every input is
+    converted again. Usage:
+
+        m = Manifest(save_dir / "manifest.json", options={"decimals": decimals})
+        if m.changed(key, [json_file, image_file]):
+            m.begin(key, expected_outputs)  # remove stale outputs
+            ...  # convert
+            m.record(key, outputs)
+        m.prune(all_keys)  # delete outputs of vanished inputs
+        m.save()
+    """
+
+    def __init__(self, file, options=None):
+        """Loads the manifest `file` and replays its journal, invalidating both if made with other `options`."""
+        self.file, self.journal = Path(file), Path(file).with_suffix(".journal")
+        self.options = json.loads(json.dumps(options))  # as read back from JSON, e.g. tuples as lists
+        self.entries, self.pending = {}, {}
+        saved, entries = None, {}
+        if self.file.exists():
+            with open(self.file) as f:
+                x = json.load(f)
+            saved, entries = (x["options"], x["entries"]) if "entries" in x else (None, x)  # older files: no header
+        journaled, journal = None, {}
+        if self.journal.exists():
+            with open(self.journal) as f:
+                for line in f:
+                    with contextlib.suppress(ValueError):  # a torn last line from a crash
+                        x = json.loads(line)
+                        if isinstance(x, dict):  # header
+                            journaled = x["options"]
+                        else:
+                            journal[x[0]] = x[1]
+        stale = []  # entries made with other options
+        if saved == self.options:
+            self.entries = entries
+        else:
+            stale += entries.values()
+        if journaled == self.options:
+            self.entries.update(journal)
+        elif journal:
+            stale += journal.values()
+            for k in journal:
+                self.entries.pop(k, None)
+        if stale:
+            print(f"Conversion options changed to {self.options}, converting all inputs again")
+            for e in stale:
+                for x in e["outputs"]:
+                    remove_path(x)
+            self.journal.unlink(missing_ok=True)
+
+    def changed(self, key, files):
+        """Returns True if `key` is new or any of its input `files` changed contents since it was recorded."""
+        files = [str(f) for f in files]
+        old = self.entries.get(key)
+        sigs = [file_signature(f) for f in files]
+        if old and old["files"] == files and old["sigs"] == sigs:
+            return False
+        hashes = [file_hash(f) if s else None for f, s in zip(files, sigs)]
+        self.pending[key] = {"files": files, "sigs": sigs, "hashes": hashes}
+        if old and old["files"] == files and old["hashes"] == hashes:  # touched but identical, keep outputs
+            self.record(key, old["outputs"])
+            return False
+        return True
+
+    def begin(self, key, outputs=()):
+        """Removes the recorded outputs of `key` and any `outputs` a previous, interrupted run may have left behind."""
+        old = self.entries.pop(key, None)
+        for x in {*(old["outputs"] if old else ()), *map(str, outputs)}:
+            remove_path(x)
+
+    def record(self, key, outputs):
+        """Marks `key` as converted into `outputs` and journals the entry."""
+        entry = {**self.pending.pop(key), "outputs": [str(x) for x in outputs]}
+        self.entries[key] = entry
+        with open(self.journal, "a") as f:
+            if not f.tell():
+                f.write(json.dumps({"options": self.options}) + "\n")
+            f.write(json.dumps([key, entry]) + "\n")
+
+    def prune(self, keys):
+        """Deletes the outputs and entries of every recorded key not in `keys`, returning the number removed."""
+        keys = set(keys)
+        gone = [k for k in self.entries if k not in keys]
+        for k in gone:
+            for x in self.entries.pop(k)["outputs"]:
+                remove_path(x)
+        return len(gone)
+
+    def save(self):
+        """Atomically writes the manifest and clears the journal."""
+        tmp = self.file.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"options": self.options, "entries": self.entries}, f)
+        os.replace(tmp, self.file)
+        self.journal.unlink(missing_ok=True)
+
+
+def remove_path(path):
+    """Deletes a file or directory tree if it exists."""
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink(missing_ok=True)
+
+
+STAGE_MODES = ("hardlink", "reflink", "symlink", "copy")  # staging modes, cheapest first
+FICLONE = 0x40049409  # Linux ioctl sharing all extents of one file with another (btrfs, XFS, bcachefs)
+
+
+def same_file(src, dst):
+    """Returns True if `dst` exists and is `src` itself (hardlink/symlink) or a copy of the same size and mtime."""
+    try:
+        s, d = os.stat(src), os.stat(dst)
+    except FileNotFoundError:
+        return False
+    return os.path.samestat(s, d) or (s.st_size == d.st_size and s.st_mtime_ns == d.st_mtime_ns)
+
+
+def reflink(src, dst):
+    """Clones `src` to `dst` by FICLONE or in-kernel copy_file_range keeping its mtime; OSError if unsupported."""
+    try:
+        with open(src, "rb") as fi, open(dst, "wb") as fo:
+            try:
+                import fcntl
+
+                fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+            except (ImportError, OSError):
+                if not hasattr(os, "copy_file_range"):
+                    raise OSError(f"reflink not supported for {dst}")
+                n = os.fstat(fi.fileno()).st_size
+                while n > 0 and (k := os.copy_file_range(fi.fileno(), fo.fileno(), n)):
+                    n -= k
+                if n:
+                    raise OSError(f"short copy_file_range for {dst}")
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(dst)
+        raise
+    shutil.copystat(src, dst)
+
+
+def stage_file(src, dst, mode="reflink"):
+    """
+    Stages `src` at `dst` by 'hardlink', 'reflink', 'symlink' or 'copy' and returns the method used.
+
+    Hardlinks fall back to reflinks and reflinks to full copies when the filesystem or device does not allow them.
+    Copies keep the source mtime, so `same_file` recognises them on later runs. Reflinks are copy-on-write, so editing
+    a reflinked file leaves the source intact. Hardlinks and symlinks are the source file itself: any in-place edit of
+    the staged file, e.g. an image opened with "r+", changes the source dataset, so use them only opt-in for files that
+    are never modified.
+    """
+    assert mode in STAGE_MODES, f"unknown staging mode '{mode}', use one of {STAGE_MODES}"
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if mode == "symlink":
+        os.symlink(os.path.abspath(src), dst)
+        return mode
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return mode
+        except OSError:
+            mode = "reflink"  # cross-device or no hardlink support
+    if mode == "reflink":
+        try:
+            reflink(src, dst)
+            return mode
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+class Stager:
+    """
+    Stages images into output trees at most once, skipping targets that are already identical.
+
+    The default 'reflink' mode shares storage copy-on-write and falls back to a copy. Stage annotation files, which
+    may be edited in place later, with 'copy'. Usage: `stage = Stager(); stage(src, dst); stage.report()`.
+    """
+
+    def __init__(self, mode="reflink"):
+        """Creates a stager using `mode`, one of STAGE_MODES."""
+        assert mode in STAGE_MODES, f"unknown staging mode '{mode}', use one of {STAGE_MODES}"
+        self.mode = mode
+        self.staged = {}  # dst -> src
+        self.counts = defaultdict(int)  # method -> files
+
+    def __call__(self, src, dst):
+        """Stages `src` at `dst` unless already staged this run or identical on disk, and returns `dst`."""
+        key = os.path.abspath(dst)
+        if self.staged.get(key) == src or same_file(src, dst):
+            self.counts["skipped"] += 1
+        else:
+            self.counts[stage_file(src, dst, self.mode)] += 1
+        self.staged[key] = src
+        return dst
+
+    def report(self):
+        """Prints one summary of how files were staged."""
+        if self.counts:
+            print(f"Staged ({self.mode}): " + ", ".join(f"{v} {k}" for k, v in sorted(self.counts.items())))
+
+
+class DatasetWriter:
+    """
+    Writes converted image/label pairs into a dataset directory in one of three layouts.
+
+    By default images are staged into images/ by `stage_mode` and labels written as .txt files under labels/. With
+    `pack=True` the labels go into one `labels.bin` (see PackedLabelWriter), and with `shard_size` > 0 images and labels
+    go into tar shards of at most `shard_size` bytes under `shards/` (see ShardWriter). Packed labels and the open shard
+    are discarded if the `with` block raises. Usage:
+
+        with DatasetWriter(save_dir, pack=True) as out:
+            out.write(image_path, save_dir / "images" / "a.jpg", save_dir / "labels" / "a.txt", rows)
+    """
+
+    def __init__(self, save_dir, stage_mode="reflink", pack=False, shard_size=0, incremental=False):
+        """Checks the layout options, before anything is written; `incremental` writes label files atomically."""
+        if pack and incremental:
+            raise ValueError("pack=True rewrites labels.bin as a whole and cannot be combined with incremental=True")
+        if shard_size and (pack or incremental):
+            raise ValueError(
+                "shard_size > 0 writes labels into tar shards and cannot be combined with pack or incremental"
+            )
+        self.save_dir, self.pack, self.shard_size, self.atomic = Path(save_dir), pack, shard_size, incremental
+        self.stage = Stager(stage_mode)
+        self.stack = contextlib.ExitStack()
+        self.packer = self.shards = None
+
+    def __enter__(self):
+        """Opens the packed label file or the shard writer of the layout."""
+        if self.pack:
+            self.packer = self.stack.enter_context(PackedLabelWriter(self.save_dir / "labels.bin"))
+        if self.shard_size:
+            self.shards = self.stack.enter_context(ShardWriter(self.save_dir / "shards", max_size=self.shard_size))
+        return self
+
+    def __exit__(self, exc_type, *args):
+        """Completes the packed labels or shards, or discards them if the block raised, and reports the staging."""
+        self.stack.__exit__(exc_type, *args)
+        if exc_type is None:
+            self.stage.report()
+
+    def write(self, image_path, image_dst, label_path, rows):
+        """Writes the image at `image_path` to `image_dst` and its label `rows` to `label_path`, or both to a shard."""
+        if self.shards:
+            sink = LabelSink(label_path)
+            sink.extend(rows)
+            files = {Path(image_dst).suffix[1:]: Path(image_path), "txt": sink.format()}
+            self.shards.write(Path(label_path).stem, files)
+        else:
+            self.stage(image_path, image_dst)
+            with LabelSink(label_path, atomic=self.atomic, pack=self.packer) as sink:
+                sink.extend(rows)
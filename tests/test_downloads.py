@@ -0,0 +1,177 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+
+from downloads import Downloader, DownloadLedger, ResourceStream, Transport, pooled_session
+
+BODY = b"\xff\xd8" + bytes(range(256)) * 64 + b"\xff\xd9"
+RESOURCES = [{"pic": f"http://img/{t}.jpg", "time": t} for t in range(0, 1000, 5)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Serves /ok, /slow (tracking concurrency), /flaky (503 once), /missing (404), /truncated (short body) and
+    /resources/{sized,chunked}, the RESOURCES between start_time and end_time inclusive.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        """Answers by the first path component."""
+        server, kind = self.server, self.path.split("/")[1]
+        if kind == "resources":
+            return self.resources()
+        with server.lock:
+            server.hits[self.path] += 1
+            hits = server.hits[self.path]
+        if kind == "slow":
+            with server.lock:
+                server.active += 1
+                server.max_active = max(server.max_active, server.active)
+            time.sleep(0.05)
+            with server.lock:
+                server.active -= 1
+        if kind == "missing" or (kind == "flaky" and hits == 1):
+            self.send_response(404 if kind == "missing" else 503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        if kind == "truncated":
+            self.wfile.write(BODY[:100])  # fewer bytes than announced, then the connection is closed
+            self.close_connection = True
+            return
+        self.wfile.write(BODY)
+
+    def resources(self):
+        """Answers a resource query with a Content-Length, or chunked without one."""
+        url = urlsplit(self.path)
+        q = {k: int(v[0]) for k, v in parse_qs(url.query).items() if k != "deviceName"}
+        with self.server.lock:
+            self.server.hits[url.path] += 1
+        items = [x for x in RESOURCES if q["start_time"] <= x["time"] <= q["end_time"]]
+        body = json.dumps({"code": 0, "data": items}).encode()
+        self.send_response(200)
+        if url.path.endswith("sized"):
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in range(0, len(body), 256):
+            chunk = body[i : i + 256]
+            self.wfile.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *args):
+        """Keeps the test output quiet."""
+
+
+@pytest.fixture
+def server():
+    """Runs Handler on an ephemeral localhost port and yields the server with its base URL in `url`."""
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.daemon_threads = True
+    httpd.lock, httpd.hits, httpd.active, httpd.max_active = threading.Lock(), Counter(), 0, 0
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def downloader(workers=8, per_host=2, retries=2, ledger=None):
+    """Returns a Downloader whose transport retries without sleeping."""
+    transport = Transport(timeout=(2, 2), retries=retries, backoff=0, session=pooled_session(per_host))
+    return Downloader(workers=workers, per_host=per_host, transport=transport, ledger=ledger)
+
+
+def test_per_host_cap(server, tmp_path):
+    """No more than `per_host` downloads from one host run at once, however many workers are free."""
+    items = [(f"{server.url}/slow/{i}", tmp_path / f"{i}.jpg") for i in range(12)]
+    with downloader(workers=8, per_host=2) as dl:
+        results = list(dl.map(items))
+    assert all(r.error is None for r in results)
+    assert 1 <= server.max_active <= 2
+    assert all(p.read_bytes() == BODY for _, p in items)
+
+
+def test_failed_download_leaves_no_part_file(server, tmp_path):
+    """A body cut off on every attempt is retried, then reported without a .part or truncated file left behind."""
+    path = tmp_path / "a.jpg"
+    with downloader(retries=2) as dl:
+        (r,) = dl.map([(f"{server.url}/truncated/a", path)])
+    assert r.error is not None
+    assert server.hits["/truncated/a"] == 3
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_retry_then_success(server, tmp_path):
+    """A 503 is retried and the second attempt's body is saved with its size, ETag and SHA-1."""
+    path = tmp_path / "b.jpg"
+    with downloader() as dl:
+        (r,) = dl.map([(f"{server.url}/flaky/b", path)])
+        metrics = dict(dl.transport.metrics)
+    assert r.error is None
+    assert (r.size, r.etag) == (len(BODY), '"v1"')
+    assert path.read_bytes() == BODY
+    assert server.hits["/flaky/b"] == 2
+    assert metrics["retries"] == 1 and metrics["failures"] == 0
+
+
+def test_not_found_is_not_retried(server, tmp_path):
+    """A 404 fails at once, without retries or leftovers."""
+    with downloader() as dl:
+        (r,) = dl.map([(f"{server.url}/missing/c", tmp_path / "c.jpg")])
+        metrics = dict(dl.transport.metrics)
+    assert isinstance(r.error, requests.exceptions.HTTPError)
+    assert server.hits["/missing/c"] == 1
+    assert metrics["retries"] == 0 and metrics["failures"] == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_ledger_skips_completed_downloads(server, tmp_path):
+    """A re-run downloads only what failed or whose file went missing."""
+    out = tmp_path / "out"
+    out.mkdir()
+    items = [(f"{server.url}/ok/{i}", out / f"{i}.jpg") for i in range(4)] + [
+        (f"{server.url}/missing/x", out / "x.jpg")
+    ]
+    with DownloadLedger(str(tmp_path / "downloads.sqlite")) as ledger:
+        with downloader(ledger=ledger) as dl:
+            assert sum(r.error is None for r in dl.map(items)) == 4
+        assert ledger.counts == {"skipped": 0, "done": 4, "failed": 1}
+
+    (out / "2.jpg").unlink()
+    with DownloadLedger(str(tmp_path / "downloads.sqlite")) as ledger:
+        with downloader(ledger=ledger) as dl:
+            results = list(dl.map(items))
+        assert ledger.counts == {"skipped": 3, "done": 1, "failed": 1}
+    assert sorted(r.url for r in results) == [f"{server.url}/missing/x", f"{server.url}/ok/2"]
+    assert server.hits["/ok/0"] == 1 and server.hits["/ok/2"] == 2
+
+
+@pytest.mark.parametrize("kind", ["sized", "chunked"])
+def test_resource_stream_splits_large_windows(server, kind):
+    """Windows over split_bytes are split whether or not the size is announced, and every item is yielded once."""
+    with Transport(retries=0) as transport:
+        stream = ResourceStream(transport, f"{server.url}/resources/{kind}", {"start_time": 0, "end_time": 999},
+                                split_bytes=2048, min_span=10)  # fmt: skip
+        items = list(stream)
+    assert stream.error is None
+    assert items == RESOURCES  # boundary items of adjacent windows, and items streamed before a split, not repeated
+    assert stream.count == len(RESOURCES) and stream.windows > 1
+    assert server.hits[f"/resources/{kind}"] > stream.windows  # the oversized windows were queried, then split
@@ -0,0 +1,55 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import contextlib
+import json
+from multiprocessing import Pool
+
+import numpy as np
+import pytest
+
+import general_json2yolo
+
+
+def min_index_reference(arr1, arr2):
+    """All-pairs min_index, the first row-major minimum."""
+    dis = ((arr1[:, None, :] - arr2[None, :, :]) ** 2).sum(-1)
+    return np.unravel_index(np.argmin(dis, axis=None), dis.shape)
+
+
+@pytest.mark.parametrize("kdtree", [True, False], ids=["kdtree", "blocked"])
+def test_min_index_matches_all_pairs(monkeypatch, kdtree):
+    """Both large-input paths return the all-pairs result, ties included, for bounds smaller than either axis."""
+    if kdtree:
+        pytest.importorskip("scipy")
+    else:
+        monkeypatch.setattr(general_json2yolo, "cKDTree", None)
+    rng = np.random.default_rng(0)
+    for t in range(200):
+        n, m = rng.integers(1, 50, 2)
+        if t % 2:
+            arr1, arr2 = rng.random((n, 2)) * 100, rng.random((m, 2)) * 100
+        else:  # integer grid, many equal distances
+            arr1, arr2 = rng.integers(0, 4, (n, 2)).astype(float), rng.integers(0, 4, (m, 2)).astype(float)
+        max_elements = int(rng.integers(1, 40))
+        expected = tuple(int(x) for x in min_index_reference(arr1, arr2))
+        assert tuple(int(x) for x in general_json2yolo.min_index(arr1, arr2, max_elements)) == expected
+
+
+def test_stream_workers_match_in_memory(tmp_path):
+    """Streamed buckets converted in parallel write the same label files as the in-memory path, for shared names too."""
+    rng = np.random.default_rng(0)
+    images = [{"id": i, "width": 640, "height": 480, "file_name": f"img{i % 7}.{'png' if i % 5 else 'jpg'}"}
+              for i in range(1, 60)]  # fmt: skip
+    anns = [{"id": k, "image_id": int(rng.integers(1, 60)), "category_id": int(rng.integers(1, 10)), "iscrowd": 0,
+             "bbox": (rng.random(4) * 200).round(1).tolist()} for k in range(400)]  # fmt: skip
+    json_file = tmp_path / "instances.json"
+    json_file.write_text(json.dumps({"annotations": anns, "images": images}))  # annotations precede their images
+
+    out = {}
+    for stream in (False, True):
+        fn = tmp_path / str(stream)
+        fn.mkdir()
+        with Pool(4) if stream else contextlib.nullcontext() as pool:
+            general_json2yolo.convert_coco_file(json_file, fn, stream=stream, workers=4 if stream else 0, pool=pool)
+        out[stream] = {p.name: p.read_text() for p in fn.iterdir()}
+    assert len(out[False]) == 7 and out[True] == out[False]
@@ -0,0 +1,48 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import json
+import os
+
+import numpy as np
+
+from labelstore import LabelMeStore
+
+
+def write_json(path, shapes=None, **kwargs):
+    """Writes a LabelMe JSON file with rectangle `shapes` [(label, group_id, [[x0, y0], [x1, y1]]), ...]."""
+    data = {"imagePath": path.with_suffix(".jpg").name, "imageWidth": 640, "imageHeight": 480, **kwargs}
+    if shapes is not None:
+        data["shapes"] = [
+            {"label": label, "group_id": g, "shape_type": "rectangle", "points": p} for label, g, p in shapes
+        ]
+    path.write_text(json.dumps(data))
+
+
+def test_labelme_store(tmp_path):
+    """The store holds the JSON shapes and recompiles only changed files."""
+    d = tmp_path / "json"
+    d.mkdir()
+    write_json(d / "a.json", [("person", 1, [[10, 20], [110, 220]]), ("helmet", None, [[30.5, 25], [50, 40.25]])])
+    write_json(d / "b.json", [])
+    write_json(d / "c.json")  # no "shapes" key
+    (d / "d.json").write_text("{")
+    store = LabelMeStore.open(d, tmp_path / "store.npz")
+
+    a, b, c, e = store
+    assert (a.file, a.image_path, a.width, a.height, a.error) == ("a.json", "a.jpg", 640, 480, None)
+    assert a.labels.tolist() == ["person", "helmet"] and a.group_ids.tolist() == [1, -1]
+    np.testing.assert_array_equal(a.xywh(), [[10, 20, 100, 200], [30.5, 25, 19.5, 15.25]])
+    assert a.shapes()[1] == {"label": "helmet", "points": [[30.5, 25], [50, 40.25]], "group_id": None,
+                             "shape_type": "rectangle"}  # fmt: skip
+    assert (len(b.labels), b.has_shapes, c.has_shapes) == (0, True, False)
+    assert e.error.startswith("JSONDecodeError") and not e.has_shapes
+
+    assert LabelMeStore.open(d, tmp_path / "store.npz").files.tolist() == store.files.tolist()  # loaded, unchanged
+    uncached = LabelMeStore.open(d)  # parsed without writing a store
+    assert uncached.files.tolist() == store.files.tolist() and uncached[0].labels.tolist() == ["person", "helmet"]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["json", "store.npz"]
+    write_json(d / "b.json", [("vest", 2, [[0, 0], [8, 8]])])
+    st = os.stat(d / "b.json")
+    os.utime(d / "b.json", ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))  # a distinct signature on coarse clocks
+    b = LabelMeStore.open(d, tmp_path / "store.npz")[1]
+    assert b.labels.tolist() == ["vest"] and b.boxes.tolist() == [[0, 0, 8, 8]]
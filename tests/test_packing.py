@@ -0,0 +1,93 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import json
+import tarfile
+
+import numpy as np
+import pytest
+
+from packing import LabelSink, PackedLabels, PackedLabelWriter, ShardWriter
+
+
+def test_packed_labels_match_txt(tmp_path):
+    """Packed labels export to the same .txt files as LabelSink writes, with appended rows kept in order."""
+    rng = np.random.default_rng(0)
+    labels = {f"img_{i:03d}.txt": np.c_[rng.integers(0, 5, (i % 4, 1)), rng.random((i % 4, 4))] for i in range(20)}
+    fmt = "%g %.6f %.6f %.6f %.6f"
+    with PackedLabelWriter(tmp_path / "labels.bin") as writer:
+        for name, rows in reversed(labels.items()):
+            with LabelSink(tmp_path / "txt" / name, fmt=fmt, pack=writer) as sink:
+                sink.extend(rows)
+        with LabelSink(tmp_path / "txt" / "img_001.txt", fmt=fmt, mode="a", pack=writer) as sink:
+            sink.add(9, [0.5, 0.5, 0.25, 0.25])
+    assert not list(tmp_path.glob(".*.rows"))
+
+    (tmp_path / "txt").mkdir()
+    for name, rows in labels.items():
+        with LabelSink(tmp_path / "txt" / name, fmt=fmt) as sink:
+            sink.extend(rows)
+    with LabelSink(tmp_path / "txt" / "img_001.txt", fmt=fmt, mode="a") as sink:
+        sink.add(9, [0.5, 0.5, 0.25, 0.25])
+
+    packed = PackedLabels(tmp_path / "labels.bin")
+    assert packed.names.tolist() == sorted(labels) and "img_001.txt" in packed and "img_999.txt" not in packed
+    assert packed["img_001.txt"][-1].tolist() == [9, 0.5, 0.5, 0.25, 0.25]
+    assert packed.export(tmp_path / "exported") == len(labels)
+    for name in labels:
+        assert (tmp_path / "exported" / name).read_text() == (tmp_path / "txt" / name).read_text()
+
+
+def test_packed_label_writer_discards_on_error(tmp_path):
+    """A failed `with` block writes no packed file and removes the temporary rows."""
+    with pytest.raises(RuntimeError), PackedLabelWriter(tmp_path / "labels.bin") as writer:
+        writer.add("a.txt", "0 0.5 0.5 0.1 0.1\n")
+        raise RuntimeError
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_packed_label_writer_merge(tmp_path):
+    """Worker parts merge into one packed file equal to packing everything at once."""
+    for part, names in (("p0.bin", ["b.txt", "d.txt"]), ("p1.bin", ["a.txt", "c.txt"])):
+        with PackedLabelWriter(tmp_path / part) as writer:
+            for name in names:
+                writer.add(name, f"{ord(name[0]) - 97} 0.5 0.5 0.1 0.1\n")
+    merged = PackedLabels(PackedLabelWriter.merge(tmp_path / "all.bin", [tmp_path / "p0.bin", tmp_path / "p1.bin"]))
+    assert merged.names.tolist() == ["a.txt", "b.txt", "c.txt", "d.txt"]
+    assert merged.rows[:, 0].tolist() == [0, 1, 2, 3]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["all.bin", "all.idx.npz"]
+
+
+def test_shard_writer(tmp_path):
+    """Samples round-trip through size-bounded tar shards whose index points at each sample's first member."""
+    samples = {f"img_{i:03d}": {"jpg": bytes([i]) * (100 * i + 1), "txt": f"0 0.5 0.5 0.{i} 0.1\n"} for i in range(30)}
+    (tmp_path / "src.jpg").write_bytes(b"\xff\xd8payload\xff\xd9")
+    with ShardWriter(tmp_path, max_size=20 * 1024, max_count=8) as shards:
+        for key, files in samples.items():
+            shards.write(key, files)
+        shards.write("from_path", {"jpg": tmp_path / "src.jpg"})
+
+    index = json.loads((tmp_path / "shard-index.json").read_text())
+    assert index["samples"] == 31 and not list(tmp_path.glob(".*.tmp"))
+    seen = {}
+    for shard in index["shards"]:
+        path = tmp_path / shard["name"]
+        assert shard["size"] == path.stat().st_size <= 20 * 1024 and 0 < shard["samples"] <= 8
+        with tarfile.open(path) as tar:
+            members = tar.getmembers()
+            assert list(dict.fromkeys(m.name.rsplit(".", 1)[0] for m in members)) == shard["keys"]
+            for key, offset in zip(shard["keys"], shard["offsets"]):
+                assert next(m for m in members if m.offset == offset).name.startswith(key + ".")
+            for m in members:
+                seen[m.name] = tar.extractfile(m).read()
+    for key, files in samples.items():
+        assert seen[f"{key}.jpg"] == files["jpg"] and seen[f"{key}.txt"] == files["txt"].encode()
+    assert seen["from_path.jpg"] == b"\xff\xd8payload\xff\xd9"
+
+
+def test_shard_writer_discards_on_error(tmp_path):
+    """A failed `with` block keeps completed shards but deletes the incomplete one and writes no index."""
+    with pytest.raises(RuntimeError), ShardWriter(tmp_path, max_count=2) as shards:
+        for i in range(3):
+            shards.write(f"k{i}", {"txt": "0 0.5 0.5 0.1 0.1\n"})
+        raise RuntimeError
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["shard-000000.tar"]
@@ -0,0 +1,23 @@
+# Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
+
+import numpy as np
+
+from utils import crop_boxes
+
+
+def test_crop_boxes_remap():
+    """Children are remapped against the integer crop, including an origin snapped down to the alignment grid."""
+    person, helmet, outside = [50.5, 20.5, 70.5, 60.5], [55, 22, 65, 30], [150, 50, 160, 60]
+    crops, assign, boxes = crop_boxes([person], [helmet, outside], 200, 100)  # expanded to 48.5, 16.5, 72.5, 64.5
+    assert crops.tolist() == [[48, 16, 72, 64]] and assign.tolist() == [0, -1]
+    np.testing.assert_allclose(boxes[0], [12 / 24, 10 / 48, 10 / 24, 8 / 48])  # helmet at x 7-17, y 6-14 of 24 x 48
+    assert np.isnan(boxes[1]).all()
+
+    crops, assign, boxes = crop_boxes([person], [helmet], 200, 100, align=(32, 32))
+    assert crops.tolist() == [[32, 0, 72, 64]]
+    np.testing.assert_allclose(boxes[0], [0.7, 0.40625, 0.25, 0.125])  # helmet at x 23-33, y 22-30 of 40 x 64
+
+    _, assign, _ = crop_boxes(
+        [person, [0, 0, 30, 30]], [helmet, [5, 5, 10, 10]], 200, 100, person_ids=[1, 2], child_ids=[2, 1]
+    )
+    assert assign.tolist() == [1, 0]  # assigned by group id, not by overlap
@@ -1,14 +1,63 @@
 # Ultralytics 🚀 AGPL-3.0 License - https://ultralytics.com/license
 
+import contextlib
 import glob
+import json
 import os
 import shutil
+from collections import defaultdict
 from pathlib import Path
 
 import numpy as np
 from PIL import ExifTags
 from tqdm import tqdm
 
+# Helpers split into their own modules, re-exported for the scripts that use `from utils import *`
+from imageio_utils import (  # noqa: F401
+    JPEG_SUBSAMPLING,
+    ORIENTATION,
+    FrameCache,
+    ImageSizeCache,
+    ImageWriter,
+    RegionReader,
+    encode_params,
+    exif_orientation,
+    image_header,
+    imread_crop,
+    jpeg_crop,
+    jpeg_crop_ready,
+    jpeg_decode_region,
+    jpeg_header,
+    jpeg_mcu,
+    jpeg_region_bounds,
+    jpeg_restart_layout,
+    passthrough_safe,
+    png_header,
+    write_image,
+)
+from labelstore import LabelMeRecord, LabelMeStore  # noqa: F401
+from packing import (  # noqa: F401
+    PACKED_FORMAT,
+    LabelSink,
+    PackedLabels,
+    PackedLabelWriter,
+    ShardWriter,
+    packed_index,
+)
+from staging import (  # noqa: F401
+    FICLONE,
+    STAGE_MODES,
+    DatasetWriter,
+    Manifest,
+    Stager,
+    file_hash,
+    file_signature,
+    reflink,
+    remove_path,
+    same_file,
+    stage_file,
+)
+
 # Parameters
 img_formats = ["bmp", "jpg", "jpeg", "png", "tif", "tiff", "dng"]  # acceptable image suffixes
 vid_formats = ["mov", "avi", "mp4", "mpg", "mpeg", "m4v", "wmv", "mkv"]  # acceptable video suffixes
@@ -32,6 +81,324 @@ def exif_size(img):
     return s
 
 
+class ImageIndex:
+    """
+    Stem and file-name index of image folders, built with one os.scandir pass per folder.
+
+    Replaces per-record glob() calls, which rescan the folder for every lookup. Stem lookups return the path whose
+    suffix ranks first in `img_formats`. Misses are collected in `missing` and reported together by report().
+    """
+
+    def __init__(self, recursive=False):
+        """Creates an empty index; folders are scanned lazily on first lookup."""
+        self.recursive = recursive
+        self.dirs = {}  # folder -> (names, stems)
+        self.missing = []
+
+    def scan(self, root):
+        """Returns the (name -> path, stem -> paths) dicts of folder `root`, scanning it once."""
+        if root not in self.dirs:
+            names, stems = {}, defaultdict(list)
+            stack = [root]
+            while stack:
+                d = stack.pop()
+                with os.scandir(d) as it:
+                    for e in it:
+                        if e.is_dir() and self.recursive:
+                            stack.append(e.path)
+                        elif e.is_file():
+                            name = os.path.relpath(e.path, root) if d != root else e.name
+                            names[name] = os.path.join(root, name)
+                            stems[os.path.splitext(name)[0]].append(names[name])
+            rank = {f".{x}": i for i, x in enumerate(img_formats)}
+            for paths in stems.values():
+                paths.sort(key=lambda x: rank.get(os.path.splitext(x)[1].lower(), len(rank)))
+            self.dirs[root] = names, stems
+        return self.dirs[root]
+
+    def find(self, root, stem=None, name=None):
+        """Returns the path of file `name`, or of the best image with `stem`, in folder `root`; None if missing."""
+        names, stems = self.scan(root)
+        path = names.get(name) if name is not None else next(iter(stems.get(stem, ())), None)
+        if path is None:
+            self.missing.append(os.path.join(root, name if name is not None else f"{stem}.*"))
+        return path
+
+    def report(self, file=None, n=10):
+        """Prints one summary of all missing images, writing the full list to `file` if given."""
+        if self.missing:
+            if file:
+                with open(file, "w") as f:
+                    f.writelines(f"{x}\n" for x in self.missing)
+            print(
+                f"WARNING, {len(self.missing)} missing images{f' (listed in {file})' if file else ''}:",
+                self.missing[:n],
+            )
+
+
+class StrictModeError(RuntimeError):
+    """Raised by Diagnostics in strict mode at the first skipped file or box."""
+
+
+class Diagnostics:
+    """
+    Structured warning channel for label extraction: counts skips by reason and logs each one to a JSONL report.
+
+    Replaces sleep-on-warning stalls, so throughput does not depend on how dirty the input is. With `strict=True` the
+    first skip raises StrictModeError instead. Usage: `with Diagnostics("skips.jsonl") as diag: diag.skip(...)`.
+    """
+
+    def __init__(self, file=None, strict=False):
+        """Creates a collector appending one JSON line per skip to `file` if given."""
+        self.file, self.strict = file, strict
+        self.counts = defaultdict(int)  # reason -> skips
+
+    def record(self, reason, file, msg=None, **info):
+        """Counts and logs one skip of `file` (or of one of its boxes) for `reason`, printing `msg` if given."""
+        if msg:
+            print(msg)
+        self.counts[reason] += 1
+        self.write([{"reason": reason, "file": str(file), **info}])
+
+    def write(self, records):
+        """Appends `records` to the JSONL report, opening and closing it per call so no handle outlives a crash."""
+        if self.file and records:
+            Path(self.file).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.file, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(x, ensure_ascii=False, default=str) + "\n" for x in records)
+
+    def skip(self, reason, file, msg=None, **info):
+        """Records a skip and raises StrictModeError in strict mode."""
+        self.record(reason, file, msg, **info)
+        if self.strict:
+            raise StrictModeError(f"{reason}: {file}")
+
+    def error(self, file, e, msg=None):
+        """Records an exception raised while processing `file`, re-raising it in strict mode."""
+        if not isinstance(e, StrictModeError):
+            self.record("error", file, msg, error=repr(e))
+        if self.strict:
+            raise e
+
+    def merge(self, files):
+        """Appends the records of other JSONL reports (e.g. per-worker logs) to this one, counts and deletes them."""
+        for file in files:
+            records = []
+            with open(file, encoding="utf-8") as f:
+                for line in f:
+                    with contextlib.suppress(ValueError):
+                        records.append(json.loads(line))
+            for x in records:
+                self.counts[x["reason"]] += 1
+            self.write(records)
+            os.remove(file)
+
+    def report(self):
+        """Prints the skip counts by reason."""
+        if self.counts:
+            where = f" (details in {self.file})" if self.file else ""
+            print(
+                f"Skipped {sum(self.counts.values())}{where}: " + ", ".join(f"{v} {k}" for k, v in self.counts.items())
+            )
+
+    def __enter__(self):
+        """Returns the collector for use as a context manager that reports on exit."""
+        return self
+
+    def __exit__(self, *args):
+        """Prints the report."""
+        self.report()
+
+
+class JSONStreamReader:
+    """Incremental reader that decodes one JSON value at a time from a text file without loading it whole."""
+
+    def __init__(self, f, chunk_size=1 << 20):
+        """Wraps an open text file `f`, reading `chunk_size` characters at a time."""
+        self.f, self.chunk_size = f, chunk_size
+        self.buf, self.pos, self.eof = "", 0, False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        """Drops consumed characters and appends the next chunk, returning False at end of file."""
+        chunk = self.f.read(self.chunk_size)
+        self.buf, self.pos, self.eof = self.buf[self.pos :] + chunk, 0, not chunk
+        return bool(chunk)
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it, or '' at end of file."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def read_char(self):
+        """Consumes and returns the next non-whitespace character."""
+        c = self.peek()
+        self.pos += 1
+        return c
+
+    def read_value(self):
+        """Decodes and consumes the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            if end == len(self.buf) and not self.eof:  # a number may continue in the next chunk
+                self.fill()
+                continue
+            self.pos = end
+            return obj
+
+
+def iter_json_arrays(file, keys, chunk_size=1 << 20):
+    """Yields (key, item) for every item of the top-level arrays named in `keys`, skipping all other members."""
+    with open(file, encoding="utf-8") as f:
+        r = JSONStreamReader(f, chunk_size)
+        assert r.read_char() == "{", f"{file} is not a JSON object"
+        while r.peek() not in {"}", ""}:
+            key = r.read_value()
+            assert r.read_char() == ":", f"malformed JSON member {key!r} in {file}"
+            if key in keys and r.peek() == "[":
+                r.read_char()
+                while r.peek() != "]":
+                    yield key, r.read_value()
+                    if r.peek() == ",":
+                        r.read_char()
+                r.read_char()
+            else:
+                r.read_value()  # skip
+            if r.peek() == ",":
+                r.read_char()
+
+
+def points_xyxy(points, dtype=np.float64):
+    """Returns the (N, 4) xyxy bounding rectangles of a list of N LabelMe point lists in one vectorized pass."""
+    n = np.array([len(p) for p in points], dtype=np.int64)
+    if not len(n):
+        return np.zeros((0, 4), dtype=dtype)
+    p = np.array([xy for x in points for xy in x], dtype=dtype).reshape(-1, 2)
+    i = np.concatenate(([0], np.cumsum(n)[:-1]))
+    return np.concatenate((np.minimum.reduceat(p, i), np.maximum.reduceat(p, i)), 1)
+
+
+def expand_boxes(boxes, w, h, scale=(1.2, 1.2)):
+    """Scales (N, 4) xyxy boxes about their centres by `scale` = (sx, sy) and clips them to a `w` x `h` image."""
+    b = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    c = (b[:, :2] + b[:, 2:]) / 2
+    half = (b[:, 2:] - b[:, :2]) * np.asarray(scale, dtype=np.float64) / 2
+    return np.concatenate((np.maximum(c - half, 0), np.minimum(c + half, (w, h))), 1)
+
+
+def box_ioa(boxes1, boxes2, eps=1e-9):
+    """Returns the (N, M) intersection-over-area matrix: the fraction of each box in `boxes2` inside each `boxes1`."""
+    b1, b2 = np.asarray(boxes1, dtype=np.float64), np.asarray(boxes2, dtype=np.float64)
+    wh = np.minimum(b1[:, None, 2:], b2[None, :, 2:]) - np.maximum(b1[:, None, :2], b2[None, :, :2])
+    area = (b2[:, 2] - b2[:, 0]) * (b2[:, 3] - b2[:, 1])
+    return wh.clip(0).prod(2) / np.maximum(area, eps)
+
+
+def crop_boxes(persons, children, w, h, scale=(1.2, 1.2), person_ids=None, child_ids=None, min_ioa=1.0, align=(1, 1)):
+    """
+    Crops person-anchored sub-images and remaps their child boxes (e.g. helmets, vests) in one vectorized pass.
+
+    All person boxes are expanded about their centres by `scale` and clipped to the image at once. Each child box is
+    assigned to the first person with the same group id if ids are given, otherwise to the crop it overlaps most with an
+    intersection over the child's area of at least `min_ioa`. Children are remapped to the integer pixel crop, whose
+    origin can be moved down to a multiple of `align`, e.g. the JPEG MCU size for lossless crops.
+
+    Args:
+        persons: (P, 4) xyxy person boxes.
+        children: (C, 4) xyxy child boxes.
+        w, h: image width and height.
+        scale: (sx, sy) expansion factors of the person boxes.
+        person_ids, child_ids: optional (P,) and (C,) group ids used for assignment.
+        min_ioa: containment threshold for assignment without ids.
+        align: (ax, ay) grid the crop origins are snapped to.
+
+    Returns:
+        crops: (P, 4) int64 crop rectangles x0, y0, x1, y1, used as image[y0:y1, x0:x1].
+        assign: (C,) crop index of each child, -1 if unassigned.
+        boxes: (C, 4) child boxes as cxcywh normalized to their crop, nan if unassigned.
+    """
+    persons = np.asarray(persons, dtype=np.float64).reshape(-1, 4)
+    children = np.asarray(children, dtype=np.float64).reshape(-1, 4)
+    crops = expand_boxes(persons, w, h, scale)
+    assign = np.full(len(children), -1, dtype=np.int64)
+    if len(persons) and len(children):
+        if person_ids is not None:
+            match = np.asarray(child_ids, dtype=object)[:, None] == np.asarray(person_ids, dtype=object)[None, :]
+        else:
+            ioa = box_ioa(crops, children).T  # (C, P)
+            match = (ioa >= min_ioa) & (ioa == ioa.max(1, keepdims=True))
+        assign = np.where(match.any(1), match.argmax(1), -1)
+    crops = crops.astype(np.int64)  # truncate like image[int(y0):int(y1), int(x0):int(x1)]
+    crops[:, :2] -= crops[:, :2] % np.asarray(align, dtype=np.int64)
+
+    boxes = np.full((len(children), 4), np.nan)
+    k = assign >= 0
+    if k.any():
+        c = crops[assign[k]]
+        xywh = np.concatenate((children[k, :2] - c[:, :2], children[k, 2:] - children[k, :2]), 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            boxes[k] = normalize_boxes(xywh, c[:, 2] - c[:, 0], c[:, 3] - c[:, 1])[0]
+    return crops, assign, boxes
+
+
+def normalize_boxes(boxes, w, h, fmt="xywh", dtype=np.float64):
+    """
+    Normalizes a batch of boxes to YOLO center-xywh format in one vectorized pass.
+
+    Args:
+        boxes: (N, 4) boxes in `fmt` convention, or for fmt='points' a list of N LabelMe point lists.
+        w, h: image width and height, scalars or (N,) arrays.
+        fmt: 'xywh' (top-left corner, COCO/VoTT), 'xyxy' (corners, INFOLKS) or 'points' (LabelMe shapes).
+        dtype: float dtype of the computation.
+
+    Returns:
+        (N, 4) normalized cxcywh array and (N,) boolean mask of boxes with positive width and height.
+    """
+    w, h = np.asarray(w, dtype=dtype), np.asarray(h, dtype=dtype)
+    if fmt == "points":  # LabelMe point lists -> top-left xywh of their bounding rectangle
+        b = points_xyxy(boxes, dtype)
+        boxes, fmt = np.concatenate((b[:, :2], b[:, 2:] - b[:, :2]), 1), "xywh"
+
+    b = np.asarray(boxes, dtype=dtype).reshape(-1, 4)
+    y = np.empty_like(b)
+    if fmt == "xywh":
+        y[:, 0] = (b[:, 0] + b[:, 2] / 2) / w  # xy top-left corner to center
+        y[:, 1] = (b[:, 1] + b[:, 3] / 2) / h
+        y[:, 2] = b[:, 2] / w
+        y[:, 3] = b[:, 3] / h
+    elif fmt == "xyxy":
+        x0, x1, y0, y1 = b[:, 0] / w, b[:, 2] / w, b[:, 1] / h, b[:, 3] / h
+        y[:, 0], y[:, 1] = (x0 + x1) / 2, (y0 + y1) / 2
+        y[:, 2], y[:, 3] = x1 - x0, y1 - y0
+    else:
+        raise ValueError(f"unsupported box format '{fmt}'")
+    return y, (y[:, 2] > 0) & (y[:, 3] > 0)
+
+
+def row_key(row, decimals=None):
+    """Returns a hashable key for a label row, rounding values to `decimals` places so near-identical rows collide."""
+    return tuple(row) if decimals is None else tuple(round(x, decimals) for x in row)
+
+
+def unique_rows(rows, decimals=None):
+    """Removes duplicate label rows in O(n), keeping the first occurrence of each in the original order."""
+    unique = {}
+    for row in rows:
+        unique.setdefault(row_key(row, decimals), row)
+    return list(unique.values())
+
+
 def split_rows_simple(file="../data/sm4/out.txt"):  # from utils import *; split_rows_simple()
     """Splits a text file into train, test, and val files based on specified ratios; expects a file path as input."""
     with open(file) as f:
@@ -73,10 +440,10 @@ def split_indices(x, train=0.9, test=0.1, validate=0.0, shuffle=True):  # split
     return v[:i], v[i:j], v[j:k]  # return indices
 
 
-def make_dirs(dir="new_dir/"):
-    """Creates a directory with subdirectories 'labels' and 'images', removing existing ones."""
+def make_dirs(dir="new_dir/", clean=True):
+    """Creates a directory with subdirectories 'labels' and 'images', removing existing ones unless `clean=False`."""
     dir = Path(dir)
-    if dir.exists():
+    if clean and dir.exists():
         shutil.rmtree(dir)  # delete dir
     for p in dir, dir / "labels", dir / "images":
         p.mkdir(parents=True, exist_ok=True)  # make dir
@@ -117,9 +484,11 @@ def add_coco_background(path="../data/sm4/", n=1000):  # from utils import *; ad
         shutil.rmtree(p)  # delete output folder
     os.makedirs(p)  # make new output folder
 
-    # copy images
+    # stage images
+    stage = Stager()
     for image in glob.glob("../coco/images/train2014/*.*")[:n]:
-        os.system(f"cp {image} {p}")
+        stage(image, os.path.join(p, os.path.basename(image)))
+    stage.report()
 
     # add to outb.txt and make train, test.txt files
     f = f"{path}out.txt"
@@ -135,13 +504,16 @@ def create_single_class_dataset(path="../data/sm3"):  # from utils import *; cre
     os.system(f"mkdir {path}_1cls")
 
 
-def flatten_recursive_folders(path="../../Downloads/data/sm4/"):  # from utils import *; flatten_recursive_folders()
+def flatten_recursive_folders(
+    path="../../Downloads/data/sm4/", mode="reflink"
+):  # from utils import *; flatten_recursive_folders()
     """Flattens nested folders in 'path/images' and 'path/json' into single 'images_flat' and 'json_flat'
-    directories.
+    directories, staging images by `mode` (see STAGE_MODES) and copying the JSON files.
     """
     idir, _jdir = f"{path}images/", f"{path}json/"
     nidir, njdir = Path(f"{path}images_flat/"), Path(f"{path}json_flat/")
     n = 0
+    stage, stage_json = Stager(mode), Stager("copy")  # JSON files may be edited in place
 
     # Create output folders
     for p in [nidir, njdir]:
@@ -162,11 +534,13 @@ def flatten_recursive_folders(path="../../Downloads/data/sm4/"):  # from utils i
                 image = parent / f
                 json = Path(parent.replace("images", "json")) / str(f).replace(suffix, ".json")
 
-                os.system(f"cp '{json}' '{json_new}'")
-                os.system(f"cp '{image}' '{image_new}'")
+                stage_json(json, json_new)
+                stage(image, image_new)
                 # cv2.imwrite(str(image_new), cv2.imread(str(image)))
 
     print(f"Flattening complete: {n:g} jsons and images")
+    stage.report()
+    stage_json.report()
 
 
 def coco91_to_coco80_class():  # converts 80-index (val2014) to 91-index (paper)